@@ -1,17 +1,46 @@
 """Prepare training data."""
 
 
+import csv
+import json
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas
 import sys
 import getopt
-from getQconfs import scanFolder
-from imagefitting import process
-from scanqconf import ScanQconf
-from os import path
+import functools
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import tifffile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from folderindex import FolderIndex, readHeader, savePlan
+from folderwatch import FolderWatcher
+from masks import cellMasks
+from imagefitting import cutBoxes, processBatch, processChannels, resizeModes
+from scanqconf import ScanQconf, StreamQconf
 from skimage import io
-from nameresolver import resolveNames
+from os import path
+from nameresolver import resolveNames, resolveChannels
+from stackcache import FrameCache, FramePrefetcher
+from cropcache import CropCache
+from cellwriter import AsyncWriter, writers, BufferWriter
+from qconfindex import QconfIndex
+from manifest import Manifest, manifestName, frameDone
+from sizestats import columns
+from celltable import CellTable
+from synthetic import makeDataset
+from metrics import Metrics, Progress, timed
+from sharding import (parseShard, selectShard, saveStats, loadStats, statsFirsts, shardFileName, saveCounters,
+                      mergeShardCounters)
+
+logger = logging.getLogger(__name__)
+maskTail = '_mask'  # tail of masks saved as separate images
+tubeletsName = 'tubelets.csv'  # table of tubelets in output folder
+tubeletColumns = ('index', 'qconf', 'image', 'handler', 'firstFrame', 'lastFrame', 'length')
 
 
 def parseProgramArgs(argv):
@@ -20,11 +49,47 @@ def parseProgramArgs(argv):
     outputFolder = './out'
     showPlot = False
     processTails = ()  # process only image pointed in QCONF
-    outSize = None
+    outSize = None  # tuple of sizes of output images
     useBckg = False  # use cell background from image (not 0)
     randomizeFileNames = False
+    jobs = 1  # number of worker processes
+    streamQconf = False  # parse QCONFs in one pass without loading them
+    writer = 'png'  # output format
+    indexFile = None  # cache of parsed QCONFs
+    resume = False  # skip work recorded in manifest
+    resizeMode = 'bilinear'  # resampling of cells larger than output size
+    verbose = False  # log every processed frame
+    profile = False  # print times of stages
+    metricsFile = None  # save times of stages
+    tableFile = None  # save table of cells
+    cacheBudget = 0  # memory for frames kept between stacks, in bytes
+    reorder = False  # process cells sorted by image and frame
+    prefetchDepth = 0  # frames read in advance by reader thread
+    writerThreads = 0  # threads saving cells
+    channels = False  # tails of cell saved as one multi-channel image
+    statsFile = None  # edge and numbering of cells computed by stats phase
+    saveStatsFile = None  # run only stats phase
+    shard = None  # (i, N) - process only i-th of N parts of QCONFs
+    mergeShards = False  # sum counters of shards
+    mask = None  # masks of cells from snake outlines, 'zero' or 'channel'
+    recursive = False  # look for QCONFs also in subfolders
+    checkOnly = False  # only check images of QCONFs
+    planFile = None  # save checked images of QCONFs
+    lsm = False  # read tails as channels of original multi-channel file
+    cropCacheFolder = None  # cells saved in earlier runs
+    cropCacheBudget = 1024 ** 3  # size of crop cache in bytes
+    linkCached = False  # hard link cells from crop cache instead of copying
+    tubelets = False  # save all frames of tracked cell as one stack
+    watch = None  # poll input folder every this many seconds
+    watchQueue = 16  # QCONFs processed at once in watch mode
     try:
-        opts, args = getopt.getopt(argv, "hpgrt:i:o:s:", ["indir=", "outdir=", "size="])
+        opts, args = getopt.getopt(argv, "hpgrvt:i:o:s:j:",
+                                   ["indir=", "outdir=", "size=", "jobs=", "stream", "writer=", "index=", "resume",
+                                    "resize=", "profile", "metrics-json=", "cache=", "reorder", "prefetch=",
+                                    "writers=", "channels", "stats=", "save-stats=", "shard=", "merge-shards",
+                                    "cell-table=", "mask=", "recursive", "check", "plan=",
+                                    "crop-cache=", "crop-cache-size=", "link-cached", "lsm", "tubelets",
+                                    "watch=", "watch-queue="])
     except getopt.GetoptError as err:
         print("preparedata.py -i <inputfolder> -o <outputfolder>")
         print(err)
@@ -35,10 +100,64 @@ def parseProgramArgs(argv):
             print("\t -h\tShow help")
             print("\t -p\tShow size distribution and exit")
             print("\t -t\tProcess all images within one QCONF that end with list of tails (comma separated)")
-            print("\t -s,--size=\tSize of output images")
+            print("\t --lsm\tRead tails as channels of original multi-channel file (LSM or TIFF) instead of")
+            print("exported images. Original file is image from QCONF or its name without tail (name.lsm for")
+            print("name.lsm_CH_1.tif), tails are _CH_n (channel from 1) or channel indexes from 0. Only needed frames")
+            print("and channels are read")
+            print("\t -s,--size=\tSize of output images, or comma separated sizes. Stacks are read once and cells of")
+            print("each size are saved to <outdir>/<size> folder")
             print("\t -g\tDo not pad by zeros, try to use background from image (cell surroundings). If necessary")
             print("pad by edge value (if cell is close to image edge)")
+            print("\t --resize=\tResampling of cells larger than output: bilinear (default) or area (mean of pixels)")
             print("\t -r\tRandomize output file name (e.g XXX_Y.png, where XXX is global number and Y tail number)")
+            print("\t -j,--jobs=\tNumber of worker processes, each processes one image stack at time (default 1)")
+            print("\t --channels\tSave all tails of cell as one [tails edge edge] image (tiff, npy or hdf5 writer)")
+            print("\t --mask=\tMasks of cells from snake outlines in QCONF: zero - set background outside cell to 0,")
+            print("channel - save mask as one more channel (with --channels) or as one more tail " + maskTail)
+            print("\t --tubelets\tSave all frames of each tracked cell (snake handler) as one [frames edge edge]")
+            print("stack named after its first cell (tiff writer), frames are listed in " + tubeletsName + " in output")
+            print("folder")
+            print("\t --recursive\tLook for QCONFs also in subfolders of <indir>, images are in folder of their QCONF")
+            print("\t --check\tOnly check that all images exist and match QCONFs (frames, size, type) and exit. The")
+            print("same check is done before every run, nothing is processed if any problem is found")
+            print("\t --plan=\tSave checked images, frames, size and type of each QCONF to this JSON file")
+            print("\t --stream\tRead only cell bounds from QCONFs in one pass, do not load whole file (needs ijson)")
+            print("\t --writer=\tOutput format: png - one file per cell (default), tiff - one tiff per cell, npy -")
+            print("cells<tail>.npy array per tail, hdf5 - one dataset per tail in cells.h5 (needs h5py). Arrays are")
+            print("described in cells.csv table")
+            print("\t --cell-table=\tSave table of all cells (celltable.CellTable) to this npz file")
+            print("\t --index=\tKeep data read from QCONFs in this file, next runs parse only changed QCONFs")
+            print("\t --resume\tSkip cells already saved with the same parameters, see " + manifestName + " in output")
+            print("folder (png and tiff writers only). Provide -s, otherwise new QCONFs can change size and everything")
+            print("is redone")
+            print("\t --cache=\tKeep read frames in memory up to this size in MB (for each job), least recently used")
+            print("frames are removed first")
+            print("\t --reorder\tProcess cells sorted by image and frame, each stack is read once even if many QCONFs")
+            print("refer to it. Output names do not change")
+            print("\t --prefetch=\tRead this many next frames in other thread while cells are cut (-j 1), frames")
+            print("of cells in crop cache are not read")
+            print("\t --crop-cache=\tKeep saved cells in this folder, named by hash of their source stacks, frame,")
+            print("box, size and modes. Cells found there are copied instead of cut again, e.g. if only naming, output")
+            print("folder or order of tails change (png and tiff writers only)")
+            print("\t --crop-cache-size=\tSize of crop cache in MB (default 1024), least recently used cells are")
+            print("removed first")
+            print("\t --link-cached\tHard link cells from crop cache to output instead of copying them. Linked files")
+            print("must not be changed in place")
+            print("\t --watch=\tKeep running and every this many seconds process QCONFs that are new or changed in")
+            print("<indir>. QCONF is taken with its images when none of them changed since previous poll and images")
+            print("match it. Needs -s or --stats (only size is taken) so size does not change, cells of new QCONFs are")
+            print("numbered after the ones in manifest (png and tiff writers only)")
+            print("\t --watch-queue=\tProcess at most this many ready QCONFs at once in watch mode (default 16)")
+            print("\t --writers=\tSave cells in this many threads while next ones are cut (png writer)")
+            print("\t --save-stats=\tOnly compute size of cells (or take -s), quartiles and numbering of cells of all")
+            print("QCONFs and save them to this file")
+            print("\t --stats=\tUse size and numbering of cells from file saved by --save-stats")
+            print("\t --shard=\ti/N - process only i-th (from 0) of N parts of QCONFs, needs --stats. Counters are")
+            print("saved to output folder, array writers save to shard-iofN subfolder")
+            print("\t --merge-shards\tPrint summary of all shards saved in output folder and exit")
+            print("\t -v\tLog every processed frame and cell")
+            print("\t --profile\tPrint time, throughput and bytes of each stage at the end")
+            print("\t --metrics-json=\tSave time, throughput and bytes of each stage to JSON file")
             print("By default program processes images referenced in QCONFs (everything must be in the same folder)")
             print("and saves cut cells in output folder (default ./out). If there are more images related to one QCONF")
             print("e.g. masks, other channels etc. they can be processed all together. Naming convenction is important")
@@ -69,61 +188,624 @@ def parseProgramArgs(argv):
         elif opt == "-r":
             randomizeFileNames = True
         elif opt in ("-s", "--size"):
-            outSize = arg
-    if not inputFolder:
+            try:
+                outSize = tuple(int(size) for size in arg.split(','))
+            except ValueError:
+                print("Size must be integer or comma separated integers")
+                sys.exit(2)
+        elif opt in ("-j", "--jobs"):
+            jobs = int(arg)
+        elif opt == "--stream":
+            streamQconf = True
+        elif opt == "--writer":
+            writer = arg
+        elif opt == "--index":
+            indexFile = arg
+        elif opt == "--resume":
+            resume = True
+        elif opt == "--resize":
+            resizeMode = arg
+        elif opt == "-v":
+            verbose = True
+        elif opt == "--profile":
+            profile = True
+        elif opt == "--metrics-json":
+            metricsFile = arg
+        elif opt == "--cache":
+            cacheBudget = int(float(arg) * 1024 ** 2)
+        elif opt == "--reorder":
+            reorder = True
+        elif opt == "--prefetch":
+            prefetchDepth = int(arg)
+        elif opt == "--writers":
+            writerThreads = int(arg)
+        elif opt == "--channels":
+            channels = True
+        elif opt == "--cell-table":
+            tableFile = arg
+        elif opt == "--stats":
+            statsFile = arg
+        elif opt == "--save-stats":
+            saveStatsFile = arg
+        elif opt == "--shard":
+            try:
+                shard = parseShard(arg)
+            except ValueError as err:
+                print(err)
+                sys.exit(2)
+        elif opt == "--merge-shards":
+            mergeShards = True
+        elif opt == "--mask":
+            mask = arg
+        elif opt == "--recursive":
+            recursive = True
+        elif opt == "--check":
+            checkOnly = True
+        elif opt == "--plan":
+            planFile = arg
+        elif opt == "--crop-cache":
+            cropCacheFolder = arg
+        elif opt == "--crop-cache-size":
+            cropCacheBudget = int(float(arg) * 1024 ** 2)
+        elif opt == "--link-cached":
+            linkCached = True
+        elif opt == "--lsm":
+            lsm = True
+        elif opt == "--tubelets":
+            tubelets = True
+        elif opt == "--watch":
+            watch = float(arg)
+        elif opt == "--watch-queue":
+            watchQueue = int(arg)
+    if not inputFolder and not mergeShards:
         print("No <indir> option")
         sys.exit(2)
-    return inputFolder, outputFolder, showPlot, processTails, outSize, useBckg, randomizeFileNames
+    if outSize and (min(outSize) < 1 or len(set(outSize)) < len(outSize)):
+        print("Sizes must be positive and different")
+        sys.exit(2)
+    if outSize and len(outSize) > 1 and saveStatsFile:
+        print("Stats can be saved only for one size")
+        sys.exit(2)
+    if jobs < 1:
+        print("Number of jobs must be positive")
+        sys.exit(2)
+    if prefetchDepth < 0 or writerThreads < 0:
+        print("Number of prefetched frames and writer threads can not be negative")
+        sys.exit(2)
+    if writer not in writers:
+        print("Unknown writer", writer)
+        sys.exit(2)
+    if resizeMode not in resizeModes:
+        print("Unknown resize mode", resizeMode)
+        sys.exit(2)
+    if resume and not writers[writer].parallel:
+        print("Only png and tiff writers can be resumed")
+        sys.exit(2)
+    if lsm and not processTails:
+        print("Give channels to read from original file by -t")
+        sys.exit(2)
+    if cropCacheFolder and not writers[writer].parallel:
+        print("Crop cache works only with png and tiff writers")
+        sys.exit(2)
+    if tubelets and (writer != 'tiff' or cropCacheFolder):
+        print("Tubelets are saved only by tiff writer, without crop cache")
+        sys.exit(2)
+    if channels and writer == 'png':
+        print("Multi-channel cells can not be saved as png, use other writer")
+        sys.exit(2)
+    if mask not in (None, 'zero', 'channel'):
+        print("Unknown mask mode", mask)
+        sys.exit(2)
+    if watch is not None:
+        if watch < 0 or watchQueue < 1:
+            print("Watch interval can not be negative and queue must be positive")
+            sys.exit(2)
+        if not writers[writer].parallel or not (outSize or statsFile):
+            print("Watch mode needs png or tiff writer and fixed size (-s or --stats)")
+            sys.exit(2)
+        if shard or saveStatsFile or showPlot or checkOnly or tubelets or mergeShards:
+            print("Watch mode can not be used with --shard, --save-stats, -p, --check, --tubelets or --merge-shards")
+            sys.exit(2)
+        resume = True  # every batch continues manifest of previous ones
+    if shard and not statsFile:
+        print("Shards need --stats, otherwise each of them selects other size and numbering of cells")
+        sys.exit(2)
+    return {'inputFolder': inputFolder,
+            'outputFolder': outputFolder,
+            'showPlot': showPlot,
+            'processTails': processTails,
+            'outSize': outSize,
+            'useBckg': useBckg,
+            'randomizeFileNames': randomizeFileNames,
+            'jobs': jobs,
+            'streamQconf': streamQconf,
+            'writer': writer,
+            'indexFile': indexFile,
+            'resume': resume,
+            'resizeMode': resizeMode,
+            'verbose': verbose,
+            'profile': profile,
+            'metricsFile': metricsFile,
+            'tableFile': tableFile,
+            'cacheBudget': cacheBudget,
+            'reorder': reorder,
+            'prefetchDepth': prefetchDepth,
+            'writerThreads': writerThreads,
+            'channels': channels,
+            'statsFile': statsFile,
+            'saveStatsFile': saveStatsFile,
+            'shard': shard,
+            'mergeShards': mergeShards,
+            'mask': mask,
+            'recursive': recursive,
+            'checkOnly': checkOnly,
+            'planFile': planFile,
+            'cropCacheFolder': cropCacheFolder,
+            'cropCacheBudget': cropCacheBudget,
+            'linkCached': linkCached,
+            'lsm': lsm,
+            'tubelets': tubelets,
+            'watch': watch,
+            'watchQueue': watchQueue}
 
 
-def main(argv):
+def mergeCounters(counters, other):
+    """Add {'padded':, 'rescaled'} counters from other to counters."""
+    for key in counters:
+        counters[key] += other[key]
+
+
+def subimageNames(options, image):
+    """Return names of subimages of image, used in output names, see nameresolver.resolveNames."""
+    if options['lsm']:
+        return resolveChannels(image, options['processTails'])[2]
+    return resolveNames(path.basename(image), options['processTails'])  # use qconf image to get base name
+
+
+def stackFrames(options, image, sources, cells, edges=(), cropCache=None):
     """
-    Run program.
+    Return (stack, 0-based index) of every frame processStack reads for cells of one stack, in reading order.
+
+    Frames of tails whose cells are all in crop cache in all sizes are not read and are not returned.
+    """
+    subimages = subimageNames(options, image)
+    frameShape = None
+    if cropCache:
+        header = readHeader(sources[0])
+        frameShape = header[1] if header else None
+    frameCells = {}
+    for cell in cells:
+        frameCells.setdefault(cell[4], []).append(cell)
+    extension = writers[options['writer']].extension
+    frames = []
+    for frame, fcells in frameCells.items():
+        sizes = [(cell[2]['x'], cell[2]['y'], cell[2]['width'], cell[2]['height']) for cell in fcells]
+        for countsubimage, subimage, names in stackLoads(options, subimages, sources):
+            if frameShape and all(valid.all() and all(cropCache.has(key, extension) for key in keys)
+                                  for keys, valid in (cellKeys(options, cropCache, names, frame, fcells, sizes, edge,
+                                                               frameShape) for edge in edges)):
+                continue
+            frames.extend((name, frame - 1) for name in names)
+    return frames
+
+
+def stackLoads(options, subimages, sources):
+    """Return (number of tail, subimage, stacks) read together by processStack, all tails at once for channels."""
+    if options['channels']:  # all tails cut at once into [tails edge edge] cells named after first one
+        return [(0, subimages[0], sources)]
+    return [(countsubimage, subimage, [sources[countsubimage]]) for countsubimage, subimage in enumerate(subimages)]
+
+
+def maskImages(masks, dtype):
+    """Convert boolean masks to images of given type, cell pixels have the largest value of integer types or 1."""
+    return (masks * (np.iinfo(dtype).max if np.issubdtype(dtype, np.integer) else 1)).astype(dtype)
+
+
+def writerTails(options):
+    """Return tails that writer gets, tails of subimages and masks as separate images."""
+    if options['channels']:  # one image per cell
+        return ()
+    if options['mask'] == 'channel':
+        return tuple(options['processTails'] or ('cells',)) + (maskTail,)
+    return options['processTails']
+
+
+def writeCells(writer, cells, countsubimage, subimage, frame, cutCells, status, inputFolder, metrics=None):
+    """Save cells cut from one frame of subimage, see processStack. QCONFs are named relative to inputFolder."""
+    for (count, qconf, bounds, centroid, _, _, _), cutCell, st in zip(cells, cutCells, status):
+        meta = {'qconf': path.relpath(qconf, inputFolder), 'image': subimage, 'frame': frame,
+                'x': bounds['x'], 'y': bounds['y'], 'width': bounds['width'], 'height': bounds['height'],
+                'centroidx': centroid['x'], 'centroidy': centroid['y'], 'status': st}
+        start = time.perf_counter()
+        nbytes = writer.write(count, countsubimage, subimage, cutCell, meta)
+        if metrics:
+            metrics.add('write', time.perf_counter() - start, 1, nbytes)
+
+
+def collectTubelets(tubelets, e, cells, countsubimage, subimage, cutCells):
+    """Add cells cut from one frame of subimage to tubelets of their snake handlers, see processStack."""
+    for cell, cutCell in zip(cells, cutCells):
+        tubelets.setdefault((e, countsubimage, subimage, cell[1], cell[6]), []).append((cell[4], cell[0], cutCell))
+
+
+def writeTubelets(writers, tubelets, inputFolder, metrics=None):
+    """Save every tubelet as one [frames edge edge] stack named after its first cell, see processStack, writeCells."""
+    for (e, countsubimage, subimage, qconf, handler), cells in tubelets.items():
+        cells.sort(key=lambda c: c[0])  # by frame
+        meta = {'qconf': path.relpath(qconf, inputFolder), 'image': subimage, 'frame': cells[0][0], 'handler': handler,
+                'length': len(cells)}
+        start = time.perf_counter()
+        nbytes = writers[e].write(cells[0][1], countsubimage, subimage, np.stack([c[2] for c in cells]), meta)
+        if metrics:
+            metrics.add('write', time.perf_counter() - start, 1, nbytes)
+
+
+def saveTubelets(fileName, table, inputFolder):
+    """Save table of tubelets, one row for each snake handler of cells in CellTable, see writeCells."""
+    cells = table.cells
+    with open(fileName, 'w', newline='') as f:
+        out = csv.writer(f)
+        out.writerow(tubeletColumns)
+        for group in table.groups(table.sort(keys=('qconf', 'handler', 'frame')), 'qconf'):
+            for track in table.groups(group, 'handler'):
+                frames = cells['frame'][track]
+                out.writerow([int(cells['count'][track].min()),
+                              path.relpath(table.qconfs[cells['qconf'][track[0]]], inputFolder),
+                              table.images[cells['image'][track[0]]], int(cells['handler'][track[0]]),
+                              int(frames[0]), int(frames[-1]), len(track)])
+
+
+def fetchCells(options, cropCache, writer, names, frame, cells, sizes, edge, shape, countsubimage, subimage):
+    """
+    Copy cells of one frame saved in earlier runs from crop cache to output, see processStack.
+
+    Returns:
+        (cut, status, keys) - indexes of cells that were not cached and have to be cut, status of all cells as returned
+        by processBatch and cache keys of all cells
+
+    """
+    startx, starty, cutw, cuth, valid, large = cutBoxes(sizes, edge, shape, options['useBckg'])
+    status = np.where(large, 'rescaled', np.where((cutw < edge) | (cuth < edge), 'padded', '')).astype('<U8')
+    keys, valid = cellKeys(options, cropCache, names, frame, cells, sizes, edge, shape)
+    cut = []
+    for i, cell in enumerate(cells):
+        # cells outside image are cut by process, their status is not known here
+        if not valid[i] or cropCache.fetch(keys[i], writer.outputName(cell[0], countsubimage, subimage)) is None:
+            cut.append(i)
+    return np.array(cut, dtype=np.int64), status, keys
+
+
+def cellKeys(options, cropCache, names, frame, cells, sizes, edge, shape):
+    """Return (keys, valid) - crop cache keys of cells of one frame and whether they are inside image."""
+    valid = cutBoxes(sizes, edge, shape, options['useBckg'])[4]
+    # everything pixels of cell depend on, except its bounding box and QCONF (outline for masks)
+    stamps = [cropCache.stamp(name) if isinstance(name, str) else cropCache.stamp(name[0]) + [name[1]]
+              for name in names]
+    params = [stamps, frame, float(edge), options['useBckg'],
+              options['resizeMode'], options['mask']]
+    keys = [cropCache.key(params, [int(v) for v in size], cropCache.stamp(cell[1]) if options['mask'] else None)
+            for cell, size in zip(cells, sizes)]
+    return keys, valid
+
+
+def processStack(options, image, sources, cells, edges, writers, manifestFile=None, metrics=None, cache=None,
+                 cropCache=None):
+    """
+    Cut and save all cells from one image stack in all sizes.
+
+    Args:
+        options - dictionary returned by parseProgramArgs
+        image - name of image from QCONF in its subfolder of input folder (see CellTable.images), used to resolve
+                names of all subimages
+        sources - stacks of subimages checked by folderindex.FolderIndex.validate ('images' of plan), file names or
+                  (file name, channel) with lsm option, see stackreader.openStack
+        cells - list of (count, qconf, bounds, centroid, frame, outline, handler) tuples, count is global cell number
+                used in output name, outline is needed only for masks. With tubelets option all cells of snake handler
+                must be in one call, they are saved together when all frames are cut
+        edges - list of sizes of output images, each frame is read once and cut for every size
+        writers - one of cellwriter writers for each size
+        manifestFile - manifest to record saved frames in, None if not recorded
+        metrics - metrics.Metrics to record times of stages in, None if not needed
+        cache - stackcache.FrameCache or FramePrefetcher to read frames from, if None stacks are opened only for this
+                call
+        cropCache - cropcache.CropCache to copy cells saved in earlier runs from, frames of cached cells are not read,
+                    None if not used
+
+    Returns:
+        list of {'padded':, 'rescaled'} counters for this stack, one for each size
+
+    """
+    counters = [{'rescaled': 0, 'padded': 0} for _ in edges]  # number of rescaled and padded frames
+    ownCache = cache is None
+    if ownCache:
+        cache = FrameCache(0)
+    # check is there are more images to process for one QCONF (user conf)
+    # assumes images in the same folder as QCONF regardless path in QCONF
+    # stacks are ordered [slices x y], frames are read when needed
+    subimages = subimageNames(options, image)
+    frameShape = None  # known from header, cells can be taken from crop cache only then
+    if cropCache:
+        header = readHeader(sources[0])
+        frameShape = header[1] if header else None
+    stored = []  # (key, file name) of cut cells, added to crop cache when they are written
+    tubelets = {} if options['tubelets'] else None  # {(size, tail, subimage, qconf, handler): [(frame, count, cell)]}
+    # cells from the same frame are cut together
+    frameCells = {}
+    for cell in cells:
+        frameCells.setdefault(cell[4], []).append(cell)
+    for frame, fcells in frameCells.items():
+        sizes = [(cell[2]['x'], cell[2]['y'], cell[2]['width'], cell[2]['height']) for cell in fcells]
+        masks = [None] * len(edges)
+        status = [None] * len(edges)
+        # process all images (or only original if processTails was empty)
+        for countsubimage, subimage, names in stackLoads(options, subimages, sources):
+            planes = None  # read when first cell has to be cut
+            stacked = None  # [tails y x] frame for channels, built once for all cells and sizes
+            for e, edge in enumerate(edges):
+                cut = np.arange(len(fcells))
+                if frameShape:
+                    with timed(metrics, 'fetch', len(fcells)):
+                        cut, status[e], keys = fetchCells(options, cropCache, writers[e], names, frame, fcells, sizes,
+                                                          edge, frameShape, countsubimage, subimage)
+                    cached = np.ones(len(fcells), dtype=bool)
+                    cached[cut] = False
+                    counters[e]['rescaled'] += int(np.count_nonzero(status[e][cached] == 'rescaled'))
+                    counters[e]['padded'] += int(np.count_nonzero(status[e][cached] == 'padded'))
+                if len(cut) and planes is None:
+                    start = time.perf_counter()
+                    planes = [cache.get(name, frame - 1) for name in names]
+                    if metrics:
+                        metrics.add('load', time.perf_counter() - start, len(planes), sum(p.nbytes for p in planes))
+                    logger.debug("Processing %s %s frame %d cells %d", path.basename(subimage), planes[0].shape,
+                                 frame, len(fcells))
+                    if options['channels'] and any(p.shape != planes[0].shape or p.dtype != planes[0].dtype
+                                                   for p in planes):
+                        raise ValueError("Frames of " + ", ".join(subimages) + " differ in size or type")
+                    if options['channels']:
+                        stacked = np.stack(planes)
+                if options['mask'] and masks[e] is None:  # rasterized from outlines once for all tails
+                    with timed(metrics, 'mask', len(fcells)):
+                        masks[e] = cellMasks([cell[5] for cell in fcells], sizes, edge,
+                                             frameShape or planes[0].shape, options['useBckg'])
+                if len(cut) == 0:  # all cells were in crop cache
+                    continue
+                cutSizes = [sizes[i] for i in cut]
+                # main image processing - cutting and scalling cels
+                if options['channels']:
+                    cutCells, cutStatus = processChannels(stacked, cutSizes, counters[e], edge,
+                                                          options['useBckg'], resizeMode=options['resizeMode'],
+                                                          metrics=metrics)
+                else:
+                    cutCells, cutStatus = processBatch(planes[0], cutSizes, counters[e], edge, options['useBckg'],
+                                                       resizeMode=options['resizeMode'], metrics=metrics)
+                if frameShape:
+                    status[e][cut] = cutStatus
+                else:
+                    status[e] = cutStatus
+                if options['mask'] == 'zero':
+                    cutCells = cutCells * (masks[e][cut, None] if options['channels'] else masks[e][cut])
+                elif options['mask'] == 'channel' and options['channels']:
+                    cutCells = np.concatenate([cutCells, maskImages(masks[e][cut, None], cutCells.dtype)], axis=1)
+                cutFcells = [fcells[i] for i in cut]
+                if tubelets is not None:
+                    collectTubelets(tubelets, e, cutFcells, countsubimage, subimage, cutCells)
+                else:
+                    writeCells(writers[e], cutFcells, countsubimage, subimage, frame, cutCells, cutStatus,
+                               options['inputFolder'], metrics)
+                if frameShape:
+                    stored.extend((keys[i], writers[e].outputName(fcells[i][0], countsubimage, subimage))
+                                  for i in cut)
+        if options['mask'] == 'channel' and not options['channels']:  # mask is saved as one more tail
+            root, ext = path.splitext(subimages[0])
+            for e, writer in enumerate(writers):
+                if tubelets is not None:
+                    collectTubelets(tubelets, e, fcells, len(subimages), root + maskTail + ext,
+                                    maskImages(masks[e], np.uint8))
+                else:
+                    writeCells(writer, fcells, len(subimages), root + maskTail + ext, frame,
+                               maskImages(masks[e], np.uint8), status[e], options['inputFolder'], metrics)
+    if tubelets:
+        writeTubelets(writers, tubelets, options['inputFolder'], metrics)
+    with timed(metrics, 'write', 0):
+        for writer in writers:
+            writer.flush()
+    if manifestFile:  # frames are done when their cells (whole tubelets) are on disk, not only queued for writing
+        for qconf, frame in sorted(set((cell[1], cell[4]) for cell in cells)):
+            frameDone(manifestFile, qconf, frame)
+    with timed(metrics, 'store', len(stored)):
+        for key, fileName in stored:
+            cropCache.store(key, fileName)
+    if ownCache:
+        cache.close()
+    return counters
+
+
+def sizeFolders(options, edges):
+    """Return output folder for each size, subfolders named by size if there are more sizes."""
+    if len(edges) == 1:
+        return [options['outputFolder']]
+    return [path.join(options['outputFolder'], '{:g}'.format(edge)) for edge in edges]
+
+
+def createWriters(options, edges, numCells):
+    """Return writer selected in options for each size, saving in threads if requested."""
+    sizeWriters = []
+    for folder, edge in zip(sizeFolders(options, edges), edges):
+        os.makedirs(folder, exist_ok=True)
+        writer = writers[options['writer']](folder, options['randomizeFileNames'], writerTails(options), numCells,
+                                            edge)
+        if options['writerThreads'] and writer.parallel:  # cells are saved while next ones are cut
+            writer = AsyncWriter(writer, options['writerThreads'])
+        sizeWriters.append(writer)
+    return sizeWriters
 
-    see: preparedata.py -h
 
+def openCropCache(options):
+    """Return crop cache selected in options, None if not used."""
+    if not options['cropCacheFolder']:
+        return None
+    return CropCache(options['cropCacheFolder'], options['cropCacheBudget'], options['linkCached'])
+
+
+workerCache = None  # frame cache of worker process, kept between jobs
+workerCropCache = None  # crop cache of worker process, kept between jobs
+
+
+def processStackJob(options, image, sources, cells, edges, numCells, manifestFile):
+    """
+    Run processStack in worker process.
+
+    Writers that can not be shared between processes are replaced by BufferWriters that are sent back with counters
+    and metrics.
+    """
+    if writers[options['writer']].parallel:
+        sizeWriters = createWriters(options, edges, numCells)
+    else:
+        sizeWriters = [BufferWriter() for _ in edges]
+    global workerCache, workerCropCache
+    if options['cacheBudget'] and workerCache is None:
+        workerCache = FrameCache(options['cacheBudget'])
+    if workerCropCache is None:
+        workerCropCache = openCropCache(options)
+    metrics = Metrics() if options['profile'] or options['metricsFile'] else None
+    counters = processStack(options, image, sources, cells, edges, sizeWriters, manifestFile, metrics, workerCache,
+                            workerCropCache)
+    for writer in sizeWriters:
+        writer.close()
+    buffers = [writer for writer in sizeWriters if isinstance(writer, BufferWriter)]
+    return counters, buffers, metrics
+
+
+def printSummary(counters, numProcessed, processTails, edge, channels=False):
+    """Print numbers of rescaled and padded cells, counters count each tail of cell unless channels are cut together."""
+    processedTails = 1 if channels or len(processTails) == 0 else len(processTails)
+    print(repr(int(counters['rescaled'] / processedTails)) + '/' + repr(numProcessed) + " were rescaled, " +
+          repr(int(counters['padded'] / processedTails)) + '/' + repr(numProcessed) + " were padded")
+    print("Selected image size: ", edge)
+    print("Subimages processed: ", processTails)
+
+
+def watch(options, metrics=None, passes=None):
+    """
+    Process sets of QCONF and images that appear or change in input folder, until interrupted.
+
+    Folder is polled every options['watch'] seconds, see folderwatch.FolderWatcher. Ready sets are processed by
+    processQconfs in batches of at most options['watchQueue'] QCONFs, each batch resumes manifest of previous ones, so
+    cells keep their numbers and are not cut again.
+
+    Args:
+        options - dictionary returned by parseProgramArgs
+        metrics - metrics.Metrics to record times of stages in, None if not needed
+        passes - number of polls, None to run forever
+
+    """
+    if options['streamQconf']:
+        Qconf = functools.partial(StreamQconf, outlines=False)
+    else:
+        Qconf = ScanQconf
+    watcher = FolderWatcher(options['inputFolder'], options['processTails'], options['recursive'], options['channels'],
+                            options['lsm'], Qconf)
+    logger.info("Watching %s every %g s", options['inputFolder'], options['watch'])
+    poll = 0
+    while passes is None or poll < passes:
+        if poll:
+            time.sleep(options['watch'])
+        poll += 1
+        with timed(metrics, 'scan'):
+            folderIndex, ready, problems = watcher.poll()
+        for problem in problems:  # reported once, set is checked again when it changes
+            print(problem)
+        for start in range(0, len(ready), options['watchQueue']):
+            batch = ready[start:start + options['watchQueue']]
+            logger.info("Processing %d new or changed QCONFs", len(batch))
+            processQconfs(options, folderIndex, batch, metrics)
+
+
+def processQconfs(options, folderIndex, fileList, metrics=None):
     """
-    inputFolder, outputFolder, showPlot, processTails, outSize, useBckg, randomizeFileNames = parseProgramArgs(argv)
+    Parse QCONFs, check their images and save their cells.
 
-    allBounds = []  # will store bounds dictionary
-    allCentroids = []  # centroids in order of bounds
-    allImages = []  # paths to images
-    allFrameId = []  # frame indexes
+    Args:
+        options - dictionary returned by parseProgramArgs
+        folderIndex - folderindex.FolderIndex of input folder
+        fileList - QCONFs to process, cells are numbered in this order
+        metrics - metrics.Metrics to record times of stages in, None if not needed
 
-    # folder to scan
-    fileList = scanFolder(inputFolder)
+    Returns:
+        False if images of some QCONFs have problems and nothing was processed, True otherwise
 
-    # iterate over QCONF files and extract information. Produce lists of the same lengths that contain data on related
-    # indexes. Some data are simply repeated along one QCONF
+    """
+    processTails = options['processTails']
+    qconfSizes = []  # (QCONF, number of cells)
+    table = CellTable()  # all cells, in order of QCONFs
+
+    stats = loadStats(options['statsFile']) if options['statsFile'] else None
+    if options['shard']:
+        fileList = selectShard(fileList, options['shard'])
+        logger.info("Shard %d of %d: %d files", options['shard'][0], options['shard'][1], len(fileList))
+
+    # iterate over QCONF files and extract information, one row of table per cell
+    if options['streamQconf']:
+        Qconf = functools.partial(StreamQconf, outlines=bool(options['mask']))
+    else:
+        Qconf = ScanQconf
+    index = QconfIndex(options['indexFile']) if options['indexFile'] else None
+    qconfImages = []  # (QCONF, image, number of frames) to check
     for qconf in fileList:
-        sq = ScanQconf(qconf)  # analyse qconf
-        sq.getFileInfo()  # print info
-        b, c, n, f = sq.getAll()  # outputs are dicts and lists
-        allBounds.extend(b)  # collect bounds for this file (all snakes)
-        allCentroids.extend(c)  # colect centroids
-        # colect image name from Qconf (repeated for each QCONF)
-        allImages.extend(n)
-        allFrameId.extend(f)  # frame range 1...N
-
-    # convert bounds to array [x y width height]
-    bounds = []
-    for b in allBounds:
-        bounds.append([b["x"], b["y"], b["width"], b["height"]])  # unwrap dict
-    bounds = np.array(bounds)  # convert to numpy
+        start = time.perf_counter()
+        if index:
+            b, c, n, f = index.getAll(qconf, Qconf, bool(options['mask']))  # parses only new or changed QCONFs
+            numFrames = index.getNumFrames(qconf)
+            handlers = index.getHandlers(qconf)
+            outlines = index.getOutlines(qconf) if options['mask'] else None
+        else:
+            sq = Qconf(qconf)  # analyse qconf
+            sq.getFileInfo()  # print info
+            b, c, n, f = sq.getAll()  # outputs are dicts and lists
+            numFrames = sq.getNumFrames()
+            handlers = sq.getHandlers()
+            outlines = sq.getOutlines() if options['mask'] else None
+        if metrics:
+            metrics.add('parse', time.perf_counter() - start, len(b), os.path.getsize(qconf))
+        qconfSizes.append((qconf, len(b)))
+        if b:
+            qconfImages.append((qconf, n[0], numFrames))
+        table.add(qconf, b, c, n, f, outlines, folderIndex.subfolder(qconf), handlers)
+    if index:
+        index.save()
+
+    # images of all QCONFs are checked before anything is cut, all problems are reported at once. Plot and stats need
+    # only QCONFs, their images are not opened unless check or plan is asked for
+    statsOnly = options['showPlot'] or options['saveStatsFile']
+    if not statsOnly or options['checkOnly'] or options['planFile']:
+        with timed(metrics, 'check', len(qconfImages)):
+            plan, problems = folderIndex.validate(qconfImages, processTails, options['channels'], options['lsm'])
+        for problem in problems:
+            print(problem)
+        if options['planFile']:
+            savePlan(options['planFile'], plan)
+        if problems:
+            print(len(problems), "problems found in", len(qconfImages) - len(plan), "QCONFs, nothing was processed")
+            return False
+        logger.info("Checked images of %d QCONFs", len(plan))
+        if options['checkOnly']:
+            return True
+    if options['tableFile']:
+        table.save(options['tableFile'])
+    allCells = table.cells
+    # distribution of widths and heights, of all QCONFs (not only of this shard) if stats are given
+    sizes = stats['histogram'] if stats else table.histogram()
 
     # %% compute basic stats - 1st 2nd and 3rd quartile
     # quartiles from width and height
-    med = np.percentile(bounds[:, (2, 3)], (25, 50, 75), axis=0)
-    pmed = pandas.DataFrame(med, columns=['Width', 'Height'], index=[
+    med = sizes.percentile((25, 50, 75))
+    pmed = pandas.DataFrame(med, columns=columns, index=[
                             '25', '50', '75'])  # convert to tables
-    pbounds = pandas.DataFrame(bounds[:, (2, 3)], columns=['Width', 'Height'])
 
     # %% Compute range of data
-    ranges = pandas.DataFrame(pbounds.min(), columns=['min'])
-    ranges['max'] = pandas.DataFrame(pbounds.max(), columns=['max'])
-    ranges = ranges.T  # transpose to have same orientation as med
-    if showPlot:
-        pbounds.plot.box()
+    ranges = pandas.DataFrame([sizes.min(), sizes.max()], columns=columns, index=['min', 'max'])
+    if options['showPlot']:
+        plt.figure().gca().bxp(sizes.boxStats())
         print(pmed)
         print(ranges)
         plt.show()
@@ -132,54 +814,300 @@ def main(argv):
     # %% Process images
     recWidth = pmed['Width']['75']  # use 75% quartile size
     recHeight = pmed['Height']['75']
-    if not outSize:
+    outSize = options['outSize']
+    if not outSize and stats:
+        edges = [stats['edge']]
+    elif not outSize:
         # length of edge of all images (square) - larger one among selected quartile for width and height
-        edge = np.round(np.max([recWidth, recHeight]))
+        edges = [np.round(np.max([recWidth, recHeight]))]
     else:
-        print("Use provided size", outSize)
-        edge = int(outSize)
-    print("Selected image size: ", edge)
-    counters = {'rescaled': 0, 'padded': 0}  # number of rescaled and padded frames
-    prevProcessed = None  # skip loading same stack many times
-    # iterate over collected frames, boundaries, cells
-    for count, image in enumerate(allImages):
-        # compute indexes of bounding box from QCONF data
-        frame = allFrameId[count]
-        # check is there are more images to process for one QCONF (user conf)
-        subimages = resolveNames(path.basename(image), processTails)  # use qconf image to get base name
-        # load stacks only once (image from all Images is repeated fro each frame)
-        if path.basename(image) != prevProcessed:  # load only if new image appears
-            print("Load next stacks")
-            prevProcessed = path.basename(image)
-            # assumes images in the same folder as QCONF regardless path in QCONF
-            im = []  # all images within one qconf will be loaded
-            for subimage in subimages:
-                absImagePath = path.join(inputFolder, subimage)
-                im.append(io.imread(absImagePath))  # im is ordered [slices x y]
-        # process all images (or only original if processTails was empty)
-        for countsubimage, subimage in enumerate(subimages):
-            print("Processing", path.basename(subimage),
-                  im[countsubimage].shape, "frame", frame,  sep=' ', end='', flush=True)
-            # main image processing - cutting and scalling cels
-            cutCell = process(im[countsubimage][frame - 1],
-                              (allBounds[count]['x'],
-                               allBounds[count]['y'],
-                               allBounds[count]['width'],
-                               allBounds[count]['height']),
-                              counters,
-                              edge,
-                              useBckg)
-            if randomizeFileNames is True:
-                outFileName = path.join(outputFolder, str(count) + "_" + str(countsubimage) + ".png")
-            else:
-                outFileName = path.join(outputFolder, path.basename(subimage) + "_" + str(count) + ".png")
-            io.imsave(outFileName, cutCell)
-            print("")
-    processedTails = 1 if len(processTails) == 0 else len(processTails)
-    print(repr(int(counters['rescaled'] / processedTails)) + '/' + repr(count + 1) + " were rescaled, " +
-          repr(int(counters['padded'] / processedTails)) + '/' + repr(count + 1) + " were padded")
-    print("Selected image size: ", edge)
-    print("Subimages processed: ", processTails)
+        logger.info("Use provided size %s", ','.join(str(size) for size in outSize))
+        edges = list(outSize)
+    for edge in edges:
+        logger.info("Selected image size: %s", edge)
+    if options['saveStatsFile']:
+        saveStats(options['saveStatsFile'], edges[0], sizes, qconfSizes, options['inputFolder'])
+        logger.info("Stats of %d cells saved to %s", len(table), options['saveStatsFile'])
+        return True
+    counters = [{'rescaled': 0, 'padded': 0} for _ in edges]  # number of rescaled and padded frames of each size
+    # global numbers of cells used in output names, consecutive for cells of one QCONF
+    manifest = None
+    manifestFile = None
+    if writers[options['writer']].parallel:  # cells in separate files can be skipped
+        manifestFile = path.join(options['outputFolder'],
+                                 shardFileName(manifestName, options['shard']) if options['shard'] else manifestName)
+        params = {'edge': float(edges[0]) if len(edges) == 1 else [float(edge) for edge in edges],
+                  'useBckg': options['useBckg'], 'processTails': processTails,
+                  'randomizeFileNames': options['randomizeFileNames'], 'resizeMode': options['resizeMode']}
+        if options['mask']:
+            params['mask'] = options['mask']
+        if options['tubelets']:
+            params['tubelets'] = True
+        if options['writer'] != 'png':  # png runs keep parameters of older manifests
+            params.update(writer=options['writer'], channels=options['channels'])
+        manifest = Manifest(manifestFile, params, options['resume'])
+        firsts = manifest.allocate(qconfSizes, {qconf: entry['images'] for qconf, entry in plan.items()})
+    else:
+        firsts = {}
+        first = 0
+        for qconf, size in qconfSizes:
+            firsts[qconf] = first
+            first += size
+    numbered = stats and options['watch'] is None  # in watch mode new QCONFs are numbered by manifest
+    if numbered:  # numbers of cells are the same in all shards
+        try:
+            firsts = statsFirsts(stats, qconfSizes, options['inputFolder'])
+        except ValueError as err:
+            print(err)
+            return False
+    # cells of QCONF get consecutive numbers from its first one, rows of one QCONF follow each other in table
+    position = np.arange(len(allCells)) - np.searchsorted(allCells['qconf'], allCells['qconf'])
+    qconfFirsts = np.array([firsts[qconf] for qconf in table.qconfs], dtype=np.int64)
+    allCells['count'] = qconfFirsts[allCells['qconf']] + position
+    numCells = stats['cells'] if numbered else max([firsts[qconf] + size for qconf, size in qconfSizes], default=0)
+    # cells saved in previous runs are skipped
+    todo = np.arange(len(allCells))
+    if manifest:
+        done = np.array([manifest.isDone(table.qconfs[q], f) for q, f in zip(allCells['qconf'], allCells['frame'])],
+                        dtype=bool)
+        if options['tubelets']:  # tubelet is saved again whole if any of its frames is missing
+            tracks = allCells['qconf'].astype(np.int64) * (np.iinfo(np.int32).max + 1) + allCells['handler']
+            done = ~np.isin(tracks, tracks[~done])
+        todo = todo[~done]
+    if len(todo) < len(allCells):
+        logger.info("Resuming, %d cells already saved", len(allCells) - len(todo))
+    if options['reorder']:  # all cells of one image in one job, frames in order
+        todo = table.sort(todo, ('image', 'frame'))
+    # one job per run of cells of the same image stack (all cells of QCONF or of image if reordered), cells keep their
+    # global numbers so output names do not depend on order of processing
+    jobs = []
+    # stacks are the ones checked in plan, QCONFs with the same image share them
+    for group in table.groups(todo, 'image'):
+        qconf = table.qconfs[allCells['qconf'][group[0]]]
+        jobs.append((table.images[allCells['image'][group[0]]], plan[qconf]['images'],
+                     [table.record(i) for i in group]))
+    countersFolders = sizeFolders(options, edges)
+    if options['shard'] and not writers[options['writer']].parallel:  # shards can not write to the same array
+        shardFolder = path.join(options['outputFolder'], shardFileName('shard', options['shard']))
+        options = dict(options, outputFolder=shardFolder)
+        os.makedirs(options['outputFolder'], exist_ok=True)
+    sizeWriters = createWriters(options, edges, numCells)
+    progress = Progress(len(todo))
+    cropCache = openCropCache(options)
+    if options['jobs'] == 1:
+        cache = FrameCache(options['cacheBudget']) if options['cacheBudget'] or options['prefetchDepth'] else None
+        if options['prefetchDepth']:  # next frames are read while these ones are cut
+            work = FramePrefetcher(jobs, lambda job: stackFrames(options, *job, edges, cropCache), cache,
+                                   options['prefetchDepth'])
+        else:
+            work = ((job, cache) for job in jobs)
+        for (image, sources, cells), frames in work:
+            stackCounters = processStack(options, image, sources, cells, edges, sizeWriters, manifestFile, metrics,
+                                         frames, cropCache)
+            for total, c in zip(counters, stackCounters):
+                mergeCounters(total, c)
+            progress.update(len(cells))
+        if options['prefetchDepth']:
+            work.close()
+        if cache:
+            cache.close()
+    else:
+        with ProcessPoolExecutor(max_workers=options['jobs']) as executor:
+            futures = {executor.submit(processStackJob, options, image, sources, cells, edges, numCells, manifestFile):
+                       len(cells) for image, sources, cells in jobs}
+            for future in as_completed(futures):
+                stackCounters, buffers, m = future.result()
+                for total, c in zip(counters, stackCounters):
+                    mergeCounters(total, c)
+                for writer, buffer in zip(sizeWriters, buffers):
+                    with timed(metrics, 'write', 0):
+                        buffer.replay(writer)
+                if m:
+                    metrics.merge(m)
+                progress.update(futures[future])
+    with timed(metrics, 'write', 0):
+        for writer in sizeWriters:
+            writer.close()
+    if cropCache and options['jobs'] == 1:
+        logger.info("Crop cache: %d cells copied, %d cut", cropCache.hits, cropCache.misses)
+    elif cropCache:  # read again with files stored by worker processes
+        openCropCache(options).trim()
+    for folder, edge, c in zip(countersFolders, edges, counters):
+        if options['tubelets']:
+            saveTubelets(path.join(folder, shardFileName(tubeletsName, options['shard']) if options['shard']
+                                   else tubeletsName), table, options['inputFolder'])
+        if options['shard']:
+            saveCounters(folder, options['shard'], c, len(todo), processTails, edge, options['channels'])
+        printSummary(c, len(todo), processTails, edge, options['channels'])
+    if options['profile']:
+        metrics.printReport()
+    if options['metricsFile']:
+        metrics.saveReport(options['metricsFile'])
+    return True
+
+
+def main(argv):
+    """
+    Run program.
+
+    see: preparedata.py -h
+
+    """
+    options = parseProgramArgs(argv)
+    logging.basicConfig(level=logging.DEBUG if options['verbose'] else logging.INFO, format='%(message)s')
+    metrics = Metrics() if options['profile'] or options['metricsFile'] else None
+    if options['mergeShards']:
+        try:
+            counters, numProcessed, tails, edge, channels = mergeShardCounters(options['outputFolder'])
+        except ValueError as err:
+            print(err)
+            sys.exit(1)
+        printSummary(counters, numProcessed, tails, edge, channels)
+        return
+    if options['watch'] is not None:
+        try:
+            watch(options, metrics)
+        except KeyboardInterrupt:
+            logger.info("Stopped")
+        return
+
+    # folder to scan, listed once and used to find images of all QCONFs
+    logger.info("Scanning %s", options['inputFolder'])
+    with timed(metrics, 'scan'):
+        folderIndex = FolderIndex(options['inputFolder'], options['recursive'])
+        fileList = folderIndex.qconfs()  # the same order, and cell numbers, in every run
+    logger.info("\tFound %d files", len(fileList))
+    if not processQconfs(options, folderIndex, fileList, metrics):
+        sys.exit(1)
+
+
+class PrepareDataTest(unittest.TestCase):
+    """Cells of generated data are saved by whole program, see synthetic.makeDataset."""
+
+    def setUp(self):
+        """Generate small dataset."""
+        self.dir = tempfile.TemporaryDirectory()
+        self.qconfs = makeDataset(self.dir.name, qconfs=2, cells=3, frames=5, imageSize=(64, 48))
+
+    def tearDown(self):
+        """Remove dataset."""
+        self.dir.cleanup()
+
+    def testPrepareData(self):
+        """Whole program saves all cells for all tails."""
+        out = os.path.join(self.dir.name, 'out')
+        os.mkdir(out)
+        main(['-i', self.dir.name, '-o', out, '-s', '32', '-t', '_CH_1,_CH_2'])
+        self.assertEqual(len([f for f in os.listdir(out) if f.endswith('.png')]), 60)
+
+    def testStatsWithoutImages(self):
+        """Stats phase needs only QCONFs, images are not checked."""
+        for name in os.listdir(self.dir.name):
+            if name.endswith('.tif'):
+                os.remove(os.path.join(self.dir.name, name))
+        statsFile = os.path.join(self.dir.name, 'stats.json')
+        main(['-i', self.dir.name, '-t', '_CH_1,_CH_2', '--save-stats=' + statsFile])
+        self.assertEqual(loadStats(statsFile)['cells'], 30)
+        with self.assertRaises(SystemExit):  # but they are checked before cells are cut
+            main(['-i', self.dir.name, '-o', self.dir.name, '-t', '_CH_1,_CH_2', '--stats=' + statsFile])
+
+    def testRecursiveTable(self):
+        """QCONFs of the same name in subfolders are told apart in cells table."""
+        for sub in ('a', 'b'):
+            makeDataset(os.path.join(self.dir.name, 'in', sub), qconfs=1, cells=2, frames=5, imageSize=(64, 48))
+        out = os.path.join(self.dir.name, 'out')
+        os.mkdir(out)
+        main(['-i', os.path.join(self.dir.name, 'in'), '-o', out, '-s', '16', '-t', '_CH_1,_CH_2', '--recursive',
+              '--writer=npy'])
+        with open(os.path.join(out, 'cells.csv')) as f:
+            qconfs = set(row['qconf'] for row in csv.DictReader(f))
+        self.assertSetEqual(qconfs, {os.path.join(sub, 'synthetic0.lsm_CH_1.QCONF') for sub in ('a', 'b')})
+
+    def testFramesDone(self):
+        """Frames are recorded in manifest only after writer has saved their cells."""
+        manifestFile = os.path.join(self.dir.name, manifestName)
+        open(manifestFile, 'w').close()
+        test = self
+
+        class CheckingWriter:
+            """Check that nothing is recorded when cells are saved."""
+
+            def write(self, *args):
+                """Do not save."""
+                return 0
+
+            def flush(self):
+                """Cells are on disk after flush."""
+                with open(manifestFile) as f:
+                    test.assertEqual(f.read(), '')
+
+        sq = ScanQconf(self.qconfs[0])
+        b, c, n, f = sq.getAll()
+        cells = [(i, self.qconfs[0], bounds, centroid, frame, None, handler)
+                 for i, (bounds, centroid, frame, handler) in enumerate(zip(b, c, f, sq.getHandlers()))]
+        options = parseProgramArgs(['-i', self.dir.name, '-s', '32', '-t', '_CH_1,_CH_2'])
+        sources = FolderIndex(self.dir.name).resolve(self.qconfs[0], n[0], options['processTails'])
+        processStack(options, os.path.basename(n[0]), sources, cells, [32], [CheckingWriter()], manifestFile)
+        with open(manifestFile) as f:
+            self.assertEqual(len(f.readlines()), 5)
+
+    def testSizes(self):
+        """Cells of each size are saved to own folder."""
+        out = os.path.join(self.dir.name, 'out')
+        os.mkdir(out)
+        main(['-i', self.dir.name, '-o', out, '-s', '32,16', '-t', '_CH_1,_CH_2'])
+        for size in ('32', '16'):
+            self.assertEqual(len([f for f in os.listdir(os.path.join(out, size)) if f.endswith('.png')]), 60)
+
+    def testTubelets(self):
+        """Every tracked cell is one stack with frames from startFrame to endFrame of its handler."""
+        folder = os.path.join(self.dir.name, 'spans')
+        makeDataset(folder, qconfs=1, cells=4, frames=6, imageSize=(64, 48), spans=True, seed=1)
+        out = os.path.join(self.dir.name, 'out')
+        os.mkdir(out)
+        main(['-i', folder, '-o', out, '-s', '16', '--writer=tiff', '--tubelets'])
+        with open(os.path.join(folder, 'synthetic0.lsm_CH_1.QCONF')) as f:
+            sHs = json.load(f)['obj']['BOAState']['nest']['sHs']
+        with open(os.path.join(out, tubeletsName)) as f:
+            rows = list(csv.DictReader(f))
+        self.assertListEqual([(int(r['firstFrame']), int(r['lastFrame'])) for r in rows],
+                             [(h['startFrame'], h['endFrame']) for h in sHs])
+        for row in rows:
+            stack = tifffile.imread(os.path.join(out, 'synthetic0.lsm_CH_1.tif_' + row['index'] + '.tif'))
+            self.assertEqual(len(stack.reshape(-1, 16, 16)), int(row['lastFrame']) - int(row['firstFrame']) + 1)
+
+    def testWatch(self):
+        """QCONFs copied to watched folder one by one give the same cells as batch run."""
+        watched = os.path.join(self.dir.name, 'watched')
+        os.mkdir(watched)
+        out = os.path.join(self.dir.name, 'out')
+        batch = os.path.join(self.dir.name, 'batch')
+        os.mkdir(out)
+        os.mkdir(batch)
+        options = parseProgramArgs(['-i', watched, '-o', out, '-s', '32', '-t', '_CH_1,_CH_2', '--watch=0'])
+        for q in range(2):
+            for name in os.listdir(self.dir.name):
+                if name.startswith('synthetic' + str(q)):
+                    shutil.copy(os.path.join(self.dir.name, name), watched)
+            watch(options, passes=2)  # the second poll finds set unchanged
+        main(['-i', self.dir.name, '-o', batch, '-s', '32', '-t', '_CH_1,_CH_2'])
+        self.assertListEqual(sorted(f for f in os.listdir(out) if f.endswith('.png')),
+                             sorted(f for f in os.listdir(batch) if f.endswith('.png')))
+
+    def testWatchImage(self):
+        """Cells are cut again when only image of QCONF is replaced in watched folder."""
+        out = os.path.join(self.dir.name, 'out')
+        os.mkdir(out)
+        options = parseProgramArgs(['-i', self.dir.name, '-o', out, '-s', '32', '-t', '_CH_1,_CH_2', '--watch=0'])
+        watch(options, passes=2)
+        cell = os.path.join(out, 'synthetic0.lsm_CH_2.tif_0.png')
+        self.assertGreater(io.imread(cell).max(), 0)
+        image = os.path.join(self.dir.name, 'synthetic0.lsm_CH_2.tif')
+        with tifffile.TiffFile(image) as tif:
+            stack = tif.asarray()
+        tifffile.imwrite(image, np.zeros_like(stack))
+        watch(options, passes=2)
+        self.assertEqual(io.imread(cell).max(), 0)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,127 @@
+"""
+Measure throughput of main stages on synthetic data.
+
+Times QCONF parsing, cutting, padding and rescaling of cells and whole PrepareData run. Results are printed and can be
+saved to JSON file to compare runs.
+
+Usage:
+    python benchmark.py [-q qconfs] [-c cells] [-f frames] [-x size] [-r repeats] [-o results.json]
+"""
+
+import contextlib
+import getopt
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import numpy
+import PrepareData
+from imagefitting import cut, pad, rescale, process, processBatch, def_pad_value
+from scanqconf import ScanQconf, StreamQconf, ijson
+from stackreader import LazyStack
+from synthetic import makeDataset
+
+
+def measure(name, fun, items, repeat):
+    """
+    Run fun repeat times.
+
+    Returns:
+        dictionary with name, number of processed items, best and median time and items per second for best time
+
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fun()
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    return {'name': name, 'items': items, 'best': best, 'median': float(numpy.median(times)),
+            'throughput': items / best if best > 0 else float('inf')}
+
+
+def benchScan(qconfs, repeat):
+    """Parse all QCONFs."""
+    cells = sum(len(ScanQconf(q).getBounds()) for q in qconfs)
+    results = [measure('ScanQconf.getAll', lambda: [ScanQconf(q).getAll() for q in qconfs], cells, repeat)]
+    if ijson is not None:
+        results.append(measure('StreamQconf.getAll', lambda: [StreamQconf(q).getAll() for q in qconfs], cells, repeat))
+    return results
+
+
+def benchFitting(folder, qconf, edge, repeat):
+    """Cut, pad and rescale all cells of one QCONF."""
+    b, c, n, f = ScanQconf(qconf).getAll()
+    with LazyStack(os.path.join(folder, os.path.basename(n[0]))) as stack:
+        frames = numpy.array([stack[i] for i in range(len(stack))])  # in memory, reading is not measured here
+    sizes = [(s['x'], s['y'], s['width'], s['height']) for s in b]
+    index = [frame - 1 for frame in f]
+    cuts = [cut(frames[i], s, None) for i, s in zip(index, sizes)]
+    small = [c for c in cuts if all(d <= edge for d in c.shape)]
+    large = [c for c in cuts if any(d > edge for d in c.shape)]
+    return [measure('cut', lambda: [cut(frames[i], s, None) for i, s in zip(index, sizes)], len(sizes),
+                    repeat),
+            measure('pad', lambda: [pad(c, edge, 'constant', constant_values=def_pad_value) for c in small],
+                    len(small), repeat),
+            measure('rescale', lambda: [rescale(c, edge) for c in large], len(large), repeat),
+            measure('process', lambda: [process(frames[i], s, None, edge) for i, s in zip(index, sizes)],
+                    len(sizes), repeat),
+            measure('processBatch', lambda: processBatch(frames, sizes, None, edge, frames=index), len(sizes),
+                    repeat)]
+
+
+def benchPrepareData(folder, cells, repeat, args=()):
+    """Run whole program, output is written to temporary folder."""
+    def run():
+        with tempfile.TemporaryDirectory() as out, contextlib.redirect_stdout(io.StringIO()):
+            PrepareData.main(['-i', folder, '-o', out] + list(args))
+    return [measure('PrepareData ' + ' '.join(args), run, cells, repeat)]
+
+
+def main(argv):
+    """Generate data and run benchmarks, see module description."""
+    kwargs = {'qconfs': 4, 'cells': 20, 'frames': 20, 'imageSize': (512, 512)}
+    repeat = 3
+    outFile = None
+    edge = 48
+    try:
+        opts, args = getopt.getopt(argv, "hq:c:f:x:r:o:")
+    except getopt.GetoptError as err:
+        print(__doc__)
+        print(err)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print(__doc__)
+            sys.exit()
+        elif opt == '-q':
+            kwargs['qconfs'] = int(arg)
+        elif opt == '-c':
+            kwargs['cells'] = int(arg)
+        elif opt == '-f':
+            kwargs['frames'] = int(arg)
+        elif opt == '-x':
+            kwargs['imageSize'] = (int(arg), int(arg))
+        elif opt == '-r':
+            repeat = int(arg)
+        elif opt == '-o':
+            outFile = arg
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        qconfs = makeDataset(folder, **kwargs)
+        cells = kwargs['qconfs'] * kwargs['cells'] * kwargs['frames']
+        results.extend(benchScan(qconfs, repeat))
+        results.extend(benchFitting(folder, qconfs[0], edge, repeat))
+        results.extend(benchPrepareData(folder, cells * 2, repeat, ['-s', str(edge), '-t', '_CH_1,_CH_2']))
+    print("{:<45}{:>10}{:>12}{:>12}{:>14}".format('stage', 'items', 'best [s]', 'median [s]', 'items/s'))
+    for r in results:
+        print("{name:<45}{items:>10}{best:>12.4f}{median:>12.4f}{throughput:>14.1f}".format(**r))
+    if outFile:
+        with open(outFile, 'w') as f:
+            json.dump({'parameters': kwargs, 'edge': edge, 'repeat': repeat, 'results': results}, f, indent=1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,159 @@
+"""
+Stream cut cells to Python code without saving them.
+
+Cells of all QCONFs in folder are cut in the same way as by PrepareData and returned in batches together with their
+metadata, e.g. to feed training loop directly. Next frames are read by other thread while current ones are cut, so at
+most prefetchDepth frames, frames of all tails being cut and one batch are kept in memory.
+
+Example:
+    for cells, meta in streamCells('data', edge=48, tails=('_CH_1', '_CH_2'), batchSize=128):
+        train(cells, meta)
+"""
+
+import os
+import tempfile
+import unittest
+import numpy
+from getQconfs import scanFolder
+from imagefitting import processBatch, processChannels
+from nameresolver import resolveNames
+from scanqconf import ScanQconf
+from sizestats import SizeHistogram
+from stackcache import FrameCache, FramePrefetcher
+
+
+def readCells(folder, Qconf=ScanQconf):
+    """
+    Read cells of all QCONFs in folder.
+
+    Args:
+        folder - folder with QCONFs and their images
+        Qconf - class used to parse QCONFs, ScanQconf or StreamQconf
+
+    Returns:
+        (jobs, sizes) - jobs is list of (image, cells) for each QCONF, where cells is list of
+        (count, qconf, bounds, centroid, frame) and count is number of cell in folder, the same as used by PrepareData.
+        sizes is SizeHistogram of all cells
+
+    """
+    jobs = []
+    sizes = SizeHistogram()
+    count = 0
+    for qconf in scanFolder(folder):
+        b, c, n, f = Qconf(qconf).getAll()
+        sizes.add(b)
+        if b:
+            jobs.append((n[0], [(count + i, qconf, bounds, centroid, frame)
+                                for i, (bounds, centroid, frame) in enumerate(zip(b, c, f))]))
+        count += len(b)
+    return jobs, sizes
+
+
+def defaultEdge(sizes):
+    """Return size used by PrepareData if not given, larger of 75th percentiles of widths and heights."""
+    return int(numpy.round(numpy.max(sizes.percentile((75,)))))
+
+
+def streamCells(folder, edge=None, tails=(), batchSize=256, trueBackground=False, resizeMode='bilinear',
+                channels=False, prefetchDepth=8, Qconf=ScanQconf):
+    """
+    Yield batches of cut cells.
+
+    Args:
+        folder - folder with QCONFs and their images
+        edge - size of cells, if None it is selected as in PrepareData
+        tails - process all images of QCONF that end with these tails, see nameresolver
+        batchSize - number of cells in batch, the last one can be smaller
+        trueBackground - see imagefitting.processBatch
+        resizeMode - see imagefitting.resize
+        channels - if True all tails of cell are in one [tails edge edge] cell, otherwise each tail gives own cell
+        prefetchDepth - number of frames read in advance, at least 1, ValueError is raised otherwise
+        Qconf - class used to parse QCONFs
+
+    Yields:
+        (cells, meta) - cells is [batch edge edge] or [batch tails edge edge] array, meta is list of dictionaries with
+        columns of cellwriter.tableColumns for each cell
+
+    """
+    if prefetchDepth < 1:  # checked before QCONFs are parsed
+        raise ValueError("At least one frame must be read ahead, prefetchDepth is {}".format(prefetchDepth))
+    jobs, sizes = readCells(folder, Qconf)
+    if edge is None:
+        edge = defaultEdge(sizes)
+
+    def stackNames(image):
+        return [os.path.join(folder, subimage) for subimage in resolveNames(os.path.basename(image), tails)]
+
+    def frames(job):
+        image, cells = job
+        return [(name, frame - 1) for frame in dict.fromkeys(cell[4] for cell in cells) for name in stackNames(image)]
+
+    batch = []
+    meta = []
+    cache = FrameCache(0)
+    prefetcher = FramePrefetcher(jobs, frames, cache, prefetchDepth)
+    try:
+        for (image, cells), loaded in prefetcher:
+            names = stackNames(image)
+            frameCells = {}
+            for cell in cells:
+                frameCells.setdefault(cell[4], []).append(cell)
+            for frame, fcells in frameCells.items():
+                boxes = [(b['x'], b['y'], b['width'], b['height']) for _, _, b, _, _ in fcells]
+                planes = [loaded.get(name, frame - 1) for name in names]
+                if channels:
+                    cut = [(0, processChannels(numpy.stack(planes), boxes, None, edge, trueBackground, resizeMode))]
+                else:
+                    cut = [(t, processBatch(plane, boxes, None, edge, trueBackground, resizeMode=resizeMode))
+                           for t, plane in enumerate(planes)]
+                for t, (cutCells, status) in cut:
+                    batch.append(cutCells)
+                    for (count, qconf, b, c, _), st in zip(fcells, status):
+                        meta.append({'index': count, 'tail': tails[t] if tails and not channels else '',
+                                     'qconf': os.path.relpath(qconf, folder), 'image': os.path.basename(names[t]),
+                                     'frame': frame, 'x': b['x'], 'y': b['y'], 'width': b['width'],
+                                     'height': b['height'], 'centroidx': c['x'], 'centroidy': c['y'], 'status': st})
+                while len(meta) >= batchSize:
+                    stacked = numpy.concatenate(batch)
+                    yield stacked[:batchSize], meta[:batchSize]
+                    batch = [stacked[batchSize:]]
+                    meta = meta[batchSize:]
+    finally:  # also if caller stops iterating
+        prefetcher.close()
+        cache.close()
+    if meta:
+        yield numpy.concatenate(batch), meta
+
+
+class CellStreamTest(unittest.TestCase):
+    """Test of streaming synthetic data."""
+
+    def setUp(self):
+        """Create data."""
+        from synthetic import makeDataset
+        self.dir = tempfile.TemporaryDirectory()
+        makeDataset(self.dir.name, qconfs=2, cells=3, frames=5, imageSize=(64, 64), cellSize=(8, 20))
+
+    def tearDown(self):
+        """Remove data."""
+        self.dir.cleanup()
+
+    def testBatches(self):
+        """All cells of all tails are returned in full batches, channels match separate tails."""
+        batches = list(streamCells(self.dir.name, 16, ('_CH_1', '_CH_2'), batchSize=10))
+        self.assertListEqual([len(m) for _, m in batches], [10] * 6)
+        cells = numpy.concatenate([c for c, _ in batches])
+        meta = sum([m for _, m in batches], [])
+        self.assertTupleEqual(cells.shape, (60, 16, 16))
+        merged = list(streamCells(self.dir.name, 16, ('_CH_1', '_CH_2'), channels=True))
+        position = {m['index']: i for i, m in enumerate(sum([m for _, m in merged], []))}
+        merged = numpy.concatenate([c for c, _ in merged])
+        self.assertTupleEqual(merged.shape, (30, 2, 16, 16))
+        for cell, m in zip(cells, meta):
+            numpy.testing.assert_array_equal(merged[position[m['index']], 0 if m['tail'] == '_CH_1' else 1], cell)
+        with self.assertRaises(ValueError):
+            next(streamCells(self.dir.name, 16, ('_CH_1', '_CH_2'), prefetchDepth=0))
+
+
+if __name__ == '__main__':
+    unittest.main()
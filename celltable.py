@@ -0,0 +1,212 @@
+"""
+Keep data of all cells in one structured array.
+
+Each cell is one row with global number, integer ids of QCONF, image and snake handler, frame, bounding box and
+centroid. Names of QCONFs and images are stored once in separate lists. Outline nodes of snakes, if added, are kept in
+one [nodes 2] array, rows point to their part of it. Table can be sorted and grouped by any columns
+and saved to npz file.
+"""
+
+import os
+import tempfile
+import unittest
+import numpy
+from sizestats import SizeHistogram
+
+cellDtype = numpy.dtype([('count', numpy.int64),  # global number of cell, used in output names
+                         ('qconf', numpy.int32),  # index in CellTable.qconfs
+                         ('image', numpy.int32),  # index in CellTable.images
+                         ('handler', numpy.int32),  # snake handler within QCONF
+                         ('frame', numpy.int32),  # 1-based
+                         ('x', numpy.int32),
+                         ('y', numpy.int32),
+                         ('width', numpy.int32),
+                         ('height', numpy.int32),
+                         ('centroidx', numpy.float64),
+                         ('centroidy', numpy.float64),
+                         ('nodes', numpy.int64),  # first row of outline in CellTable.points
+                         ('numNodes', numpy.int32)])
+
+
+class CellTable:
+    """Cells of all QCONFs as structured array."""
+
+    def __init__(self):
+        """Create empty table."""
+        self.qconfs = []  # paths of QCONFs
+        self.images = []  # base names of images, with subfolder of input folder if not in it
+        self.imageIds = {}
+        self.parts = []  # arrays added since last access to cells
+        self._cells = numpy.empty(0, dtype=cellDtype)
+        self.pointParts = []
+        self._points = numpy.empty((0, 2))
+        self.numPoints = 0
+
+    def add(self, qconf, bounds, centroids, images, frames, outlines=None, folder='', handlers=None):
+        """
+        Add cells of one QCONF, arguments are as returned by ScanQconf.getAll, getOutlines and getHandlers.
+
+        Cells are numbered consecutively after already added ones. If handlers are not given, new snake handler starts
+        where frame does not increase. Images are named by their base names in folder, relative to input folder.
+        """
+        part = numpy.zeros(len(bounds), dtype=cellDtype)
+        if len(bounds):
+            part['count'] = len(self) + numpy.arange(len(bounds))
+            part['qconf'] = len(self.qconfs)
+            part['image'] = [self.imageId(image, folder) for image in images]
+            part['frame'] = frames
+            if handlers is not None:
+                part['handler'] = handlers
+            else:
+                part['handler'] = numpy.cumsum(numpy.diff(part['frame'], prepend=numpy.iinfo(numpy.int32).max) <= 0) - 1
+            for key in ('x', 'y', 'width', 'height'):
+                part[key] = [b[key] for b in bounds]
+            part['centroidx'] = [c['x'] for c in centroids]
+            part['centroidy'] = [c['y'] for c in centroids]
+        if outlines is not None and len(outlines):
+            part['numNodes'] = [len(outline) for outline in outlines]
+            part['nodes'] = self.numPoints + numpy.cumsum(part['numNodes']) - part['numNodes']
+            self.pointParts.extend(numpy.asarray(outline, dtype=numpy.float64).reshape(-1, 2) for outline in outlines)
+            self.numPoints += int(part['numNodes'].sum())
+        self.qconfs.append(qconf)
+        self.parts.append(part)
+
+    def imageId(self, image, folder=''):
+        """Return id of image in folder, new one if not seen before."""
+        name = os.path.join(folder, os.path.basename(image))
+        if name not in self.imageIds:
+            self.imageIds[name] = len(self.images)
+            self.images.append(name)
+        return self.imageIds[name]
+
+    @property
+    def cells(self):
+        """Return structured array of all cells."""
+        if self.parts:
+            self._cells = numpy.concatenate([self._cells] + self.parts)
+            self.parts = []
+        return self._cells
+
+    @property
+    def points(self):
+        """Return [nodes 2] array of outline nodes of all cells."""
+        if self.pointParts:
+            self._points = numpy.concatenate([self._points] + self.pointParts)
+            self.pointParts = []
+        return self._points
+
+    def outline(self, index):
+        """Return [nodes 2] array of outline of cell, None if outline was not added."""
+        row = self.cells[index]
+        if row['numNodes'] == 0:
+            return None
+        return self.points[row['nodes']:row['nodes'] + row['numNodes']]
+
+    def __len__(self):
+        """Return number of cells."""
+        return len(self._cells) + sum(len(part) for part in self.parts)
+
+    def sort(self, indexes=None, keys=('image', 'frame')):
+        """Return indexes (all cells if None) sorted by columns in keys, order of equal cells is kept."""
+        cells = self.cells
+        indexes = numpy.arange(len(cells)) if indexes is None else numpy.asarray(indexes, dtype=numpy.int64)
+        order = numpy.lexsort([cells[key][indexes] for key in reversed(keys)])  # lexsort is stable
+        return indexes[order]
+
+    def groups(self, indexes, key='image'):
+        """Split indexes into runs of consecutive cells with the same value of column key."""
+        indexes = numpy.asarray(indexes, dtype=numpy.int64)
+        if len(indexes) == 0:
+            return []
+        values = self.cells[key][indexes]
+        starts = numpy.flatnonzero(numpy.diff(values)) + 1
+        return numpy.split(indexes, starts)
+
+    def record(self, index):
+        """
+        Return cell as (count, qconf, bounds, centroid, frame, outline, handler) tuple used by PrepareData.processStack.
+        """
+        row = self.cells[index]
+        bounds = {key: int(row[key]) for key in ('x', 'y', 'width', 'height')}
+        return (int(row['count']), self.qconfs[row['qconf']], bounds,
+                {'x': float(row['centroidx']), 'y': float(row['centroidy'])}, int(row['frame']), self.outline(index),
+                int(row['handler']))
+
+    def histogram(self):
+        """Return SizeHistogram of widths and heights of all cells."""
+        sizes = SizeHistogram()
+        sizes.counts[0].update(self.cells['width'].tolist())
+        sizes.counts[1].update(self.cells['height'].tolist())
+        return sizes
+
+    def save(self, fileName):
+        """Save table to npz file."""
+        numpy.savez(fileName, cells=self.cells, qconfs=numpy.array(self.qconfs, dtype=str),
+                    images=numpy.array(self.images, dtype=str), points=self.points)
+
+    @classmethod
+    def load(cls, fileName):
+        """Load table saved by save."""
+        table = cls()
+        with numpy.load(fileName) as npz:
+            table._cells = npz['cells']
+            table.qconfs = npz['qconfs'].tolist()
+            table.images = npz['images'].tolist()
+            table._points = npz['points']
+        table.imageIds = {name: i for i, name in enumerate(table.images)}
+        table.numPoints = len(table._points)
+        return table
+
+
+class CellTableTest(unittest.TestCase):
+    """Test of adding, grouping and saving."""
+
+    def setUp(self):
+        """Fill table with two QCONFs of the same image."""
+        self.table = CellTable()
+        for q in range(2):
+            bounds = [{'x': q, 'y': f, 'width': 10 + f, 'height': 5} for f in range(6)]
+            centroids = [{'x': 0.5, 'y': 1.5 * f} for f in range(6)]
+            outlines = [numpy.full((3 + f, 2), q + f) for f in range(6)]
+            self.table.add('q{}.QCONF'.format(q), bounds, centroids, ['/a/im.tif'] * 6, [1, 2, 3, 1, 2, 3], outlines)
+
+    def testAdd(self):
+        """Handlers are found and records are the same as added data."""
+        cells = self.table.cells
+        self.assertEqual(len(self.table), 12)
+        self.assertListEqual(cells['handler'].tolist(), [0, 0, 0, 1, 1, 1] * 2)
+        self.assertListEqual(self.table.images, ['im.tif'])
+        record = self.table.record(7)
+        self.assertTupleEqual(record[:5], (7, 'q1.QCONF', {'x': 1, 'y': 1, 'width': 11, 'height': 5},
+                                           {'x': 0.5, 'y': 1.5}, 2))
+        numpy.testing.assert_array_equal(record[5], numpy.full((4, 2), 2))
+        self.assertEqual(self.table.histogram().percentile((50,))[0, 0], 12.5)
+        self.table.add('c/q.QCONF', [{'x': 0, 'y': 0, 'width': 1, 'height': 1}], [{'x': 0, 'y': 0}], ['/a/im.tif'], [1],
+                       folder='c')
+        self.assertListEqual(self.table.images, ['im.tif', os.path.join('c', 'im.tif')])
+        self.table.add('d.QCONF', [{'x': 0, 'y': 0, 'width': 1, 'height': 1}] * 3, [{'x': 0, 'y': 0}] * 3,
+                       ['/a/im.tif'] * 3, [4, 5, 2], handlers=[0, 0, 2])  # handler 1 starts after the last frame
+        self.assertListEqual(self.table.cells['handler'][-3:].tolist(), [0, 0, 2])
+        self.assertEqual(self.table.record(len(self.table) - 1)[6], 2)
+
+    def testSortAndGroup(self):
+        """Cells of the same frame follow each other, order within frame is kept."""
+        order = self.table.sort(keys=('image', 'frame'))
+        self.assertListEqual(order.tolist(), [0, 3, 6, 9, 1, 4, 7, 10, 2, 5, 8, 11])
+        groups = self.table.groups(order, 'frame')
+        self.assertListEqual([g.tolist() for g in groups], [[0, 3, 6, 9], [1, 4, 7, 10], [2, 5, 8, 11]])
+
+    def testSave(self):
+        """Loaded table is the same."""
+        with tempfile.TemporaryDirectory() as folder:
+            name = os.path.join(folder, 'cells.npz')
+            self.table.save(name)
+            loaded = CellTable.load(name)
+        numpy.testing.assert_array_equal(loaded.cells, self.table.cells)
+        self.assertListEqual(loaded.qconfs, self.table.qconfs)
+        self.assertEqual(loaded.record(5)[:5], self.table.record(5)[:5])
+        numpy.testing.assert_array_equal(loaded.outline(11), self.table.outline(11))
+
+
+if __name__ == '__main__':
+    unittest.main()
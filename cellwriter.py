@@ -0,0 +1,338 @@
+"""
+Save cut cells.
+
+PngWriter saves each cell to separate file, TiffWriter does the same and also keeps multi-channel cells. NpyWriter and
+Hdf5Writer put all cells of one tail into one [N edge edge] array (N is number of cells in run, cell number is index in
+array, multi-channel cells give [N channels edge edge]) and describe them in companion cells.csv table.
+AsyncWriter runs writer that can be shared in pool of threads, so encoding and saving overlap with cutting.
+"""
+
+import csv
+import os
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+import numpy
+import tifffile
+from skimage import io
+try:
+    import h5py
+except ImportError:  # hdf5 output is optional
+    h5py = None
+
+tableName = 'cells.csv'
+tableColumns = ('index', 'tail', 'qconf', 'image', 'frame', 'x', 'y', 'width', 'height', 'centroidx', 'centroidy',
+                'status')
+
+
+def tailName(tails, countsubimage):
+    """Return name of tail of given number, 'cells' if only images from QCONFs are processed."""
+    return tails[countsubimage] if tails else 'cells'
+
+
+class PngWriter:
+    """Save every cell as separate png, name is basename_count.png or count_tail.png."""
+
+    parallel = True  # can be used in many processes at once
+    extension = '.png'
+
+    def __init__(self, outputFolder, randomizeFileNames, tails, numCells, edge):
+        """Take output folder and naming mode, other parameters are not used."""
+        self.outputFolder = outputFolder
+        self.randomizeFileNames = randomizeFileNames
+
+    def write(self, count, countsubimage, subimage, cell, meta):
+        """
+        Save cell.
+
+        Args:
+            count - global number of cell
+            countsubimage - number of tail
+            subimage - name of image the cell was cut from
+            cell - image to save
+            meta - dictionary with other columns of metadata table, see tableColumns
+
+        Returns:
+            number of written bytes
+
+        """
+        outFileName = self.outputName(count, countsubimage, subimage)
+        try:  # file can be hard link to crop cache (--link-cached), writing into it would change cached cell
+            os.remove(outFileName)
+        except FileNotFoundError:
+            pass
+        self.save(outFileName, cell)
+        return os.path.getsize(outFileName)
+
+    def outputName(self, count, countsubimage, subimage):
+        """Return name of file of cell, see write."""
+        if self.randomizeFileNames is True:
+            return os.path.join(self.outputFolder, str(count) + "_" + str(countsubimage) + self.extension)
+        return os.path.join(self.outputFolder, os.path.basename(subimage) + "_" + str(count) + self.extension)
+
+    def save(self, fileName, cell):
+        """Save one image."""
+        io.imsave(fileName, cell, check_contrast=False)
+
+    def flush(self):
+        """Nothing is buffered."""
+        pass
+
+    def close(self):
+        """Nothing to close."""
+        pass
+
+
+class TiffWriter(PngWriter):
+    """Save every cell as separate tiff, [channels edge edge] cells are saved as stacks. Names as for PngWriter."""
+
+    extension = '.tif'
+
+    def save(self, fileName, cell):
+        """Save one image or stack of channels or frames, stacks of 3 or 4 planes are not taken as RGB."""
+        tifffile.imwrite(fileName, cell, photometric='minisblack')
+
+
+class ArrayWriter:
+    """Base of writers that put cells into one array per tail and fill metadata table."""
+
+    parallel = False  # all cells go to one file
+
+    def __init__(self, outputFolder, randomizeFileNames, tails, numCells, edge):
+        """Create metadata table. Arrays are created on first write, when type of cells is known."""
+        self.outputFolder = outputFolder
+        self.tails = tails
+        self.numCells = numCells
+        self.arrays = {}
+        self.pending = {}  # cells waiting for flush, for each tail
+        self.tableFile = open(os.path.join(outputFolder, tableName), 'w', newline='')
+        self.table = csv.writer(self.tableFile)
+        self.table.writerow(tableColumns)
+
+    def write(self, count, countsubimage, subimage, cell, meta):
+        """Add cell and its metadata, see PngWriter.write. Returns size of cell, it is compressed later."""
+        name = tailName(self.tails, countsubimage)
+        self.pending.setdefault(name, []).append((count, cell))
+        row = dict(meta, index=count, tail=name)
+        self.table.writerow([row[column] for column in tableColumns])
+        return cell.nbytes
+
+    def flush(self):
+        """Write buffered cells as consecutive blocks."""
+        for name, cells in self.pending.items():
+            if name not in self.arrays:
+                self.arrays[name] = self.createArray(name, cells[0][1].dtype, (self.numCells,) + cells[0][1].shape)
+            cells.sort(key=lambda c: c[0])
+            start = 0
+            for i in range(1, len(cells) + 1):
+                if i == len(cells) or cells[i][0] != cells[i - 1][0] + 1:
+                    block = numpy.stack([c[1] for c in cells[start:i]])
+                    self.arrays[name][cells[start][0]:cells[start][0] + len(block)] = block
+                    start = i
+        self.pending = {}
+
+    def close(self):
+        """Flush cells and close files."""
+        self.flush()
+        self.tableFile.close()
+
+
+class NpyWriter(ArrayWriter):
+    """Save cells to memory-mapped cells<tail>.npy files."""
+
+    def createArray(self, name, dtype, shape):
+        """Create npy file for tail."""
+        fileName = os.path.join(self.outputFolder, name + '.npy' if name == 'cells' else 'cells' + name + '.npy')
+        return numpy.lib.format.open_memmap(fileName, mode='w+', dtype=dtype, shape=shape)
+
+    def close(self):
+        """Flush cells and write arrays to disk."""
+        super().close()
+        for array in self.arrays.values():
+            array.flush()
+        self.arrays = {}
+
+
+class Hdf5Writer(ArrayWriter):
+    """Save cells to chunked and compressed datasets in cells.h5, one dataset per tail. Requires h5py package."""
+
+    chunk = 64  # cells in one chunk
+
+    def __init__(self, outputFolder, randomizeFileNames, tails, numCells, edge):
+        """Create cells.h5 file."""
+        if h5py is None:
+            raise ImportError("Hdf5Writer requires h5py package")
+        super().__init__(outputFolder, randomizeFileNames, tails, numCells, edge)
+        self.h5 = h5py.File(os.path.join(outputFolder, 'cells.h5'), 'w', rdcc_nbytes=64 * 1024 ** 2)
+
+    def createArray(self, name, dtype, shape):
+        """Create dataset for tail."""
+        return self.h5.create_dataset(name, shape=shape, dtype=dtype,
+                                      chunks=(min(self.chunk, max(shape[0], 1)),) + shape[1:],
+                                      compression='gzip', shuffle=True)
+
+    def close(self):
+        """Flush cells and close file."""
+        super().close()
+        self.h5.close()
+
+
+class BufferWriter:
+    """Keep written cells to send them from worker process to writer that can not be shared."""
+
+    parallel = True
+
+    def __init__(self):
+        """Create empty buffer."""
+        self.records = []
+
+    def write(self, *args):
+        """Keep cell, see PngWriter.write."""
+        self.records.append(args)
+        return args[3].nbytes
+
+    def flush(self):
+        """Nothing to do, records are sent by replay."""
+        pass
+
+    def close(self):
+        """Nothing to close."""
+        pass
+
+    def replay(self, writer):
+        """Write kept cells with other writer."""
+        for record in self.records:
+            writer.write(*record)
+        writer.flush()
+
+
+class AsyncWriter:
+    """Run writes of other writer in pool of threads, at most maxPending cells wait for writing."""
+
+    parallel = True
+
+    def __init__(self, writer, threads, maxPending=None):
+        """
+        Start threads.
+
+        Args:
+            writer - writer with parallel set to True
+            threads - number of threads
+            maxPending - number of cells kept in memory before write blocks, default 4 per thread
+
+        """
+        self.writer = writer
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.slots = threading.BoundedSemaphore(maxPending or 4 * threads)
+        self.futures = []
+
+    def write(self, count, countsubimage, subimage, cell, meta):
+        """Queue cell for writing, see PngWriter.write. Returns size of cell, file size is not known yet."""
+        self.slots.acquire()
+        future = self.pool.submit(self.writer.write, count, countsubimage, subimage, cell, meta)
+        future.add_done_callback(lambda f: self.slots.release())
+        self.futures.append(future)
+        return cell.nbytes
+
+    def outputName(self, count, countsubimage, subimage):
+        """Return name of file of cell, see PngWriter.outputName."""
+        return self.writer.outputName(count, countsubimage, subimage)
+
+    def flush(self):
+        """Wait for queued cells, errors of writes are raised here."""
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+        self.writer.flush()
+
+    def close(self):
+        """Write queued cells and stop threads."""
+        self.flush()
+        self.pool.shutdown()
+        self.writer.close()
+
+
+writers = {'png': PngWriter, 'tiff': TiffWriter, 'npy': NpyWriter, 'hdf5': Hdf5Writer}
+
+
+class PngWriterTest(unittest.TestCase):
+    """Test of writers of separate files."""
+
+    def testLinked(self):
+        """Cell saved over file linked from crop cache does not change cache."""
+        from cropcache import CropCache
+        with tempfile.TemporaryDirectory() as folder:
+            writer = PngWriter(folder, False, ('_CH_1',), 1, 8)
+            writer.write(0, 0, 'a.tif', numpy.zeros((8, 8), numpy.uint8), {})
+            name = writer.outputName(0, 0, 'a.tif')
+            cache = CropCache(os.path.join(folder, 'cache'), 10000, link=True)
+            cache.store('ab', name)
+            cache.fetch('ab', name)
+            self.assertEqual(os.stat(name).st_nlink, 2)
+            writer.write(0, 0, 'a.tif', numpy.full((8, 8), 255, numpy.uint8), {})
+            self.assertEqual(io.imread(cache.path('ab', '.png')).max(), 0)
+            self.assertEqual(io.imread(name).min(), 255)
+
+
+class ArrayWriterTest(unittest.TestCase):
+    """Test of array writers."""
+
+    def setUp(self):
+        """Create output folder."""
+        self.dir = tempfile.TemporaryDirectory()
+        self.cells = (numpy.random.rand(5, 4, 4) * 1000).astype(numpy.uint16)
+        self.meta = {c: 0 for c in tableColumns}
+
+    def tearDown(self):
+        """Remove output folder."""
+        self.dir.cleanup()
+
+    def fill(self, writer, numTails):
+        """Write cells in mixed order."""
+        for count in (3, 4, 0, 2, 1):
+            for countsubimage in range(numTails):
+                writer.write(count, countsubimage, 'im.tif', self.cells[count] + countsubimage, self.meta)
+            if count == 0:
+                writer.flush()
+        writer.close()
+
+    def testNpy(self):
+        """Cells are in order of their numbers."""
+        self.fill(NpyWriter(self.dir.name, False, ('_CH_1', '_CH_2'), 5, 4), 2)
+        for countsubimage, name in enumerate(('_CH_1', '_CH_2')):
+            out = numpy.load(os.path.join(self.dir.name, 'cells' + name + '.npy'))
+            numpy.testing.assert_array_equal(out, self.cells + countsubimage)
+        with open(os.path.join(self.dir.name, tableName)) as table:
+            self.assertEqual(len(table.readlines()), 11)
+
+    def testAsync(self):
+        """All cells are saved and reading back gives the same images."""
+        self.fill(AsyncWriter(PngWriter(self.dir.name, True, (), 5, 4), 2, 2), 1)
+        for count in range(5):
+            out = io.imread(os.path.join(self.dir.name, str(count) + '_0.png'))
+            numpy.testing.assert_array_equal(out, self.cells[count])
+
+    def testChannels(self):
+        """Multi-channel cells are kept in tiff and npy."""
+        channels = numpy.stack([self.cells, self.cells + 1], axis=1)
+        writer = TiffWriter(self.dir.name, False, (), 5, 4)
+        writer.write(3, 0, 'im.tif', channels[3], self.meta)
+        numpy.testing.assert_array_equal(tifffile.imread(os.path.join(self.dir.name, 'im.tif_3.tif')), channels[3])
+        writer = NpyWriter(self.dir.name, False, (), 5, 4)
+        for count in range(5):
+            writer.write(count, 0, 'im.tif', channels[count], self.meta)
+        writer.close()
+        numpy.testing.assert_array_equal(numpy.load(os.path.join(self.dir.name, 'cells.npy')), channels)
+
+    @unittest.skipIf(h5py is None, "h5py not installed")
+    def testHdf5(self):
+        """Cells are in order of their numbers and type is kept."""
+        self.fill(Hdf5Writer(self.dir.name, False, (), 5, 4), 1)
+        with h5py.File(os.path.join(self.dir.name, 'cells.h5'), 'r') as h5:
+            self.assertEqual(h5['cells'].dtype, numpy.uint16)
+            numpy.testing.assert_array_equal(h5['cells'][:], self.cells)
+
+
+if __name__ == '__main__':
+    unittest.main()
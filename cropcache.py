@@ -0,0 +1,167 @@
+"""
+Keep saved cells between runs, addressed by their content.
+
+Key of cell is hash of everything its pixels depend on: identity of source stacks (name, size and modification time),
+frame, bounding box, size of output, background and resize modes. Naming of output files, output folder or order of
+tails are not part of key, so runs that change only them copy cells from cache instead of cutting and encoding them
+again. Cache is folder of files named by key, its size is limited and least recently used files are removed first.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+from collections import OrderedDict
+
+
+class CropCache:
+    """Folder of encoded cells named by hash of their source."""
+
+    def __init__(self, folder, budget, link=False):
+        """
+        Open cache, sizes of files already in it are read.
+
+        Args:
+            folder - cache folder, created if does not exist
+            budget - size of cache in bytes, least recently used files are removed by trim above it
+            link - hard link cached files to output instead of copying them, output files then share data with cache
+                   and must not be changed in place
+
+        """
+        self.folder = folder
+        self.budget = budget
+        self.link = link
+        self.hits = 0
+        self.misses = 0
+        self.stamps = {}
+        os.makedirs(folder, exist_ok=True)
+        entries = []
+        for sub in os.scandir(folder):
+            if sub.is_dir():
+                for entry in os.scandir(sub.path):
+                    st = entry.stat()
+                    entries.append((st.st_mtime_ns, entry.name, st.st_size))
+        self.entries = OrderedDict((name, size) for _, name, size in sorted(entries))  # the oldest first
+        self.size = sum(self.entries.values())
+
+    def stamp(self, fileName):
+        """Return identity of file (name, size, modification time), files are checked once."""
+        if fileName not in self.stamps:
+            st = os.stat(fileName)
+            self.stamps[fileName] = [os.path.basename(fileName), st.st_size, st.st_mtime_ns]
+        return self.stamps[fileName]
+
+    @staticmethod
+    def key(*parts):
+        """Return key of cell from JSON-serializable parts."""
+        return hashlib.sha1(json.dumps(parts).encode()).hexdigest()
+
+    def path(self, key, extension):
+        """Return path of cached file."""
+        return os.path.join(self.folder, key[:2], key + extension)
+
+    def has(self, key, extension):
+        """Return True if cell is cached in file of given extension, nothing is copied."""
+        return os.path.exists(self.path(key, extension))
+
+    def fetch(self, key, fileName):
+        """Put cached cell to fileName, extension of file is part of key. Returns size of file, None if not cached."""
+        name = key + os.path.splitext(fileName)[1]
+        cached = self.path(key, os.path.splitext(fileName)[1])
+        try:
+            if os.path.lexists(fileName):
+                os.remove(fileName)
+            if self.link:
+                try:
+                    os.link(cached, fileName)
+                except FileNotFoundError:
+                    raise
+                except OSError:  # other file system
+                    shutil.copyfile(cached, fileName)
+            else:
+                shutil.copyfile(cached, fileName)
+            os.utime(cached)  # recently used
+        except FileNotFoundError:  # not cached or removed by other process
+            self.misses += 1
+            self.entries.pop(name, None)
+            return None
+        self.hits += 1
+        if name in self.entries:
+            self.entries.move_to_end(name)
+        return os.path.getsize(fileName)
+
+    def store(self, key, fileName):
+        """Copy saved cell to cache."""
+        name = key + os.path.splitext(fileName)[1]
+        cached = self.path(key, os.path.splitext(fileName)[1])
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        tmpName = cached + '.' + uuid.uuid4().hex + '.tmp'  # other processes can store the same cell
+        shutil.copyfile(fileName, tmpName)
+        os.replace(tmpName, cached)
+        self.size += os.path.getsize(cached) - self.entries.pop(name, 0)
+        self.entries[name] = os.path.getsize(cached)
+        if self.size > self.budget:
+            self.trim()
+
+    def trim(self):
+        """Remove least recently used files until cache fits its budget."""
+        while self.entries and self.size > self.budget:
+            name, size = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(os.path.join(self.folder, name[:2], name))
+            except FileNotFoundError:  # removed by other process
+                pass
+
+
+class CropCacheTest(unittest.TestCase):
+    """Test of storing, fetching and eviction."""
+
+    def setUp(self):
+        """Create folders and file to cache."""
+        self.dir = tempfile.TemporaryDirectory()
+        self.cacheFolder = os.path.join(self.dir.name, 'cache')
+        self.cell = os.path.join(self.dir.name, 'cell.png')
+        with open(self.cell, 'wb') as f:
+            f.write(b'x' * 100)
+
+    def tearDown(self):
+        """Remove folders."""
+        self.dir.cleanup()
+
+    def testFetch(self):
+        """Stored cell is copied or linked, key depends on all parts."""
+        cache = CropCache(self.cacheFolder, 1000)
+        key = cache.key(cache.stamp(self.cell), 1, [2, 3, 4, 5], 32)
+        self.assertNotEqual(key, cache.key(cache.stamp(self.cell), 1, [2, 3, 4, 5], 33))
+        out = os.path.join(self.dir.name, 'out.png')
+        self.assertIsNone(cache.fetch(key, out))
+        cache.store(key, self.cell)
+        self.assertIsNone(cache.fetch(key, os.path.join(self.dir.name, 'out.tif')))  # other format
+        self.assertEqual(cache.fetch(key, out), 100)
+        self.assertTrue(cache.has(key, '.png'))
+        linked = CropCache(self.cacheFolder, 1000, link=True)
+        self.assertEqual(linked.size, 100)
+        self.assertEqual(linked.fetch(key, out), 100)
+        self.assertEqual(os.stat(out).st_nlink, 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def testTrim(self):
+        """The least recently used cells are removed."""
+        cache = CropCache(self.cacheFolder, 250)
+        for i in range(3):
+            cache.store(cache.key(i), self.cell)
+        self.assertEqual(cache.size, 200)  # the first one was removed
+        out = os.path.join(self.dir.name, 'out.png')
+        self.assertIsNone(cache.fetch(cache.key(0), out))
+        self.assertIsNotNone(cache.fetch(cache.key(1), out))
+        cache.store(cache.key(3), self.cell)
+        self.assertIsNone(cache.fetch(cache.key(2), out))
+        self.assertIsNotNone(cache.fetch(cache.key(1), out))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,238 @@
+"""
+Index input folder and check images before any cell is cut.
+
+Folder, and optionally all its subfolders, is listed once with directories read in parallel threads. Names of images of
+each QCONF are resolved against this listing, images are expected in the same folder as their QCONF. Headers of TIFF
+stacks are read (no pixels) to check number of frames against QCONF, size and type of all tails. All problems are
+collected and reported together, images of QCONFs without problems form the plan used by extraction. Channels of
+original multi-channel file are checked by opening them as stackreader.ChannelStack.
+"""
+
+import json
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+import numpy
+import tifffile
+from getQconfs import ext
+from nameresolver import resolveNames, resolveChannels
+from stackreader import ChannelStack
+
+
+def listFolder(folder, recursive=False, threads=8):
+    """Return {folder: set of file names} for folder and, if recursive, all its subfolders (symlinks not followed)."""
+    def scan(directory):
+        files = set()
+        dirs = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                else:
+                    files.add(entry.name)
+        return directory, files, dirs
+
+    listing = {}
+    level = [folder]
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        while level:  # directories of one level of tree are read at once
+            following = []
+            for directory, files, dirs in executor.map(scan, level):
+                listing[directory] = files
+                following.extend(dirs)
+            level = sorted(following) if recursive else []
+    return listing
+
+
+def readHeader(fileName):
+    """
+    Return (frames, (height, width), dtype) of stack from TIFF header as LazyStack sees it, None if not TIFF.
+
+    fileName can be also (file name, channel) of multi-channel file, ValueError is raised if it has not that channel.
+    """
+    if not isinstance(fileName, str):
+        with ChannelStack(*fileName) as stack:
+            return len(stack), stack.shape[1:], stack.dtype
+    try:
+        with tifffile.TiffFile(fileName) as tif:
+            series = tif.series[0]
+            frames = series.shape[0] if len(series.shape) > 2 else 1
+            return frames, tuple(series.shape[-2:]), numpy.dtype(series.dtype)
+    except ValueError:  # not TIFF, LazyStack reads it by skimage
+        return None
+
+
+def stackName(source):
+    """Return name of stack in messages, source is as for readHeader."""
+    if isinstance(source, str):
+        return os.path.basename(source)
+    return "{} channel {}".format(os.path.basename(source[0]), source[1])
+
+
+class FolderIndex:
+    """Listing of input folder used to find and check images of QCONFs."""
+
+    def __init__(self, folder, recursive=False, threads=8):
+        """List folder, no file is opened here."""
+        if not os.path.isdir(folder):
+            raise Exception("Not a folder")
+        self.folder = folder
+        self.threads = threads
+        self.listing = listFolder(folder, recursive, threads)
+
+    def qconfs(self):
+        """Return sorted list of QCONF files in all listed folders."""
+        return sorted(os.path.join(folder, name) for folder, names in self.listing.items() for name in names
+                      if name.endswith(ext) and not name.startswith('.'))
+
+    def subfolder(self, qconf):
+        """Return folder of QCONF relative to indexed folder, empty for top one."""
+        folder = os.path.relpath(os.path.dirname(qconf), self.folder)
+        return '' if folder == os.curdir else folder
+
+    def resolve(self, qconf, image, tails, lsm=False):
+        """
+        Return paths of images of QCONF for given tails, (path, channel) of original file if lsm is True.
+
+        Raises ValueError if tails do not match name of image or some images are not in folder of QCONF.
+        """
+        folder = os.path.dirname(qconf)
+        if lsm:
+            source, channels, _ = resolveChannels(image, tails)
+            names = [source]
+        else:
+            names = resolveNames(os.path.basename(image), tails)
+        missing = [name for name in names if name not in self.listing.get(folder, ())]
+        if missing:
+            raise ValueError("missing " + ", ".join(missing))
+        if lsm:
+            return [(os.path.join(folder, source), channel) for channel in channels]
+        return [os.path.join(folder, name) for name in names]
+
+    def validate(self, qconfs, tails, channels=False, lsm=False):
+        """
+        Check images of QCONFs.
+
+        Args:
+            qconfs - list of (qconf, image name from QCONF, number of frames from QCONF)
+            tails - tails of images, see nameresolver.resolveNames
+            channels - tails are stacked into one image, so they must have the same type
+            lsm - tails are channels of original multi-channel file, see nameresolver.resolveChannels
+
+        Returns:
+            (plan, problems) - plan is {qconf: {'images':, 'frames':, 'shape':, 'dtype':}} of QCONFs without problems,
+            problems is list of messages
+
+        """
+        problems = []
+        resolved = []
+        for qconf, image, numFrames in qconfs:
+            try:
+                resolved.append((qconf, self.resolve(qconf, image, tails, lsm), numFrames))
+            except ValueError as err:
+                problems.append("{}: {}".format(qconf, err))
+        names = sorted(set(name for _, images, _ in resolved for name in images))
+
+        def header(name):
+            try:
+                return readHeader(name)
+            except (OSError, ValueError) as err:
+                return err
+
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            headers = dict(zip(names, executor.map(header, names)))
+        plan = {}
+        for qconf, images, numFrames in resolved:
+            errors = []
+            known = [(name, headers[name]) for name in images if headers[name] is not None]
+            for name, h in known:
+                if isinstance(h, Exception):
+                    errors.append("can not read {}: {}".format(stackName(name), h))
+                elif h[0] != numFrames:
+                    errors.append("{} has {} frames, QCONF has {}".format(stackName(name), h[0], numFrames))
+            known = [(name, h) for name, h in known if not isinstance(h, Exception)]
+            for name, h in known[1:]:
+                if h[1] != known[0][1][1]:
+                    errors.append("{} has size {}, {} has {}".format(stackName(name), h[1],
+                                                                     stackName(known[0][0]), known[0][1][1]))
+                elif channels and h[2] != known[0][1][2]:
+                    errors.append("{} is {}, {} is {}".format(stackName(name), h[2],
+                                                              stackName(known[0][0]), known[0][1][2]))
+            if errors:
+                problems.extend("{}: {}".format(qconf, error) for error in errors)
+                continue
+            first = known[0][1] if known else (numFrames, None, None)
+            plan[qconf] = {'images': images, 'frames': first[0], 'shape': first[1],
+                           'dtype': None if first[2] is None else first[2].name}
+        return plan, problems
+
+
+def savePlan(fileName, plan):
+    """Save plan returned by FolderIndex.validate to JSON file."""
+    with open(fileName, 'w') as f:
+        json.dump(plan, f, indent=1)
+
+
+class FolderIndexTest(unittest.TestCase):
+    """Test of listing and checks."""
+
+    def setUp(self):
+        """Create folder with QCONF in subfolder and stacks of different sizes."""
+        self.dir = tempfile.TemporaryDirectory()
+        self.sub = os.path.join(self.dir.name, 'a', 'b')
+        os.makedirs(self.sub)
+        for name in ('x.lsm_CH_1.QCONF', 'y.lsm_CH_1.QCONF'):
+            open(os.path.join(self.sub, name), 'w').close()
+        tifffile.imwrite(os.path.join(self.sub, 'x.lsm_CH_1.tif'), numpy.zeros((5, 8, 6), numpy.uint8))
+        tifffile.imwrite(os.path.join(self.sub, 'x.lsm_CH_2.tif'), numpy.zeros((5, 8, 6), numpy.uint16))
+        tifffile.imwrite(os.path.join(self.sub, 'y.lsm_CH_1.tif'), numpy.zeros((5, 8, 6), numpy.uint8))
+        tifffile.imwrite(os.path.join(self.sub, 'y.lsm_CH_2.tif'), numpy.zeros((6, 8, 7), numpy.uint8))
+
+    def tearDown(self):
+        """Remove folder."""
+        self.dir.cleanup()
+
+    def testList(self):
+        """QCONFs are found only in recursive mode."""
+        self.assertListEqual(FolderIndex(self.dir.name).qconfs(), [])
+        index = FolderIndex(self.dir.name, recursive=True)
+        qconfs = index.qconfs()
+        self.assertListEqual([os.path.basename(q) for q in qconfs], ['x.lsm_CH_1.QCONF', 'y.lsm_CH_1.QCONF'])
+        self.assertEqual(index.subfolder(qconfs[0]), os.path.join('a', 'b'))
+        self.assertTupleEqual(readHeader(os.path.join(self.sub, 'y.lsm_CH_2.tif')), (6, (8, 7), numpy.uint8))
+
+    def testValidate(self):
+        """All problems are reported, valid QCONF is planned."""
+        index = FolderIndex(self.dir.name, recursive=True)
+        x, y = index.qconfs()
+        qconfs = [(x, '/other/x.lsm_CH_1.tif', 5), (y, 'y.lsm_CH_1.tif', 5)]
+        plan, problems = index.validate(qconfs, ('_CH_1', '_CH_2'))
+        self.assertListEqual(list(plan), [x])
+        self.assertEqual(plan[x]['shape'], (8, 6))
+        self.assertEqual(len(problems), 2)  # frames and size of y.lsm_CH_2.tif
+        plan, problems = index.validate(qconfs, ('_CH_1', '_CH_2'), channels=True)
+        self.assertEqual(len(problems), 3)
+        plan, problems = index.validate(qconfs, ('_CH_1', '_CH_3'))
+        self.assertEqual(len(problems), 2)
+        self.assertIn('missing x.lsm_CH_3.tif', problems[0])
+        plan, problems = index.validate(qconfs, ('_CH_2', '_CH_3'))  # original tail not given
+        self.assertEqual(len(problems), 2)
+
+    def testChannels(self):
+        """Channels of original file are checked."""
+        tifffile.imwrite(os.path.join(self.sub, 'x.lsm'), numpy.zeros((5, 2, 8, 6), numpy.uint8),
+                         planarconfig='separate', photometric='minisblack')
+        index = FolderIndex(self.dir.name, recursive=True)
+        x, y = index.qconfs()
+        qconfs = [(x, 'x.lsm_CH_1.tif', 5), (y, 'y.lsm_CH_1.tif', 5)]
+        plan, problems = index.validate(qconfs, ('_CH_1', '_CH_2'), lsm=True)
+        lsm = os.path.join(self.sub, 'x.lsm')
+        self.assertListEqual(plan[x]['images'], [(lsm, 0), (lsm, 1)])
+        self.assertListEqual(problems, [y + ': missing y.lsm'])
+        plan, problems = index.validate(qconfs[:1], ('_CH_1', '_CH_3'), lsm=True)
+        self.assertIn('can not read x.lsm channel 2', problems[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
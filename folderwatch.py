@@ -0,0 +1,137 @@
+"""
+Find QCONFs that appear or change in watched folder.
+
+Folder is indexed again on every poll. Each QCONF is parsed (only when it changes) to get name and number of frames of
+its image, and size and modification time of QCONF and all its images form stamp of the set. Set is ready when its
+stamp did not change since previous poll, so files that are still being copied are not taken, and its images pass
+FolderIndex.validate. Ready sets are returned once, again only if some of their files change later.
+"""
+
+import logging
+import os
+import tempfile
+import unittest
+import numpy
+import tifffile
+from folderindex import FolderIndex
+from manifest import stamp
+from scanqconf import ScanQconf
+
+logger = logging.getLogger(__name__)
+
+
+class FolderWatcher:
+    """New and changed sets of QCONF and its images in folder."""
+
+    def __init__(self, folder, tails, recursive=False, channels=False, lsm=False, Qconf=ScanQconf):
+        """
+        Prepare watcher, folder is not read until first poll.
+
+        Args:
+            folder - watched folder
+            tails, channels, lsm - how images of QCONF are found and checked, see FolderIndex.validate
+            recursive - watch also subfolders
+            Qconf - class used to parse QCONFs
+
+        """
+        self.folder = folder
+        self.tails = tails
+        self.recursive = recursive
+        self.channels = channels
+        self.lsm = lsm
+        self.Qconf = Qconf
+        self.info = {}  # {qconf: (stamp, image, number of frames)}, QCONF is parsed again only if changed
+        self.last = {}  # {qconf: stamp of set} from previous poll
+        self.handled = {}  # {qconf: stamp of set} when it was returned
+
+    def describe(self, index, qconf):
+        """Return (stamp of set, image, number of frames) of QCONF, raises OSError or ValueError if not complete."""
+        qstamp = stamp(qconf)
+        info = self.info.get(qconf)
+        if info is None or info[0] != qstamp:
+            try:
+                sq = self.Qconf(qconf)
+                info = (qstamp, sq.getImageName(), sq.getNumFrames())
+            except KeyError as err:  # valid JSON, but not QCONF yet
+                raise ValueError("no " + str(err))
+            self.info[qconf] = info
+        sources = index.resolve(qconf, info[1], self.tails, self.lsm)
+        stamps = [qstamp] + [stamp(source if isinstance(source, str) else source[0]) for source in sources]
+        return stamps, info[1], info[2]
+
+    def poll(self):
+        """
+        Index folder and return sets that are ready.
+
+        Returns:
+            (index, ready, problems) - FolderIndex of folder, sorted list of ready QCONFs whose images are correct and
+            list of messages about ready QCONFs whose images are not. QCONFs with problems are not returned again
+            until they change
+
+        """
+        index = FolderIndex(self.folder, self.recursive)
+        qconfs = index.qconfs()
+        current = {}
+        candidates = []
+        for qconf in qconfs:
+            try:
+                stamps, image, numFrames = self.describe(index, qconf)
+            except (OSError, ValueError) as err:  # being written, removed or images are not there yet
+                logger.debug("%s is not complete: %s", qconf, err)
+                continue
+            current[qconf] = stamps
+            if stamps == self.last.get(qconf) and stamps != self.handled.get(qconf):
+                candidates.append((qconf, image, numFrames))
+        self.last = current
+        for qconf in set(self.info) - set(qconfs):  # removed
+            del self.info[qconf]
+        plan, problems = index.validate(candidates, self.tails, self.channels, self.lsm)
+        for qconf, _, _ in candidates:
+            self.handled[qconf] = current[qconf]
+        return index, sorted(plan), problems
+
+
+class FolderWatcherTest(unittest.TestCase):
+    """Test of finding complete sets."""
+
+    def setUp(self):
+        """Create folder with one set."""
+        from synthetic import makeDataset
+        self.dir = tempfile.TemporaryDirectory()
+        self.qconf = makeDataset(self.dir.name, qconfs=1, cells=1, frames=5, imageSize=(16, 16))[0]
+        self.watcher = FolderWatcher(self.dir.name, ('_CH_1', '_CH_2'))
+
+    def tearDown(self):
+        """Remove folder."""
+        self.dir.cleanup()
+
+    def testPoll(self):
+        """Set is returned after it did not change for one poll and again when it changes."""
+        self.assertListEqual(self.watcher.poll()[1], [])
+        self.assertListEqual(self.watcher.poll()[1], [self.qconf])
+        self.assertListEqual(self.watcher.poll()[1], [])
+        image = os.path.join(self.dir.name, 'synthetic0.lsm_CH_2.tif')
+        tifffile.imwrite(image, numpy.zeros((6, 16, 16), numpy.uint16))  # replaced, does not match QCONF
+        self.assertListEqual(self.watcher.poll()[1], [])
+        _, ready, problems = self.watcher.poll()
+        self.assertListEqual(ready, [])
+        self.assertIn('6 frames', problems[0])
+        tifffile.imwrite(image, numpy.zeros((5, 16, 16), numpy.uint16))
+        self.watcher.poll()
+        self.assertListEqual(self.watcher.poll()[1], [self.qconf])
+
+    def testIncomplete(self):
+        """QCONF that is not complete JSON and QCONF without images are not returned."""
+        with open(self.qconf, 'r') as f:
+            text = f.read()
+        with open(self.qconf, 'w') as f:
+            f.write(text[:len(text) // 2])
+        other = os.path.join(self.dir.name, 'other.lsm_CH_1.QCONF')
+        with open(other, 'w') as f:
+            f.write(text.replace('synthetic0', 'other'))
+        for _ in range(3):
+            self.assertListEqual(self.watcher.poll()[1], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,15 +2,18 @@
 
 from os import path as p
 import glob
+import logging
+
+logger = logging.getLogger(__name__)
 
 ext = ".QCONF"
 
 
 def scanFolder(folder):
     """Scan folder for QCONF files and returns list of them."""
-    print("Scanning ", folder)
+    logger.info("Scanning %s", folder)
     if not p.isdir(folder):
         raise Exception("Not a folder")
-    fileList = glob.glob(p.join(folder, "*" + ext))
-    print("\tFound", len(fileList), "files")
+    fileList = sorted(glob.glob(p.join(folder, "*" + ext)))  # the same order, and cell numbers, in every run
+    logger.info("\tFound %d files", len(fileList))
     return fileList
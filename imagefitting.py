@@ -1,19 +1,73 @@
 """Scale and pad cell images."""
 
+import logging
 import numpy
-import scipy.misc
 import unittest
+from metrics import timed
 
+logger = logging.getLogger(__name__)
 def_pad_value = 0
+resizeModes = ('bilinear', 'area')
 
 
-def rescale(image, edge):
+def resizeWeights(length, newLength, mode):
+    """
+    Return [newLength length] matrix that resamples 1D signal.
+
+    bilinear - linear interpolation between pixel centers
+    area - each output pixel is mean of input pixels it covers, weighted by covered part
+    """
+    if length == 0:  # empty cut, output is background
+        return numpy.zeros((newLength, 0))
+    scale = newLength / length
+    if mode == 'bilinear':
+        src = numpy.clip((numpy.arange(newLength) + 0.5) / scale - 0.5, 0, length - 1)
+        low = numpy.floor(src).astype(int)
+        high = numpy.minimum(low + 1, length - 1)
+        weights = numpy.zeros((newLength, length))
+        rows = numpy.arange(newLength)
+        numpy.add.at(weights, (rows, low), 1 - (src - low))
+        numpy.add.at(weights, (rows, high), src - low)
+    elif mode == 'area':
+        start = numpy.arange(newLength)[:, None] / scale
+        pixel = numpy.arange(length)[None, :]
+        overlap = numpy.minimum(start + 1 / scale, pixel + 1) - numpy.maximum(start, pixel)
+        weights = numpy.maximum(overlap, 0) * scale
+    else:
+        raise ValueError("Unknown resize mode " + repr(mode))
+    return weights
+
+
+def resize(image, scale, mode='bilinear'):
+    """
+    Resize image by scale keeping its type.
+
+    Args:
+        image - [y x] image or [N y x] stack of images of the same size, all are resized together
+        scale - scale factor, output size is rounded
+        mode - 'bilinear' or 'area'
+
+    Returns:
+        Resized image or stack of type of input. Integer images are rounded and clipped to range of their type.
+
+    """
+    rows, cols = image.shape[-2:]
+    newRows = max(int(numpy.round(rows * scale)), 1)
+    newCols = max(int(numpy.round(cols * scale)), 1)
+    res = resizeWeights(rows, newRows, mode) @ image.astype(numpy.float64) @ resizeWeights(cols, newCols, mode).T
+    if numpy.issubdtype(image.dtype, numpy.integer):
+        info = numpy.iinfo(image.dtype)
+        res = numpy.clip(numpy.round(res), info.min, info.max)
+    return res.astype(image.dtype)
+
+
+def rescale(image, edge, mode='bilinear'):
     """Rescale and pads image to get [edge, edge] size."""
     # Find largest edge
     largest = numpy.max(image.shape)
 
-    res = scipy.misc.imresize(image, edge / largest)
-    return pad(res, edge)
+    res = resize(image, edge / largest, mode)
+    return pad(res, edge, 'constant', constant_values=def_pad_value)
 
 
 def pad(image, edge, mode, **kwargs):
@@ -27,7 +81,7 @@ def pad(image, edge, mode, **kwargs):
     rows = edge - image.shape[0]
     cols = edge - image.shape[1]
     if any(i < 0 for i in (rows, cols)):
-        print("\nWarning, image larger than requested box, scale first")
+        logger.warning("Image larger than requested box, scale first")
         return image
     rowsup = int(numpy.round(rows / 2))  # rows above
     rowsdown = int(rows - rowsup)  # rows below - may be different that above
@@ -80,7 +134,7 @@ def cut(image, size, edge):
     return image[starty:endy, startx:endx]
 
 
-def process(im, size, counters, edge, trueBackground=False):
+def process(im, size, counters, edge, trueBackground=False, resizeMode='bilinear'):
     """Process image cutting cells and adjusting size of them.
 
     If trueBackground==True, mean value is used for padding.
@@ -93,6 +147,7 @@ def process(im, size, counters, edge, trueBackground=False):
         edge - demanded size of output image
         trueBackground - if True, natural object background from image is also taken (if requested size is bigger than
                          object)
+        resizeMode - 'bilinear' or 'area', see resize
 
     Returns:
         (cell)
@@ -106,10 +161,10 @@ def process(im, size, counters, edge, trueBackground=False):
         cutCell = cut(im, size, None)  # just BBox
     # compare with demanded size
     if any(i > edge for i in cutCell.shape):
-        cutCell = rescale(cutCell, edge)
+        cutCell = rescale(cutCell, edge, resizeMode)
         if counters:
             counters["rescaled"] += 1
-        print(" [RESCALED]", sep=' ', end='', flush=True)
+        logger.debug("[RESCALED]")
     elif any(i < edge for i in cutCell.shape):  # if trueBackground==True output can be smaller and then is padded
         if trueBackground:
             cutCell = pad(cutCell, edge, 'reflect')
@@ -117,10 +172,166 @@ def process(im, size, counters, edge, trueBackground=False):
             cutCell = pad(cutCell, edge, 'constant', constant_values=def_pad_value)
         if counters:
             counters['padded'] += 1
-        print(" [PADDED]", sep=' ', end='', flush=True)
+        logger.debug("[PADDED]")
     return cutCell
 
 
+def cutBoxes(sizes, edge, shape, trueBackground=False):
+    """Compute cut of many bounding boxes, the same as cut does.
+
+    Args:
+        sizes - N x 4 array of (startx, starty, width, height) bounding boxes
+        edge - demanded size of output images
+        shape - (height, width) of image
+        trueBackground - if True, box is extended to edge around cell as in cut with edge
+
+    Returns:
+        (startx, starty, cutw, cuth, valid, large) - arrays of start and size of cut, valid is False for cuts that lay
+        outside image, large is True for valid cuts that are larger than edge and have to be rescaled
+
+    """
+    sizes = numpy.asarray(sizes, dtype=numpy.int64).reshape(-1, 4)
+    height, width = shape
+    startx, starty, boxw, boxh = (sizes[:, i] for i in range(4))
+    if trueBackground:
+        e = int(edge)
+        startx = startx - (numpy.round((edge - boxw) / 2).astype(numpy.int64) - 1)
+        starty = starty - (numpy.round((edge - boxh) / 2).astype(numpy.int64) - 1)
+        endx = startx + e
+        endy = starty + e
+    else:
+        endx = startx + boxw
+        endy = starty + boxh
+    startx = numpy.clip(startx, 0, width - 1)
+    starty = numpy.clip(starty, 0, height - 1)
+    endx = numpy.minimum(endx, width)
+    endy = numpy.minimum(endy, height)
+    cutw = endx - startx
+    cuth = endy - starty
+    valid = (endx > 0) & (endy > 0) & (cutw > 0) & (cuth > 0)
+    large = valid & ((cutw > edge) | (cuth > edge))
+    return startx, starty, cutw, cuth, valid, large
+
+
+def processBatch(im, sizes, counters, edge, trueBackground=False, frames=None, resizeMode='bilinear', metrics=None):
+    """Process many cells from one frame or stack at once.
+
+    Gives the same cells as process called for each bounding box, but all cells are written to one preallocated array
+    with vectorized indexing. Cells that have to be rescaled are resized together if their cuts have the same size.
+    Only cells that lay outside image are processed one by one.
+
+    Args:
+        im - full image to process, [y x] frame or [slices y x] stack
+        sizes - N x 4 array of (startx, starty, width, height) bounding boxes, see process
+        counters - {'padded':, 'rescaled'} - numbers that are increased during method call. Use None if not needed.
+        edge - demanded size of output images
+        trueBackground - if True, natural object background from image is taken and padding is by reflection
+        frames - N indexes of slices for each bounding box if im is stack
+        resizeMode - 'bilinear' or 'area', see resize
+        metrics - metrics.Metrics to record time of cut, rescale and pad stages, None if not needed
+
+    Returns:
+        (cells, status) - cells is [N edge edge] array of type of im, status is N-element array of strings 'padded',
+        'rescaled' or '' telling what was done with each cell
+
+    """
+    sizes = numpy.asarray(sizes, dtype=numpy.int64).reshape(-1, 4)
+    e = int(edge)
+    cells = numpy.empty((len(sizes), e, e), dtype=im.dtype)
+    status = numpy.full(len(sizes), '', dtype='<U8')
+    with timed(metrics, 'cut', len(sizes)):
+        # bounding boxes of cut, the same as in cut
+        startx, starty, cutw, cuth, valid, large = cutBoxes(sizes, edge, im.shape[-2:], trueBackground)
+        regular = valid & ~large
+        # cuts with empty or negative ranges go through process
+        for i in numpy.flatnonzero(~valid):
+            single = {'rescaled': 0, 'padded': 0}
+            cells[i] = process(im[frames[i]] if frames is not None else im, sizes[i], single, edge, trueBackground,
+                               resizeMode)
+            status[i] = 'rescaled' if single['rescaled'] else 'padded' if single['padded'] else ''
+    with timed(metrics, 'rescale', int(numpy.count_nonzero(large))):
+        # cuts larger than edge are rescaled and padded by zeros as in rescale, together if they have the same size
+        shapes = {}
+        for i in numpy.flatnonzero(large):
+            shapes.setdefault((cuth[i], cutw[i]), []).append(i)
+        for (h, w), idx in shapes.items():
+            idx = numpy.array(idx)
+            rows = starty[idx, None] + numpy.arange(h)
+            cols = startx[idx, None] + numpy.arange(w)
+            if frames is not None:
+                crops = im[numpy.asarray(frames)[idx, None, None], rows[:, :, None], cols[:, None, :]]
+            else:
+                crops = im[rows[:, :, None], cols[:, None, :]]
+            res = resize(crops, edge / max(h, w), resizeMode)
+            rowsup = int(numpy.round((edge - res.shape[1]) / 2))
+            colsup = int(numpy.round((edge - res.shape[2]) / 2))
+            cells[idx] = def_pad_value
+            cells[idx, rowsup:rowsup + res.shape[1], colsup:colsup + res.shape[2]] = res
+            status[idx] = 'rescaled'
+    g = numpy.flatnonzero(regular)
+    with timed(metrics, 'pad', len(g)):
+        status[g[(cutw[g] < edge) | (cuth[g] < edge)]] = 'padded'
+        # index of source pixel for each output pixel, padding is centered as in pad
+        rows = numpy.arange(e) - numpy.round((edge - cuth[g]) / 2).astype(numpy.int64)[:, None]  # [G e]
+        cols = numpy.arange(e) - numpy.round((edge - cutw[g]) / 2).astype(numpy.int64)[:, None]
+        if trueBackground:  # the same as numpy.pad 'reflect' mode
+            rows = _reflect(rows, cuth[g, None])
+            cols = _reflect(cols, cutw[g, None])
+        else:
+            validrows = (rows >= 0) & (rows < cuth[g, None])
+            validcols = (cols >= 0) & (cols < cutw[g, None])
+            rows = numpy.clip(rows, 0, cuth[g, None] - 1)
+            cols = numpy.clip(cols, 0, cutw[g, None] - 1)
+        rows += starty[g, None]
+        cols += startx[g, None]
+        if frames is not None:
+            gathered = im[numpy.asarray(frames)[g, None, None], rows[:, :, None], cols[:, None, :]]
+        else:
+            gathered = im[rows[:, :, None], cols[:, None, :]]
+        if not trueBackground:
+            gathered[~(validrows[:, :, None] & validcols[:, None, :])] = def_pad_value
+        cells[g] = gathered
+
+    if counters:
+        counters['rescaled'] += int(numpy.count_nonzero(status == 'rescaled'))
+        counters['padded'] += int(numpy.count_nonzero(status == 'padded'))
+    return cells, status
+
+
+def processChannels(im, sizes, counters, edge, trueBackground=False, resizeMode='bilinear', metrics=None):
+    """Process many cells from frame with many channels, all channels of cell are cut with the same box.
+
+    Channels are treated as stack slices in one processBatch call, so boxes are computed and cut once for all. Pixels of
+    cells are copied only by this gather, [N channels edge edge] output is view of its result.
+
+    Args:
+        im - [channels y x] frame, build it once and reuse it for all cells and sizes of frame
+        counters - {'padded':, 'rescaled'} increased once for each cell, not for each channel, None if not needed
+        others - see processBatch
+
+    Returns:
+        (cells, status) - cells is [N channels edge edge] array, status is the same for all channels of cell
+
+    """
+    sizes = numpy.asarray(sizes, dtype=numpy.int64).reshape(-1, 4)
+    numChannels = im.shape[0]
+    cells, status = processBatch(im, numpy.repeat(sizes, numChannels, axis=0), None, edge, trueBackground,
+                                 frames=numpy.tile(numpy.arange(numChannels), len(sizes)), resizeMode=resizeMode,
+                                 metrics=metrics)
+    status = status[::numChannels]
+    if counters:
+        counters['rescaled'] += int(numpy.count_nonzero(status == 'rescaled'))
+        counters['padded'] += int(numpy.count_nonzero(status == 'padded'))
+    return cells.reshape((len(sizes), numChannels) + cells.shape[1:]), status
+
+
+def _reflect(index, length):
+    """Map indexes outside [0, length) to reflected ones, without repeating edge values."""
+    period = numpy.maximum(2 * (length - 1), 1)
+    index = index % period
+    return numpy.where(index >= length, period - index, index)
+
+
 class PadTests(unittest.TestCase):
     """
     Test of pad and rescale methods.
@@ -146,6 +357,20 @@ class PadTests(unittest.TestCase):
         out = rescale(rr, 5)
         self.assertTupleEqual(out.shape, (5, 5))
 
+    def testResize(self):
+        """Type is kept and stack is resized as separate images."""
+        rr = (numpy.random.rand(3, 12, 8) * 60000).astype(numpy.uint16)
+        for mode in resizeModes:
+            out = resize(rr, 0.5, mode)
+            self.assertTupleEqual(out.shape, (3, 6, 4))
+            self.assertEqual(out.dtype, numpy.uint16)
+            numpy.testing.assert_array_equal(out[1], resize(rr[1], 0.5, mode))
+        # area of 2x2 blocks is their mean
+        numpy.testing.assert_allclose(resize(rr.astype(float), 0.5, 'area')[0],
+                                      rr[0].astype(float).reshape(6, 2, 4, 2).mean(axis=(1, 3)))
+        # bilinear of constant image is constant
+        numpy.testing.assert_array_equal(resize(numpy.full((7, 9), 1000, numpy.uint16), 0.37), 1000)
+
     def testCut(self):
         """Test of cut method."""
         rr = numpy.random.rand(10, 6) * 255
@@ -182,6 +407,36 @@ class PadTests(unittest.TestCase):
         out = cut(rr, (1, 1, 0, 0), 4)
         self.assertTupleEqual(out.shape, (4, 4))
 
+    def testBatch(self):
+        """Batch gives the same cells as process."""
+        rr = (numpy.random.rand(3, 40, 30) * 255).astype(numpy.uint8)
+        sizes = [(x, y, w, h) for x in (-3, 0, 7, 28) for y in (-2, 5, 39) for w in (1, 5, 12, 20) for h in (2, 12, 17)]
+        frames = numpy.arange(len(sizes)) % 3
+        for trueBackground in (False, True):
+            counters = {'rescaled': 0, 'padded': 0}
+            out, status = processBatch(rr, sizes, counters, 12, trueBackground, frames, 'area')
+            self.assertTupleEqual(out.shape, (len(sizes), 12, 12))
+            single = {'rescaled': 0, 'padded': 0}
+            for i, size in enumerate(sizes):
+                numpy.testing.assert_array_equal(out[i], process(rr[frames[i]], size, single, 12, trueBackground,
+                                                                 'area'))
+            self.assertDictEqual(counters, single)
+            self.assertEqual(numpy.count_nonzero(status == 'padded'), single['padded'])
+
+    def testChannels(self):
+        """Each channel gives the same cells as processBatch of that channel alone."""
+        rr = (numpy.random.rand(3, 40, 30) * 255).astype(numpy.uint8)
+        sizes = [(-3, 5, 5, 12), (7, 39, 12, 2), (0, 0, 20, 17), (28, 5, 1, 2)]
+        counters = {'rescaled': 0, 'padded': 0}
+        out, status = processChannels(rr, sizes, counters, 12, True)
+        self.assertTupleEqual(out.shape, (4, 3, 12, 12))
+        for c in range(3):
+            single = {'rescaled': 0, 'padded': 0}
+            cells, singleStatus = processBatch(rr[c], sizes, single, 12, True)
+            numpy.testing.assert_array_equal(out[:, c], cells)
+            numpy.testing.assert_array_equal(status, singleStatus)
+            self.assertDictEqual(counters, single)  # once for each cell
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,187 @@
+"""
+Record finished work of PrepareData run.
+
+Manifest is JSON lines file in output folder. First line keeps parameters of run. Then each QCONF gets a line with size
+and modification time of it and of its images and with global numbers given to its cells, and each saved frame of QCONF
+gets one line.
+Lines are only appended, so work done before program was stopped stays recorded and can be skipped on resume.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import unittest
+
+logger = logging.getLogger(__name__)
+manifestName = 'manifest.jsonl'
+
+
+def stamp(fileName):
+    """Return size and modification time of file."""
+    st = os.stat(fileName)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def frameDone(fileName, qconf, frame):
+    """Record that all cells of QCONF from frame were saved. Can be called from many processes at once."""
+    line = json.dumps({'qconf': os.path.abspath(qconf), 'frame': frame}) + '\n'
+    with open(fileName, 'a') as f:  # one short appended line is not mixed with lines from other processes
+        f.write(line)
+
+
+class Manifest:
+    """Finished work of previous runs and numbering of cells."""
+
+    def __init__(self, fileName, params, resume):
+        """
+        Open manifest.
+
+        Args:
+            fileName - manifest file
+            params - dictionary of parameters that change output, work done with other parameters is not reused
+            resume - if False or manifest does not exist new manifest is started
+
+        """
+        self.fileName = fileName
+        self.params = json.loads(json.dumps(params))  # the same types as read from file
+        self.qconfs = {}  # {qconf: {'stamp':, 'images':, 'first':, 'cells':}}
+        self.frames = {}  # {qconf: set of saved frames}
+        if resume and os.path.isfile(fileName):
+            self.load()
+        else:
+            self.start()
+
+    def start(self):
+        """Start new manifest."""
+        self.qconfs = {}
+        self.frames = {}
+        with open(self.fileName, 'w') as f:
+            f.write(json.dumps({'params': self.params}) + '\n')
+
+    def load(self):
+        """Read manifest, start new one if parameters are different."""
+        with open(self.fileName, 'r') as f:
+            lines = f.readlines()
+        try:
+            params = json.loads(lines[0])['params']
+        except (IndexError, ValueError, KeyError):
+            params = None
+        if params != self.params:
+            logger.warning("Parameters differ from previous run, nothing is resumed")
+            self.start()
+            return
+        for line in lines[1:]:
+            try:
+                record = json.loads(line)
+            except ValueError:  # last line can be broken if program was killed
+                continue
+            if 'frame' in record:
+                self.frames.setdefault(record['qconf'], set()).add(record['frame'])
+            else:
+                self.qconfs[record['qconf']] = {'stamp': record['stamp'], 'images': record.get('images'),
+                                                'first': record['first'], 'cells': record['cells']}
+                self.frames[record['qconf']] = set()  # QCONF changed, nothing done yet
+
+    def allocate(self, qconfSizes, images=None):
+        """
+        Give global numbers to cells of QCONFs.
+
+        Unchanged QCONFs keep numbers from previous run. QCONFs that changed keep them as long as number of cells is
+        the same, but all their frames are processed again. QCONF is changed also if some of its images changed. New
+        QCONFs get numbers after the largest one used.
+
+        Args:
+            qconfSizes - list of (qconf, number of cells)
+            images - {qconf: stacks read for QCONF}, file names or (file name, channel), see FolderIndex.validate
+
+        Returns:
+            {qconf: number of first cell}
+
+        """
+        firsts = {}
+        nextFree = max([e['first'] + e['cells'] for e in self.qconfs.values()], default=0)
+        records = []
+        for qconf, cells in qconfSizes:
+            key = os.path.abspath(qconf)
+            entry = self.qconfs.get(key)
+            qstamp = stamp(qconf)
+            istamps = [stamp(source if isinstance(source, str) else source[0])
+                       for source in (images or {}).get(qconf, ())]
+            if entry is None or entry['cells'] != cells:
+                entry = {'stamp': qstamp, 'first': nextFree, 'cells': cells}
+                nextFree += cells
+            elif entry['stamp'] == qstamp and entry['images'] == istamps:
+                firsts[qconf] = entry['first']
+                continue
+            entry['stamp'] = qstamp
+            entry['images'] = istamps
+            self.qconfs[key] = entry
+            self.frames[key] = set()
+            records.append(dict(entry, qconf=key))
+            firsts[qconf] = entry['first']
+        with open(self.fileName, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+        return firsts
+
+    def isDone(self, qconf, frame):
+        """Return True if cells of QCONF from frame were saved."""
+        return frame in self.frames.get(os.path.abspath(qconf), ())
+
+
+class ManifestTest(unittest.TestCase):
+    """Test of resuming."""
+
+    def setUp(self):
+        """Create QCONFs."""
+        self.dir = tempfile.TemporaryDirectory()
+        self.fileName = os.path.join(self.dir.name, manifestName)
+        self.qconfs = []
+        for name in ('a.QCONF', 'b.QCONF'):
+            self.qconfs.append(os.path.join(self.dir.name, name))
+            with open(self.qconfs[-1], 'w') as f:
+                f.write(name)
+
+    def tearDown(self):
+        """Remove files."""
+        self.dir.cleanup()
+
+    def testResume(self):
+        """Saved frames are remembered, new QCONF is numbered after old ones."""
+        manifest = Manifest(self.fileName, {'edge': 10}, False)
+        self.assertDictEqual(manifest.allocate([(self.qconfs[0], 4)]), {self.qconfs[0]: 0})
+        frameDone(self.fileName, self.qconfs[0], 2)
+        manifest = Manifest(self.fileName, {'edge': 10}, True)
+        self.assertTrue(manifest.isDone(self.qconfs[0], 2))
+        self.assertFalse(manifest.isDone(self.qconfs[0], 1))
+        firsts = manifest.allocate([(self.qconfs[1], 3), (self.qconfs[0], 4)])
+        self.assertDictEqual(firsts, {self.qconfs[0]: 0, self.qconfs[1]: 4})
+        self.assertTrue(manifest.isDone(self.qconfs[0], 2))
+
+    def testImages(self):
+        """Frames are processed again when image of QCONF changes."""
+        image = os.path.join(self.dir.name, 'a.tif')
+        with open(image, 'w') as f:
+            f.write('a')
+        Manifest(self.fileName, {'edge': 10}, False).allocate([(self.qconfs[0], 4)], {self.qconfs[0]: [image]})
+        frameDone(self.fileName, self.qconfs[0], 2)
+        manifest = Manifest(self.fileName, {'edge': 10}, True)
+        manifest.allocate([(self.qconfs[0], 4)], {self.qconfs[0]: [image]})
+        self.assertTrue(manifest.isDone(self.qconfs[0], 2))
+        with open(image, 'w') as f:
+            f.write('ab')
+        manifest = Manifest(self.fileName, {'edge': 10}, True)
+        self.assertDictEqual(manifest.allocate([(self.qconfs[0], 4)], {self.qconfs[0]: [image]}), {self.qconfs[0]: 0})
+        self.assertFalse(manifest.isDone(self.qconfs[0], 2))
+
+    def testParams(self):
+        """Other parameters start from scratch."""
+        Manifest(self.fileName, {'edge': 10}, False).allocate([(self.qconfs[0], 4)])
+        frameDone(self.fileName, self.qconfs[0], 2)
+        manifest = Manifest(self.fileName, {'edge': 12}, True)
+        self.assertFalse(manifest.isDone(self.qconfs[0], 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
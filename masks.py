@@ -0,0 +1,115 @@
+"""
+Masks of cells from snake outlines.
+
+Outline nodes of final snakes in QCONF are rasterized directly in coordinates of cut cells, at output size, so masks
+are aligned with cells returned by imagefitting.processBatch (including padding and rescaling) and snake mask stacks
+do not have to be read. Pixel is inside cell if its center is inside outline polygon (even-odd rule). For each row of
+pixels, crossings of outline edges with the row are located among pixel centers, so memory is [cells rows nodes].
+"""
+
+import unittest
+import numpy
+from imagefitting import cutBoxes, processBatch
+
+
+def _polygons(outlines, sizes):
+    """Return [N M 2] array of outlines padded by repeating last node, bounding box is used if outline is missing."""
+    polygons = []
+    for outline, (x, y, w, h) in zip(outlines, sizes):
+        if outline is None or len(outline) < 3:
+            outline = [(x, y), (x + w, y), (x + w, y + h), (x, y + h)]
+        polygons.append(numpy.asarray(outline, dtype=numpy.float64).reshape(-1, 2))
+    length = max([len(p) for p in polygons], default=0)
+    out = numpy.empty((len(polygons), length, 2))
+    for i, p in enumerate(polygons):
+        out[i, :len(p)] = p
+        out[i, len(p):] = p[-1]  # zero-length edges cross nothing
+    return out
+
+
+def cellMasks(outlines, sizes, edge, shape, trueBackground=False, chunk=64):
+    """
+    Rasterize outlines of cells cut from one frame.
+
+    Args:
+        outlines - list of [M 2] arrays of (x, y) nodes of snake for each cell, in image coordinates, None if not known
+        sizes - N x 4 array of (startx, starty, width, height) bounding boxes, as for processBatch
+        edge - size of output cells
+        shape - (height, width) of frame
+        trueBackground - the same as for processBatch
+        chunk - number of cells whose crossings are computed at once, limits memory
+
+    Returns:
+        [N edge edge] boolean array, False also where cell is padded
+
+    """
+    sizes = numpy.asarray(sizes, dtype=numpy.int64).reshape(-1, 4)
+    e = int(edge)
+    startx, starty, cutw, cuth, valid, large = cutBoxes(sizes, edge, shape, trueBackground)
+    cutw = numpy.maximum(cutw, 1)
+    cuth = numpy.maximum(cuth, 1)
+    # size of cut after rescaling, as in imagefitting.resize
+    scale = edge / numpy.maximum(cutw, cuth)
+    outw = numpy.where(large, numpy.maximum(numpy.round(cutw * scale), 1), cutw)
+    outh = numpy.where(large, numpy.maximum(numpy.round(cuth * scale), 1), cuth)
+    colsup = numpy.round((edge - outw) / 2)
+    rowsup = numpy.round((edge - outh) / 2)
+    # image coordinates of centers of output pixels
+    cols = numpy.arange(e) - colsup[:, None]  # [N e]
+    rows = numpy.arange(e) - rowsup[:, None]
+    xs = startx[:, None] + (cols + 0.5) * (cutw / outw)[:, None]
+    ys = starty[:, None] + (rows + 0.5) * (cuth / outh)[:, None]
+    inCut = (((rows >= 0) & (rows < outh[:, None]))[:, :, None] & ((cols >= 0) & (cols < outw[:, None]))[:, None, :])
+    polygons = _polygons(outlines, sizes)
+    masks = numpy.zeros((len(sizes), e, e), dtype=bool)
+    for s in range(0, len(sizes), chunk):
+        p = polygons[s:s + chunk]
+        x1, y1 = p[:, None, :, 0], p[:, None, :, 1]  # [C 1 M]
+        x2, y2 = numpy.roll(x1, -1, axis=2), numpy.roll(y1, -1, axis=2)
+        y = ys[s:s + chunk, :, None]  # [C e 1]
+        spans = (y1 > y) != (y2 > y)  # edge crosses row, [C e M]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            crossx = numpy.where(spans, x1 + (y - y1) * (x2 - x1) / (y2 - y1), -numpy.inf)
+        rows = numpy.arange(e)[:, None] * (e + 1)
+        for c in range(len(p)):
+            # number of pixel centers left of each crossing in its row, [e M]
+            left = numpy.searchsorted(xs[s + c], crossx[c].ravel()).reshape(e, -1)
+            perPixel = numpy.bincount((rows + left).ravel(), minlength=e * (e + 1)).reshape(e, e + 1)
+            # number of edges right of pixel center in its row
+            crossings = numpy.cumsum(perPixel[:, ::-1], axis=1)[:, ::-1][:, 1:]
+            masks[s + c] = crossings % 2 == 1
+    return masks & inCut & valid[:, None, None]
+
+
+class CellMasksTest(unittest.TestCase):
+    """Compare with mask cut from image."""
+
+    def setUp(self):
+        """Draw outlines into image."""
+        self.shape = (50, 60)
+        self.outlines = [numpy.array([(10.2, 10.1), (20.3, 12.7), (18.1, 25.3), (8.4, 20.2)]),
+                         numpy.array([(40, 5), (55, 5), (55, 45), (40, 45)]),  # larger than edge
+                         None]
+        self.sizes = [(8, 10, 13, 16), (40, 5, 15, 40), (30, 30, 4, 6)]
+
+    def testAgainstImage(self):
+        """Padded cells are the same as cut of mask image, rescaled cell keeps its shape."""
+        from matplotlib.path import Path
+        centers = numpy.stack(numpy.mgrid[:self.shape[0], :self.shape[1]][::-1], axis=-1).reshape(-1, 2) + 0.5
+        image = Path(self.outlines[0]).contains_points(centers).reshape(self.shape).astype(numpy.uint8)
+        image[30:36, 30:34] = 1  # bounding box of cell without outline
+        for trueBackground in (False, True):
+            cells, status = processBatch(image, self.sizes, None, 20, trueBackground)
+            masks = cellMasks(self.outlines, self.sizes, 20, self.shape, trueBackground)
+            if not trueBackground:  # reflected background can contain other cells
+                numpy.testing.assert_array_equal(masks[0], cells[0] > 0)
+                numpy.testing.assert_array_equal(masks[2], cells[2] > 0)
+                self.assertEqual(status[1], 'rescaled')
+                self.assertEqual(masks[1].sum(), 8 * 20)  # 15x40 box scaled to 8x20
+            self.assertEqual(masks[0].sum(), image.sum() - 24)
+            numpy.testing.assert_array_equal(cellMasks(self.outlines, self.sizes, 20, self.shape, trueBackground, 1),
+                                             masks)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+"""
+Measure time spent in stages of processing.
+
+Each stage (folder scan, QCONF parse, stack load, cut, pad, rescale, write) collects duration of every call, number of
+processed items and bytes. Metrics of worker processes are merged into one report with totals, throughput and
+percentiles of call times.
+"""
+
+import contextlib
+import json
+import logging
+import time
+import unittest
+import numpy
+
+logger = logging.getLogger(__name__)
+
+
+class Metrics:
+    """Times, items and bytes of stages."""
+
+    def __init__(self):
+        """Create empty metrics."""
+        self.stages = {}  # {name: {'times': [], 'items':, 'bytes':}}
+        self.start = time.perf_counter()
+
+    def add(self, name, seconds, items=1, nbytes=0):
+        """Record one call of stage."""
+        stage = self.stages.setdefault(name, {'times': [], 'items': 0, 'bytes': 0})
+        stage['times'].append(seconds)
+        stage['items'] += items
+        stage['bytes'] += nbytes
+
+    @contextlib.contextmanager
+    def stage(self, name, items=1, nbytes=0):
+        """Measure code in with block as one call of stage."""
+        start = time.perf_counter()
+        yield
+        self.add(name, time.perf_counter() - start, items, nbytes)
+
+    def merge(self, other):
+        """Add calls recorded by other metrics, e.g. from worker process."""
+        for name, stage in other.stages.items():
+            mine = self.stages.setdefault(name, {'times': [], 'items': 0, 'bytes': 0})
+            mine['times'].extend(stage['times'])
+            mine['items'] += stage['items']
+            mine['bytes'] += stage['bytes']
+
+    def report(self):
+        """Return dictionary with wall time of run and statistics of each stage."""
+        wall = time.perf_counter() - self.start
+        stages = {}
+        for name, stage in self.stages.items():
+            times = numpy.array(stage['times'])
+            total = float(times.sum())
+            p50, p90, p99 = numpy.percentile(times, (50, 90, 99))
+            stages[name] = {'calls': len(times), 'seconds': total, 'items': stage['items'], 'bytes': stage['bytes'],
+                            'itemsPerSecond': stage['items'] / total if total > 0 else None,
+                            'bytesPerSecond': stage['bytes'] / total if total > 0 else None,
+                            'p50': float(p50), 'p90': float(p90), 'p99': float(p99), 'max': float(times.max())}
+        return {'wall': wall, 'stages': stages}
+
+    def printReport(self):
+        """Print report as table."""
+        report = self.report()
+        print("Wall time {:.3f} s".format(report['wall']))
+        print("{:<10}{:>8}{:>11}{:>10}{:>12}{:>11}{:>10}{:>10}".format(
+              'stage', 'calls', 'time [s]', 'items', 'items/s', 'MB', 'MB/s', 'p90 [ms]'))
+        for name, s in report['stages'].items():
+            print("{:<10}{:>8}{:>11.3f}{:>10}{:>12.1f}{:>11.2f}{:>10.2f}{:>10.2f}".format(
+                  name, s['calls'], s['seconds'], s['items'], s['itemsPerSecond'] or 0, s['bytes'] / 1e6,
+                  (s['bytesPerSecond'] or 0) / 1e6, s['p90'] * 1e3))
+
+    def saveReport(self, fileName):
+        """Save report as JSON."""
+        with open(fileName, 'w') as f:
+            json.dump(self.report(), f, indent=1)
+
+
+def timed(metrics, name, items=1, nbytes=0):
+    """Return metrics.stage or empty context if metrics is None."""
+    if metrics is None:
+        return contextlib.nullcontext()
+    return metrics.stage(name, items, nbytes)
+
+
+class Progress:
+    """Log processed cells not more often than every interval seconds."""
+
+    def __init__(self, total, interval=10):
+        """Start counting total items."""
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.start = time.perf_counter()
+        self.last = self.start
+
+    def update(self, items):
+        """Add processed items and log progress if interval has passed."""
+        self.done += items
+        now = time.perf_counter()
+        if now - self.last >= self.interval or self.done == self.total:
+            self.last = now
+            logger.info("Processed %d/%d cells, %.1f cells/s", self.done, self.total,
+                        self.done / (now - self.start) if now > self.start else 0)
+
+
+class MetricsTest(unittest.TestCase):
+    """Test of merging."""
+
+    def testMerge(self):
+        """Calls from two metrics are summed."""
+        m = Metrics()
+        m.add('cut', 0.5, items=10, nbytes=100)
+        other = Metrics()
+        with other.stage('cut', items=2):
+            pass
+        other.add('write', 1.0)
+        m.merge(other)
+        report = m.report()['stages']
+        self.assertEqual(report['cut']['calls'], 2)
+        self.assertEqual(report['cut']['items'], 12)
+        self.assertEqual(report['cut']['bytes'], 100)
+        self.assertEqual(report['write']['itemsPerSecond'], 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -20,9 +20,13 @@ KZ4-220214-ABD-GFP-dev6h-agar2+TRITC-2.lsm_CH_DIC.tif
 Images from the same experiments differ in endings: _CH_1, _CH_2, _CH_1_snakemask,.... The _CH_1 is that original one.
 User must provide all expected endings with the original one. Method will use first provided to guess corename and then
 add all remainaings to generate expected file list.
+
+Channels can be also read directly from original multi-channel file (e.g. the .lsm above), resolveChannels maps tails
+to channels of that file.
 """
 
 import os
+import re
 import unittest
 
 imageExt = ".tif"
@@ -67,6 +71,39 @@ def resolveNames(qconfname, tails):
     return tuple(ret)
 
 
+def resolveChannels(imagename, tails):
+    """Reslove channels of original multi-channel file instead of images exported from it.
+
+    Image from QCONF is either one of exported channels, then original file is its core name (e.g. name.lsm for
+    name.lsm_CH_1.tif), or original file itself.
+
+    Args:
+        imagename - name of image from QCONF
+        tails - list of channels, _CH_n (n is channel from 1) or channel index from 0
+
+    Return:
+        (original file name, list of channel indexes from 0, names of subimages as resolveNames would give for tails)
+    """
+    imagename = os.path.basename(imagename)
+    basename = os.path.splitext(imagename)[0]
+    source = imagename
+    for tail in tails:
+        if not tail.isdigit() and basename.endswith(tail):  # exported channel
+            basename = basename[:-len(tail)]
+            source = basename
+            break
+    channels = []
+    for tail in tails:
+        match = re.fullmatch(r'_CH_(\d+)', tail)
+        if tail.isdigit():
+            channels.append(int(tail))
+        elif match and int(match.group(1)) > 0:
+            channels.append(int(match.group(1)) - 1)
+        else:
+            raise ValueError("Tail " + tail + " is not channel, use _CH_n or channel index")
+    return source, channels, tuple(basename + tail + imageExt for tail in tails)
+
+
 class ResolveNamesTest(unittest.TestCase):
     """Test unit for resolveNames."""
 
@@ -101,5 +138,24 @@ class ResolveNamesTest(unittest.TestCase):
         self.assertTupleEqual(ret, ("qconfname_CH_1.QCONF",))
 
 
+class ResolveChannelsTest(unittest.TestCase):
+    """Test unit for resolveChannels."""
+
+    def testExported(self):
+        """Original file is found from exported channel."""
+        ret = resolveChannels("/a/name.lsm_CH_1.tif", ("_CH_2", "_CH_1"))
+        self.assertTupleEqual(ret, ("name.lsm", [1, 0], ("name.lsm_CH_2.tif", "name.lsm_CH_1.tif")))
+
+    def testOriginal(self):
+        """QCONF refers to original file, channels are given by indexes."""
+        ret = resolveChannels("name.lsm", ("0", "2"))
+        self.assertTupleEqual(ret, ("name.lsm", [0, 2], ("name0.tif", "name2.tif")))
+
+    def testNotChannel(self):
+        """Tail that is not channel."""
+        with self.assertRaises(ValueError):
+            resolveChannels("name.lsm_CH_1.tif", ("_CH_1", "_CH_DIC"))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,166 @@
+"""
+Keep results of QCONF parsing on disk.
+
+Index is JSON file that stores bounds, centroids, image name, frames, snake handlers and number of frames of each
+QCONF together with size and modification time of the file, and outline nodes if they were asked for. QCONF is parsed
+again only if it has changed since it was indexed or its outlines are needed and were not stored.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import unittest
+import numpy
+from scanqconf import ScanQconf
+
+logger = logging.getLogger(__name__)
+indexVersion = 4  # change if stored data change, old indexes are then ignored
+
+
+class QconfIndex:
+    """Cache of ScanQconf.getAll results."""
+
+    def __init__(self, fileName):
+        """Load index if exists."""
+        self.fileName = fileName
+        self.entries = {}
+        self.changed = False
+        if os.path.isfile(fileName):
+            with open(fileName, 'r') as f:
+                js = json.load(f)
+            if js.get('version') == indexVersion:
+                self.entries = js['entries']
+
+    @staticmethod
+    def stamp(qconf):
+        """Return size and modification time of file."""
+        st = os.stat(qconf)
+        return [st.st_size, st.st_mtime_ns]
+
+    def getAll(self, qconf, Qconf=ScanQconf, outlines=False):
+        """
+        Return bounds, centroids, image names and frames of QCONF, see ScanQconf.getAll.
+
+        Args:
+            qconf - path to QCONF file
+            Qconf - class used to parse file if it is not in index or changed, it must read outlines if they are asked
+                    for (StreamQconf with outlines=True)
+            outlines - store outline nodes too, see getOutlines
+
+        """
+        key = os.path.abspath(qconf)
+        stamp = self.stamp(qconf)
+        entry = self.entries.get(key)
+        if entry is None or entry['stamp'] != stamp or (outlines and 'outlines' not in entry):
+            sq = Qconf(qconf)
+            sq.getFileInfo()
+            b, c, n, f = sq.getAll()
+            entry = {'stamp': stamp, 'image': sq.getImageName(), 'numFrames': sq.getNumFrames(), 'bounds': b,
+                     'centroids': c, 'frames': f, 'handlers': sq.getHandlers()}
+            if outlines:
+                entry['outlines'] = [nodes.tolist() for nodes in sq.getOutlines()]
+            self.entries[key] = entry
+            self.changed = True
+        else:
+            logger.debug("%s from index", qconf)
+        return entry['bounds'], entry['centroids'], [entry['image']] * len(entry['bounds']), entry['frames']
+
+    def getNumFrames(self, qconf):
+        """Return number of frames of QCONF read by getAll."""
+        return self.entries[os.path.abspath(qconf)]['numFrames']
+
+    def getHandlers(self, qconf):
+        """Return snake handlers of cells of QCONF read by getAll, see ScanQconf.getHandlers."""
+        return self.entries[os.path.abspath(qconf)]['handlers']
+
+    def getOutlines(self, qconf):
+        """Return outline nodes of cells of QCONF read by getAll with outlines, see ScanQconf.getOutlines."""
+        return [numpy.array(nodes, dtype=numpy.float64).reshape(-1, 2)
+                for nodes in self.entries[os.path.abspath(qconf)]['outlines']]
+
+    def save(self):
+        """Save index if anything has changed. Entries of not existing QCONFs are removed."""
+        for key in [key for key in self.entries if not os.path.isfile(key)]:
+            del self.entries[key]
+            self.changed = True
+        if not self.changed:
+            return
+        tmpName = self.fileName + '.tmp'
+        with open(tmpName, 'w') as f:
+            json.dump({'version': indexVersion, 'entries': self.entries}, f)
+        os.replace(tmpName, self.fileName)  # do not leave broken index if interrupted
+        self.changed = False
+
+
+class QconfIndexTest(unittest.TestCase):
+    """Test of reusing indexed data."""
+
+    class CountingQconf(ScanQconf):
+        """Count parsed files."""
+
+        parsed = 0
+
+        def __init__(self, fileName):
+            """Count and parse."""
+            QconfIndexTest.CountingQconf.parsed += 1
+            super().__init__(fileName)
+
+        def getFileInfo(self):
+            """Do not print."""
+            pass
+
+    def setUp(self):
+        """Create QCONF."""
+        self.dir = tempfile.TemporaryDirectory()
+        self.qconf = os.path.join(self.dir.name, 'a.QCONF')
+        self.index = os.path.join(self.dir.name, 'index.json')
+        self.writeQconf(2)
+        QconfIndexTest.CountingQconf.parsed = 0
+
+    def tearDown(self):
+        """Remove files."""
+        self.dir.cleanup()
+
+    def writeQconf(self, frames):
+        """Write QCONF with one snake and given number of frames."""
+        snake = {'bounds': {'x': 1, 'y': 2, 'width': 3, 'height': 4}, 'centroid': {'x': 2.5, 'y': 4.0},
+                 'Elements': [{'point': {'x': 0, 'y': 1}}, {'point': {'x': 2, 'y': 3}}]}
+        js = {'createdOn': 'today',
+              'obj': {'BOAState': {'boap': {'orgFile': {'path': 'a.tif'}, 'FRAMES': frames},
+                                   'nest': {'sHs': [{'finalSnakes': [snake] * frames}]}}}}
+        with open(self.qconf, 'w') as f:
+            json.dump(js, f)
+
+    def testReuse(self):
+        """Second run does not parse, changed file is parsed."""
+        index = QconfIndex(self.index)
+        first = index.getAll(self.qconf, self.CountingQconf)
+        index.save()
+        index = QconfIndex(self.index)
+        self.assertTupleEqual(index.getAll(self.qconf, self.CountingQconf), first)
+        self.assertEqual(self.CountingQconf.parsed, 1)
+        self.writeQconf(3)
+        os.utime(self.qconf, ns=(0, 0))  # make sure that stamp changes
+        b, c, n, f = index.getAll(self.qconf, self.CountingQconf)
+        self.assertEqual(self.CountingQconf.parsed, 2)
+        self.assertListEqual(f, [1, 2, 3])
+        self.assertEqual(index.getNumFrames(self.qconf), 3)
+        self.assertListEqual(index.getHandlers(self.qconf), [0, 0, 0])
+
+    def testOutlines(self):
+        """Outlines are parsed once, when they are asked for the first time."""
+        index = QconfIndex(self.index)
+        index.getAll(self.qconf, self.CountingQconf)
+        index.getAll(self.qconf, self.CountingQconf, outlines=True)
+        index.save()
+        index = QconfIndex(self.index)
+        index.getAll(self.qconf, self.CountingQconf, outlines=True)
+        self.assertEqual(self.CountingQconf.parsed, 2)
+        outlines = index.getOutlines(self.qconf)
+        self.assertEqual(len(outlines), 2)
+        numpy.testing.assert_array_equal(outlines[0], [[0, 1], [2, 3]])
+
+
+if __name__ == '__main__':
+    unittest.main()
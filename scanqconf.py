@@ -1,6 +1,14 @@
 """Extract information from QCONF file."""
 
 import json
+import os
+import tempfile
+import unittest
+import numpy
+try:
+    import ijson
+except ImportError:  # streaming is optional
+    ijson = None
 
 
 class ScanQconf:
@@ -11,8 +19,12 @@ class ScanQconf:
               'QFRAME': ['obj', 'BOAState', 'boap', 'FRAMES'],
               'QSNAKES': ['obj', 'BOAState', 'nest', 'sHs'],
               'FINALS': 'finalSnakes',
+              'START': 'startFrame',
+              'END': 'endFrame',
               'BOUNDS': 'bounds',
-              'CENTROID': 'centroid'}
+              'CENTROID': 'centroid',
+              'NODES': 'Elements',
+              'POINT': 'point'}
 
     def __init__(self, fileName):
         """Initialize object Taking QCONF file name."""
@@ -43,6 +55,19 @@ class ScanQconf:
         sHs = self.__iteratreOver(self.keyMap["QSNAKES"])
         return sHs
 
+    @classmethod
+    def handlerFrames(cls, handler):
+        """
+        Return frame (from 1) of each final snake of SnakeHandler, None for snakes that were not tracked.
+
+        Snakes start at startFrame of handler and are not tracked after its endFrame. Handlers without these fields
+        cover the whole movie.
+        """
+        start = handler.get(cls.keyMap["START"], 1)
+        end = handler.get(cls.keyMap["END"])
+        return [start + i if snake is not None and (end is None or start + i <= end) else None
+                for i, snake in enumerate(handler[cls.keyMap["FINALS"]])]
+
     def getFinalSnakes(self):
         """
         Collect all final snakes into one list.
@@ -53,12 +78,21 @@ class ScanQconf:
         sHs = self.getSnakeHandler()
 
         for idx, val in enumerate(sHs):
-            for sdx, sval in enumerate(val[self.keyMap["FINALS"]]):
-                fs.append(sval)
+            for frame, sval in zip(self.handlerFrames(val), val[self.keyMap["FINALS"]]):
+                if frame is not None:
+                    fs.append(sval)
 
-        # print("\tProcessed", idx + 1, "handlers and", sdx + 1, "snakes")
         return fs
 
+    def getFrames(self):
+        """Return frames (from 1) of final snakes in the same order as getBounds."""
+        return [frame for val in self.getSnakeHandler() for frame in self.handlerFrames(val) if frame is not None]
+
+    def getHandlers(self):
+        """Return index of SnakeHandler of final snakes in the same order as getBounds."""
+        return [idx for idx, val in enumerate(self.getSnakeHandler())
+                for frame in self.handlerFrames(val) if frame is not None]
+
     def getBounds(self):
         """Return list of bounds for all final snakes."""
         b = []
@@ -75,6 +109,12 @@ class ScanQconf:
             c.append(sval[self.keyMap["CENTROID"]])
         return c
 
+    def getOutlines(self):
+        """Return list of [nodes 2] arrays of (x, y) outline nodes in the same order as getBounds."""
+        return [numpy.array([[e[self.keyMap["POINT"]]['x'], e[self.keyMap["POINT"]]['y']]
+                             for e in sval.get(self.keyMap["NODES"], [])], dtype=numpy.float64).reshape(-1, 2)
+                for sval in self.getFinalSnakes()]
+
     def getAll(self):
         """
         Return bounds, centroinds and imagename and frame indexes.
@@ -89,14 +129,7 @@ class ScanQconf:
         b = self.getBounds()
         c = self.getCentroid()
         n = [self.getImageName()] * len(b)
-
-        # number of SnakeHandler
-        sHN = len(self.getSnakeHandler())
-        # number of frames
-        fN = self.getNumFrames()
-        f = []
-        for s in range(0, sHN):
-            f.extend(list(range(1, fN + 1)))  # produce frame indexes [1,2,3,4...N, 1,2,3,4,....N] for each snake
+        f = self.getFrames()  # from startFrame to endFrame of each SnakeHandler
 
         return b, c, n, f
 
@@ -116,3 +149,195 @@ class ScanQconf:
             ans = ans[k]
 
         return ans
+
+
+class StreamQconf:
+    """
+    Extract the same information as ScanQconf.getAll in one pass over QCONF file.
+
+    File is parsed by ijson events and only fields used by getAll are kept, snake nodes (unless outlines are requested)
+    and other data are skipped without building them in memory. Requires ijson package.
+    """
+
+    boundsKeys = ('x', 'y', 'width', 'height')
+    centroidKeys = ('x', 'y')
+
+    def __init__(self, fileName, outlines=False):
+        """Parse QCONF file, nodes of snakes are kept only if outlines is True."""
+        if ijson is None:
+            raise ImportError("StreamQconf requires ijson package")
+        self.fileName = fileName
+        self.info = {'QDATE': None, 'QIMAGE': None, 'QFRAME': None}  # scalars, keys as in keyMap
+        self.numHandlers = 0
+        self.handlers = []  # {'start':, 'end':} of each SnakeHandler
+        self.snakes = []  # (handler, position in finalSnakes) of each not null snake
+        self.bounds = []
+        self.centroids = []
+        self.outlines = [] if outlines else None
+
+        keyMap = ScanQconf.keyMap
+        handler = '.'.join(keyMap["QSNAKES"]) + '.item'
+        snake = handler + '.' + keyMap["FINALS"] + '.item'
+        records = {snake + '.' + keyMap["BOUNDS"]: (self.bounds, self.boundsKeys),
+                   snake + '.' + keyMap["CENTROID"]: (self.centroids, self.centroidKeys)}
+        # prefixes of scalars to collect and where to put them
+        starts = {}
+        leaves = {'.'.join(keyMap[key]): (self.info, key) for key in self.info}
+        for prefix, (dest, keys) in records.items():
+            starts[prefix] = dest
+            for key in keys:
+                leaves[prefix + '.' + key] = (dest, key)
+        point = snake + '.' + keyMap["NODES"] + '.item.' + keyMap["POINT"]
+        pointKeys = {point + '.x': 0, point + '.y': 1}
+        rangeKeys = {handler + '.' + keyMap["START"]: 'start', handler + '.' + keyMap["END"]: 'end'}
+        position = 0  # in finalSnakes of current handler
+
+        with open(fileName, 'rb') as qconf:
+            for prefix, event, value in ijson.parse(qconf, use_float=True):
+                if event == 'start_map':
+                    if prefix in starts:
+                        starts[prefix].append({})
+                    elif prefix == handler:
+                        self.numHandlers += 1
+                        self.handlers.append({'start': 1, 'end': None})
+                        position = 0
+                    elif prefix == snake:
+                        self.snakes.append((self.numHandlers - 1, position))
+                        position += 1
+                        if outlines:
+                            self.outlines.append([])
+                    elif outlines and prefix == point:
+                        self.outlines[-1].append([0.0, 0.0])
+                elif event == 'null' and prefix == snake:  # not tracked
+                    position += 1
+                elif prefix in rangeKeys:
+                    self.handlers[-1][rangeKeys[prefix]] = value
+                elif outlines and prefix in pointKeys:
+                    self.outlines[-1][-1][pointKeys[prefix]] = value
+                elif prefix in leaves:
+                    dest, key = leaves[prefix]
+                    if isinstance(dest, list):
+                        dest[-1][key] = value
+                    else:
+                        dest[key] = value
+
+    def getFileInfo(self):
+        """Print object file name and parameters."""
+        print(self.fileName, "at", self.info["QDATE"])
+        print("Image:", self.getImageName())
+        print("Frames:", self.getNumFrames())
+
+    def getImageName(self):
+        """Return name of image."""
+        return self.info["QIMAGE"]
+
+    def getNumFrames(self):
+        """Return number of frames."""
+        return self.info["QFRAME"]
+
+    def getOutlines(self):
+        """Return outline nodes, see ScanQconf.getOutlines. Object must be created with outlines=True."""
+        if self.outlines is None:
+            raise ValueError("Outlines were not read, use outlines=True")
+        return [numpy.array(nodes, dtype=numpy.float64).reshape(-1, 2)
+                for nodes, frame in zip(self.outlines, self.snakeFrames()) if frame is not None]
+
+    def snakeFrames(self):
+        """Return frame of each not null snake, None if it is after endFrame of its handler, see handlerFrames."""
+        frames = []
+        for h, position in self.snakes:
+            start, end = self.handlers[h]['start'], self.handlers[h]['end']
+            frames.append(start + position if end is None or start + position <= end else None)
+        return frames
+
+    def getFrames(self):
+        """Return frames of final snakes, see ScanQconf.getFrames."""
+        return [frame for frame in self.snakeFrames() if frame is not None]
+
+    def getHandlers(self):
+        """Return index of SnakeHandler of final snakes, see ScanQconf.getHandlers."""
+        return [h for (h, _), frame in zip(self.snakes, self.snakeFrames()) if frame is not None]
+
+    def getAll(self):
+        """
+        Return bounds, centroinds and imagename and frame indexes.
+
+        See ScanQconf.getAll
+
+        """
+        frames = self.snakeFrames()
+        b = [bounds for bounds, frame in zip(self.bounds, frames) if frame is not None]
+        c = [centroid for centroid, frame in zip(self.centroids, frames) if frame is not None]
+        n = [self.getImageName()] * len(b)
+        return b, c, n, self.getFrames()
+
+
+class ScanQconfTest(unittest.TestCase):
+    """Test of QCONF readers."""
+
+    def setUp(self):
+        """Create small QCONF."""
+        snakes = []
+        for h in range(2):
+            fs = []
+            for f in range(3):
+                fs.append({'bounds': {'x': f, 'y': h, 'width': 10 + f, 'height': 20},
+                           'centroid': {'x': 1.5 * f, 'y': h + 0.5},
+                           'Elements': [{'point': {'x': 1.0, 'y': 2.0}}]})
+            snakes.append({'finalSnakes': fs, 'liveSnake': {'bounds': {'x': 100}}})
+        js = {'createdOn': 'today',
+              'obj': {'BOAState': {'boap': {'orgFile': {'path': '/a/b.tif'}, 'FRAMES': 3},
+                                   'nest': {'sHs': snakes}}}}
+        fd, self.name = tempfile.mkstemp(suffix='.QCONF')
+        with os.fdopen(fd, 'w') as qconf:
+            json.dump(js, qconf)
+
+    def tearDown(self):
+        """Remove QCONF."""
+        os.remove(self.name)
+
+    def testGetAll(self):
+        """Check frames and image name."""
+        b, c, n, f = ScanQconf(self.name).getAll()
+        self.assertEqual(len(b), 6)
+        self.assertListEqual(f, [1, 2, 3, 1, 2, 3])
+        self.assertListEqual(n, ['/a/b.tif'] * 6)
+
+    def testFrameRange(self):
+        """Snakes are in frames of their handler, not tracked snakes are skipped."""
+        with open(self.name, 'r') as f:
+            js = json.load(f)
+        sHs = js['obj']['BOAState']['nest']['sHs']
+        sHs[0].update(startFrame=2, endFrame=3)  # appears in frame 2 and last tracked snake is dropped
+        sHs[1].update(startFrame=1, endFrame=2)
+        sHs[1]['finalSnakes'][1] = None
+        with open(self.name, 'w') as f:
+            json.dump(js, f)
+        sq = ScanQconf(self.name)
+        b, c, n, f = sq.getAll()
+        self.assertListEqual(f, [2, 3, 1])
+        self.assertListEqual(sq.getHandlers(), [0, 0, 1])
+        self.assertListEqual([bounds['x'] for bounds in b], [0, 1, 0])
+        if ijson is not None:
+            st = StreamQconf(self.name, outlines=True)
+            self.assertTupleEqual(st.getAll(), (b, c, n, f))
+            self.assertListEqual(st.getHandlers(), [0, 0, 1])
+            self.assertEqual(len(st.getOutlines()), 3)
+
+    @unittest.skipIf(ijson is None, "ijson not installed")
+    def testStream(self):
+        """Streaming gives the same as full parser."""
+        sq = ScanQconf(self.name)
+        st = StreamQconf(self.name)
+        self.assertTupleEqual(st.getAll(), sq.getAll())
+        self.assertEqual(st.getNumFrames(), sq.getNumFrames())
+        self.assertEqual(st.getImageName(), sq.getImageName())
+        outlines = StreamQconf(self.name, outlines=True).getOutlines()
+        self.assertEqual(len(outlines), 6)
+        for a, b in zip(outlines, sq.getOutlines()):
+            numpy.testing.assert_array_equal(a, b)
+        numpy.testing.assert_array_equal(b, [[1.0, 2.0]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+"""
+Split one PrepareData run between many machines.
+
+The run has two phases. Stats phase parses all QCONFs and saves size of cells (edge), quartiles, histogram of sizes and
+global number of first cell of each QCONF to stats file. Crop phase reads this file, so every shard uses the same edge
+and cell numbers, and processes only its part of QCONFs. Each shard saves its counters, merge step sums them.
+"""
+
+import glob
+import json
+import os
+import tempfile
+import unittest
+from sizestats import SizeHistogram, columns
+
+statsVersion = 2  # QCONFs are keyed by path relative to input folder since 2
+
+
+def parseShard(text):
+    """Parse 'i/N' string to (i, N), i is 0-based."""
+    try:
+        index, count = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise ValueError("Shard must be given as i/N, e.g. 0/4")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError("Shard index must be in range 0..N-1")
+    return index, count
+
+
+def selectShard(fileList, shard):
+    """Return QCONFs of shard (i, N), every N-th file of sorted list starting from i."""
+    index, count = shard
+    return sorted(fileList)[index::count]
+
+
+def saveStats(fileName, edge, sizes, qconfSizes, folder):
+    """
+    Save results of stats phase.
+
+    Args:
+        fileName - stats file, JSON
+        edge - selected size of cells
+        sizes - SizeHistogram of all cells
+        qconfSizes - list of (qconf, number of cells) in order of numbering, cells are numbered from 0
+        folder - input folder, QCONFs are stored by path relative to it, so shards can mount it elsewhere
+
+    """
+    qconfs = {}
+    first = 0
+    for qconf, cells in qconfSizes:
+        qconfs[os.path.relpath(qconf, folder)] = {'first': first, 'cells': cells}
+        first += cells
+    quartiles = sizes.percentile((25, 50, 75)).tolist() if len(sizes) else None
+    with open(fileName, 'w') as f:
+        json.dump({'version': statsVersion, 'edge': float(edge), 'cells': first, 'columns': columns,
+                   'quartiles': quartiles, 'histogram': json.loads(sizes.toJson()), 'qconfs': qconfs}, f, indent=1)
+
+
+def loadStats(fileName):
+    """Read stats file, histogram is returned as SizeHistogram."""
+    with open(fileName, 'r') as f:
+        stats = json.load(f)
+    if stats.get('version') != statsVersion:
+        raise ValueError("Unknown version of stats file " + fileName)
+    stats['histogram'] = SizeHistogram.fromJson(json.dumps(stats['histogram']))
+    return stats
+
+
+def statsFirsts(stats, qconfSizes, folder):
+    """
+    Return {qconf: number of first cell} from stats, QCONFs are found by path relative to input folder.
+
+    Raises ValueError if QCONF was not in stats phase or has other number of cells, numbers would not be unique then.
+    """
+    firsts = {}
+    for qconf, cells in qconfSizes:
+        entry = stats['qconfs'].get(os.path.relpath(qconf, folder))
+        if entry is None or entry['cells'] != cells:
+            raise ValueError(qconf + " has changed since stats were computed, run stats phase again")
+        firsts[qconf] = entry['first']
+    return firsts
+
+
+def shardFileName(fileName, shard):
+    """Return name of file of shard, e.g. manifest-0of4.jsonl for manifest.jsonl."""
+    root, ext = os.path.splitext(fileName)
+    return '{}-{}of{}{}'.format(root, shard[0], shard[1], ext)
+
+
+def saveCounters(outputFolder, shard, counters, processed, tails, edge, channels=False):
+    """Save {'rescaled':, 'padded':} counters, number of processed cells, tails, edge and channels mode of shard."""
+    with open(os.path.join(outputFolder, shardFileName('counters.json', shard)), 'w') as f:
+        json.dump(dict(counters, processed=processed, tails=list(tails), edge=float(edge), shard=list(shard),
+                       channels=channels), f)
+
+
+def mergeShardCounters(outputFolder):
+    """
+    Sum counters of all shards saved in folder.
+
+    Returns:
+        (counters, processed, tails, edge, channels) - summed counters and numbers of processed cells, tails, edge and
+        channels mode of run. Raises ValueError if shards of some run are missing.
+
+    """
+    counters = {'rescaled': 0, 'padded': 0}
+    processed = 0
+    tails = ()
+    edge = None
+    channels = False
+    shards = []
+    for fileName in sorted(glob.glob(os.path.join(outputFolder, 'counters-*of*.json'))):
+        with open(fileName, 'r') as f:
+            js = json.load(f)
+        for key in counters:
+            counters[key] += js[key]
+        processed += js['processed']
+        tails = tuple(js['tails'])
+        edge = js['edge']
+        channels = js.get('channels', False)
+        shards.append(tuple(js['shard']))
+    if not shards:
+        raise ValueError("No counters of shards in " + outputFolder)
+    count = shards[0][1]
+    missing = set(range(count)) - set(i for i, n in shards if n == count)
+    if missing or any(n != count for _, n in shards):
+        raise ValueError("Counters of shards {} of {} are missing or from other run".format(sorted(missing), count))
+    return counters, processed, tails, edge, channels
+
+
+class ShardingTest(unittest.TestCase):
+    """Test of splitting and merging."""
+
+    def setUp(self):
+        """Create folder."""
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        """Remove folder."""
+        self.dir.cleanup()
+
+    def testSelect(self):
+        """Shards do not overlap and cover all files."""
+        files = ['f{}.QCONF'.format(i) for i in range(7)]
+        shards = [selectShard(files[::-1], (i, 3)) for i in range(3)]
+        self.assertListEqual(sorted(sum(shards, [])), sorted(files))
+        self.assertListEqual(shards[1], ['f1.QCONF', 'f4.QCONF'])
+        self.assertEqual(parseShard('2/3'), (2, 3))
+        with self.assertRaises(ValueError):
+            parseShard('3/3')
+
+    def testStats(self):
+        """Numbers of cells are read back, changed QCONF is refused."""
+        sizes = SizeHistogram()
+        sizes.add([{'width': 3, 'height': 4}, {'width': 5, 'height': 6}])
+        name = os.path.join(self.dir.name, 'stats.json')
+        saveStats(name, 10, sizes, [('/a/x.QCONF', 2), ('/a/y.QCONF', 3), ('/a/s/y.QCONF', 4)], '/a')
+        stats = loadStats(name)
+        self.assertEqual(stats['edge'], 10)
+        self.assertEqual(len(stats['histogram']), 2)
+        self.assertDictEqual(statsFirsts(stats, [('/b/y.QCONF', 3), ('/b/s/y.QCONF', 4)], '/b'),
+                             {'/b/y.QCONF': 2, '/b/s/y.QCONF': 5})
+        with self.assertRaises(ValueError):
+            statsFirsts(stats, [('/b/y.QCONF', 4)], '/b')
+
+    def testMerge(self):
+        """Counters are summed, missing shard is reported."""
+        saveCounters(self.dir.name, (0, 2), {'rescaled': 1, 'padded': 2}, 3, ('_CH_1',), 10)
+        with self.assertRaises(ValueError):
+            mergeShardCounters(self.dir.name)
+        saveCounters(self.dir.name, (1, 2), {'rescaled': 0, 'padded': 4}, 5, ('_CH_1',), 10)
+        counters, processed, tails, edge, channels = mergeShardCounters(self.dir.name)
+        self.assertDictEqual(counters, {'rescaled': 1, 'padded': 6})
+        self.assertEqual(processed, 8)
+        self.assertFalse(channels)
+        self.assertEqual(shardFileName('manifest.jsonl', (1, 2)), 'manifest-1of2.jsonl')
+
+
+if __name__ == '__main__':
+    unittest.main()
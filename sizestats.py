@@ -0,0 +1,123 @@
+"""
+Statistics of cell sizes computed without keeping all bounds.
+
+Widths and heights of bounding boxes are integers from a small range, so their histograms are exact and small.
+Histograms of separate QCONFs or worker processes are merged by adding counts and percentiles are computed from them
+exactly as numpy.percentile does from all values.
+"""
+
+import json
+import unittest
+from collections import Counter
+import numpy
+
+columns = ('Width', 'Height')
+
+
+class SizeHistogram:
+    """Histograms of widths and heights of bounding boxes."""
+
+    def __init__(self):
+        """Create empty histograms."""
+        self.counts = [Counter(), Counter()]  # for each of columns
+
+    def add(self, bounds):
+        """Add list of bounds dictionaries as returned by ScanQconf.getBounds."""
+        self.counts[0].update(b['width'] for b in bounds)
+        self.counts[1].update(b['height'] for b in bounds)
+
+    def merge(self, other):
+        """Add counts of other histogram."""
+        for mine, others in zip(self.counts, other.counts):
+            mine.update(others)
+
+    def __len__(self):
+        """Return number of added bounds."""
+        return sum(self.counts[0].values())
+
+    def _sorted(self, column):
+        """Return sorted values and cumulative counts of column."""
+        values = numpy.array(sorted(self.counts[column]))
+        cumulative = numpy.cumsum([self.counts[column][v] for v in values])
+        return values, cumulative
+
+    def percentile(self, q):
+        """Return [len(q) 2] array of percentiles of width and height, the same as numpy.percentile(axis=0)."""
+        q = numpy.asarray(q, dtype=numpy.float64) / 100
+        out = numpy.empty((len(q), len(columns)))
+        n = len(self)
+        for column in range(len(columns)):
+            values, cumulative = self._sorted(column)
+            index = (n - 1) * q  # linear method of numpy
+            low = numpy.floor(index).astype(int)
+            high = numpy.minimum(low + 1, n - 1)
+            gamma = index - low
+            a = values[numpy.searchsorted(cumulative, low, side='right')]
+            b = values[numpy.searchsorted(cumulative, high, side='right')]
+            diff = b - a
+            # the same rounding as numpy lerp
+            out[:, column] = numpy.where(gamma >= 0.5, b - diff * (1 - gamma), a + diff * gamma)
+        return out
+
+    def min(self):
+        """Return smallest width and height."""
+        return [min(c) for c in self.counts]
+
+    def max(self):
+        """Return largest width and height."""
+        return [max(c) for c in self.counts]
+
+    def boxStats(self, whis=1.5):
+        """Return list of statistics for matplotlib Axes.bxp, the same as for box plot of all values."""
+        stats = []
+        q1, med, q3 = self.percentile((25, 50, 75))
+        for column, label in enumerate(columns):
+            values = numpy.array(sorted(self.counts[column]))
+            iqr = q3[column] - q1[column]
+            inside = values[(values >= q1[column] - whis * iqr) & (values <= q3[column] + whis * iqr)]
+            stats.append({'label': label, 'med': med[column], 'q1': q1[column], 'q3': q3[column],
+                          'whislo': inside.min(), 'whishi': inside.max(),
+                          'fliers': values[(values < inside.min()) | (values > inside.max())]})
+        return stats
+
+    def toJson(self):
+        """Return histograms as JSON string."""
+        return json.dumps({label: sorted(c.items()) for label, c in zip(columns, self.counts)})
+
+    @classmethod
+    def fromJson(cls, text):
+        """Create histograms from string returned by toJson."""
+        js = json.loads(text)
+        hist = cls()
+        for label, c in zip(columns, hist.counts):
+            c.update(dict((v, n) for v, n in js[label]))
+        return hist
+
+
+class SizeHistogramTest(unittest.TestCase):
+    """Compare with numpy."""
+
+    def testPercentile(self):
+        """Merged histograms give the same percentiles as all values."""
+        sizes = numpy.random.randint(1, 80, size=(1001, 2))
+        bounds = [{'width': int(w), 'height': int(h)} for w, h in sizes]
+        hist = SizeHistogram()
+        hist.add(bounds[:400])
+        other = SizeHistogram()
+        other.add(bounds[400:])
+        hist.merge(other)
+        q = (0, 25, 50, 75, 33.3, 100)
+        numpy.testing.assert_array_equal(hist.percentile(q), numpy.percentile(sizes, q, axis=0))
+        self.assertListEqual(hist.min(), list(sizes.min(axis=0)))
+        self.assertListEqual(hist.max(), list(sizes.max(axis=0)))
+        self.assertEqual(len(hist), 1001)
+
+    def testJson(self):
+        """Histograms survive saving."""
+        hist = SizeHistogram()
+        hist.add([{'width': 3, 'height': 4}, {'width': 3, 'height': 5}])
+        numpy.testing.assert_array_equal(SizeHistogram.fromJson(hist.toJson()).percentile((50,)), [[3, 4.5]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,225 @@
+"""
+Keep frames of stacks in memory.
+
+Frames read from any stack (all tails share one cache) are kept up to memory budget. When budget is exceeded least
+recently used frames are removed. Stacks are kept open, so switching between them does not open files again.
+Frames needed by next jobs can also be read in advance by other thread, a bounded number of frames ahead, see
+FramePrefetcher.
+"""
+
+import logging
+import os
+import queue
+import tempfile
+import threading
+import unittest
+from collections import OrderedDict
+import numpy
+import tifffile
+from stackreader import openStack
+
+logger = logging.getLogger(__name__)
+
+
+class FrameCache:
+    """Frames of stacks with LRU eviction."""
+
+    def __init__(self, budget, maxOpen=16):
+        """
+        Create empty cache.
+
+        Args:
+            budget - memory for frames in bytes, if 0 frames are not kept and are returned as read by LazyStack
+            maxOpen - number of stacks kept open
+
+        """
+        self.budget = budget
+        self.maxOpen = maxOpen
+        self.frames = OrderedDict()  # {(fileName, index): frame}
+        self.stacks = OrderedDict()  # {fileName: LazyStack}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def stack(self, fileName):
+        """Return open stack, fileName can be also (file name, channel), see stackreader.openStack."""
+        if fileName in self.stacks:
+            self.stacks.move_to_end(fileName)
+        else:
+            self.stacks[fileName] = openStack(fileName)
+            if len(self.stacks) > self.maxOpen:
+                self.stacks.popitem(last=False)[1].close()
+        return self.stacks[fileName]
+
+    def get(self, fileName, index):
+        """Return frame of stack (index is 0-based)."""
+        key = (fileName, index)
+        if key in self.frames:
+            self.frames.move_to_end(key)
+            self.hits += 1
+            return self.frames[key]
+        self.misses += 1
+        if self.budget <= 0:
+            return self.stack(fileName)[index]
+        frame = numpy.array(self.stack(fileName)[index])  # copy, memory-mapped frame would not take memory
+        self.put(key, frame)
+        return frame
+
+    def put(self, key, frame):
+        """Keep frame read elsewhere under (fileName, index) key, if it fits budget."""
+        if key in self.frames or frame.nbytes > self.budget:
+            return
+        self.frames[key] = frame
+        self.size += frame.nbytes
+        while self.size > self.budget:
+            self.size -= self.frames.popitem(last=False)[1].nbytes
+
+    def close(self):
+        """Close stacks and remove frames."""
+        logger.debug("Frame cache: %d hits, %d misses", self.hits, self.misses)
+        for stack in self.stacks.values():
+            stack.close()
+        self.stacks.clear()
+        self.frames.clear()
+        self.size = 0
+
+
+class FramePrefetcher:
+    """
+    Frames of next jobs read by other thread, with get method of FrameCache.
+
+    Reader thread reads frames in order in which jobs take them, at most depth frames ahead of the taken one. Taken
+    frames are put to FrameCache, so they are kept for later jobs within its budget, and frames that are in cache are
+    not read again. Frames that job does not take (e.g. its cells were copied from crop cache) are dropped when later
+    frame is taken, frames that were not read ahead are read from cache.
+    """
+
+    def __init__(self, jobs, frames, cache, depth):
+        """
+        Start reader thread.
+
+        Args:
+            jobs - list of jobs, iterate over prefetcher to process them
+            frames - function returning list of (fileName, index) of frames job takes, in order of taking
+            cache - FrameCache
+            depth - number of frames read ahead, at least 1, memory of prefetched frames is bounded by it
+
+        """
+        if depth < 1:  # queue of size 0 would be unbounded
+            raise ValueError("At least one frame must be read ahead, depth is {}".format(depth))
+        self.jobs = jobs
+        self.cache = cache
+        self.queue = queue.Queue(maxsize=depth)
+        self.stop = threading.Event()
+        self.job = 0  # number of current job
+        self.following = None  # item taken from queue that belongs to later job
+        self.thread = threading.Thread(target=self.read, args=(frames,), daemon=True)
+        self.thread.start()
+
+    def read(self, frames):
+        """Queue (job number, key, frame, error) items of all jobs, runs in reader thread."""
+        reader = FrameCache(0)  # own open stacks, they are not shared between threads
+        number = 0
+        try:
+            for number, job in enumerate(self.jobs):
+                for key in frames(job):
+                    if self.stop.is_set():
+                        return
+                    frame = None if key in self.cache.frames else numpy.array(reader.get(*key))
+                    self.queue.put((number, key, frame, None))
+            self.queue.put((len(self.jobs), None, None, None))  # after the last job
+        except Exception as err:
+            self.queue.put((number, None, None, err))
+        finally:
+            reader.close()
+
+    def __iter__(self):
+        """Yield (job, self) for all jobs, frames of job are taken by get."""
+        for number, job in enumerate(self.jobs):
+            self.job = number
+            yield job, self
+
+    def get(self, fileName, index):
+        """Return frame of stack (index is 0-based), errors of reader are raised here."""
+        key = (fileName, index)
+        while True:
+            item = self.following if self.following is not None else self.queue.get()
+            self.following = None
+            number, itemKey, frame, err = item
+            if number > self.job:  # frame was not read ahead
+                self.following = item
+                return self.cache.get(fileName, index)
+            if err is not None:
+                raise err
+            if number == self.job and itemKey == key:
+                if frame is None:  # was in cache when reader got to it
+                    return self.cache.get(fileName, index)
+                self.cache.misses += 1
+                self.cache.put(key, frame)
+                return frame
+
+    def close(self):
+        """Stop reader thread, frames in cache are kept."""
+        self.stop.set()
+        while self.thread.is_alive():  # let reader finish if it waits on full queue
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+class FrameCacheTest(unittest.TestCase):
+    """Test of eviction."""
+
+    def setUp(self):
+        """Create stack."""
+        self.dir = tempfile.TemporaryDirectory()
+        self.name = os.path.join(self.dir.name, 'stack.tif')
+        self.stack = numpy.random.randint(0, 255, (6, 10, 10)).astype(numpy.uint8)
+        tifffile.imwrite(self.name, self.stack)
+
+    def tearDown(self):
+        """Remove stack."""
+        self.dir.cleanup()
+
+    def testEviction(self):
+        """Only frames within budget are kept, least recently used are removed."""
+        cache = FrameCache(250)  # two frames
+        for index in (0, 1, 0, 2, 0, 1):
+            numpy.testing.assert_array_equal(cache.get(self.name, index), self.stack[index])
+        self.assertEqual(cache.hits, 2)  # second 0 and third 0, 1 was removed by 2
+        self.assertListEqual(list(cache.frames), [(self.name, 0), (self.name, 1)])
+        self.assertEqual(cache.size, 200)
+        cache.close()
+
+    def testNoBudget(self):
+        """Nothing is kept."""
+        cache = FrameCache(0)
+        cache.get(self.name, 0)
+        cache.get(self.name, 0)
+        self.assertEqual(cache.hits, 0)
+        cache.close()
+
+    def testFramePrefetcher(self):
+        """Frames are read ahead in order, skipped and not prefetched frames are returned too, cache is used."""
+        cache = FrameCache(100)  # one frame
+        jobs = [[0, 1, 2], [2, 3], [4]]
+        prefetcher = FramePrefetcher(jobs, lambda job: [(self.name, index) for index in job], cache, 2)
+        taken = {0: [0, 2], 1: [2, 5, 3], 2: [4]}  # 1 is skipped, 5 was not read ahead
+        for number, (job, frames) in enumerate(prefetcher):
+            for index in taken[number]:
+                numpy.testing.assert_array_equal(frames.get(self.name, index), self.stack[index])
+        prefetcher.close()
+        self.assertListEqual(list(cache.frames), [(self.name, 4)])  # taken frames are kept
+        self.assertFalse(prefetcher.thread.is_alive())
+        prefetcher = FramePrefetcher([[0], [10]], lambda job: [(self.name, index) for index in job], cache, 1)
+        with self.assertRaises(IndexError):
+            for job, frames in prefetcher:
+                frames.get(self.name, job[0])
+        prefetcher.close()
+        with self.assertRaises(ValueError):
+            FramePrefetcher(jobs, lambda job: [(self.name, index) for index in job], cache, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,242 @@
+"""
+Access frames of image stacks without loading them.
+
+QCONF refers to [slices x y] stacks but only single frames are cut at time. Uncompressed TIFFs are memory-mapped,
+other TIFFs are decoded page by page on demand. Files that can not be opened as TIFF are loaded by skimage.io.imread.
+ChannelStack reads one channel of multi-channel TIFF or LSM file, only strips of that channel in requested frame are
+decoded.
+"""
+
+import os
+import tempfile
+import threading
+import unittest
+import numpy
+import tifffile
+from skimage import io
+
+
+class LazyStack:
+    """Stack of frames read on demand. Indexing by frame returns 2D image, as for array returned by io.imread."""
+
+    def __init__(self, fileName):
+        """Open stack, no pixels are read here."""
+        self.fileName = fileName
+        self.tif = None
+        self.pages = None
+        try:
+            data = tifffile.memmap(fileName, mode='r')  # only for uncompressed and contiguous data
+        except ValueError:  # also raised if file is not TIFF
+            data = None
+            try:
+                self.tif = tifffile.TiffFile(fileName)
+            except ValueError:
+                data = io.imread(fileName)
+        if data is not None:
+            if data.ndim == 2:  # single frame
+                data = data[numpy.newaxis]
+            self.data = data
+            self.shape = data.shape
+            self.dtype = data.dtype
+        else:
+            self.data = None
+            series = self.tif.series[0]
+            self.pages = series.pages
+            self.shape = (len(self.pages),) + tuple(series.shape[-2:])
+            self.dtype = series.dtype
+
+    def __len__(self):
+        """Return number of frames."""
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        """Return frame of given index (0-based) as 2D image."""
+        if self.data is not None:
+            return self.data[index]
+        return self.pages[index].asarray()
+
+    def __enter__(self):
+        """Use stack in with statement."""
+        return self
+
+    def __exit__(self, *args):
+        """Close stack at the end of with statement."""
+        self.close()
+
+    def close(self):
+        """Release file handles and mapped memory."""
+        if self.tif is not None:
+            self.tif.close()
+            self.tif = None
+        self.data = None
+        self.pages = None
+
+
+class ChannelStack:
+    """One channel of multi-channel file as stack of frames read on demand, interface is the same as of LazyStack."""
+
+    def __init__(self, fileName, channel):
+        """Open file and find pages of channel (0-based), no pixels are read here."""
+        self.fileName = fileName
+        self.channel = channel
+        self.lock = threading.Lock()  # file handle is shared by threads reading frames
+        self.tif = tifffile.TiffFile(fileName)
+        series = self.tif.series[0]
+        self.pages = series.pages
+        first = self.pages[0].keyframe
+        if first.samplesperpixel > 1:  # channels are samples of one page for each frame, e.g. LSM
+            numChannels = first.samplesperpixel
+            numFrames = len(self.pages)
+            self.index = numpy.arange(numFrames)
+        else:  # page for each frame and channel, e.g. ImageJ hyperstack
+            dims = series.shape[:-2]
+            axes = series.axes[:-2]
+            numChannels = dims[axes.index('C')] if 'C' in axes else 1
+            numFrames = int(numpy.prod(dims)) // numChannels
+            pages = numpy.arange(int(numpy.prod(dims))).reshape(dims)
+            if 'C' in axes:
+                pages = numpy.take(pages, channel if channel < numChannels else 0, axis=axes.index('C'))
+            self.index = pages.ravel()  # frames are all other dimensions in order of file
+        if not 0 <= channel < numChannels:
+            self.close()
+            raise ValueError("{} has {} channels, channel {} requested".format(fileName, numChannels, channel))
+        # last dimensions of series are samples for interleaved (contig) pages, size is taken from page
+        self.shape = (numFrames, first.imagelength, first.imagewidth)
+        self.dtype = numpy.dtype(series.dtype)
+
+    def __len__(self):
+        """Return number of frames."""
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        """Return channel of frame of given index (0-based) as 2D image."""
+        page = self.pages[int(self.index[index])]
+        key = page.keyframe  # pages can share properties of key page
+        if key.samplesperpixel == 1:
+            with self.lock:
+                return page.asarray()
+        if key.planarconfig != 2:  # interleaved samples are decoded together
+            with self.lock:
+                return page.asarray()[..., self.channel]
+        # separate planes, only strips (or tiles) of channel are read and decoded
+        out = numpy.zeros(self.shape[1:], dtype=self.dtype)
+        segments = len(page.dataoffsets) // key.samplesperpixel
+        fh = self.tif.filehandle
+        for i in range(self.channel * segments, (self.channel + 1) * segments):
+            with self.lock:
+                fh.seek(page.dataoffsets[i])
+                data = fh.read(page.databytecounts[i])
+            segment, (_, _, row, col, _), _ = key.decode(data, i, jpegtables=key.jpegtables)
+            if segment is None:  # empty strip
+                continue
+            segment = segment.reshape(segment.shape[-3:-1])[:out.shape[0] - row, :out.shape[1] - col]
+            out[row:row + segment.shape[0], col:col + segment.shape[1]] = segment
+        return out
+
+    def __enter__(self):
+        """Use stack in with statement."""
+        return self
+
+    def __exit__(self, *args):
+        """Close stack at the end of with statement."""
+        self.close()
+
+    def close(self):
+        """Release file handle."""
+        if self.tif is not None:
+            self.tif.close()
+            self.tif = None
+        self.pages = None
+
+
+def openStack(source):
+    """Open stack given by file name (LazyStack) or (file name, channel) of multi-channel file (ChannelStack)."""
+    if isinstance(source, str):
+        return LazyStack(source)
+    return ChannelStack(*source)
+
+
+class LazyStackTest(unittest.TestCase):
+    """Test if frames are the same as from whole stack."""
+
+    def setUp(self):
+        """Create stack."""
+        self.dir = tempfile.TemporaryDirectory()
+        self.stack = (numpy.random.rand(5, 12, 9) * 1000).astype(numpy.uint16)
+
+    def tearDown(self):
+        """Remove stack."""
+        self.dir.cleanup()
+
+    def checkFrames(self, **kwargs):
+        """Save stack with kwargs and compare all frames."""
+        name = os.path.join(self.dir.name, 'stack.tif')
+        tifffile.imwrite(name, self.stack, **kwargs)
+        with LazyStack(name) as im:
+            self.assertTupleEqual(im.shape, self.stack.shape)
+            self.assertEqual(im.dtype, self.stack.dtype)
+            for frame in range(len(im)):
+                numpy.testing.assert_array_equal(im[frame], self.stack[frame])
+            return im.data is not None
+
+    def testMemmap(self):
+        """Uncompressed stack is mapped."""
+        self.assertTrue(self.checkFrames())
+
+    def testPages(self):
+        """Compressed stack is read by pages."""
+        self.assertFalse(self.checkFrames(compression='zlib'))
+
+    def testSingleFrame(self):
+        """2D image is one frame."""
+        self.stack = self.stack[:1]
+        name = os.path.join(self.dir.name, 'frame.tif')
+        tifffile.imwrite(name, self.stack[0])
+        with LazyStack(name) as im:
+            self.assertEqual(len(im), 1)
+            numpy.testing.assert_array_equal(im[0], self.stack[0])
+
+
+class ChannelStackTest(unittest.TestCase):
+    """Channels are the same as in whole array for all layouts of file."""
+
+    def setUp(self):
+        """Create [frames channels y x] data."""
+        self.dir = tempfile.TemporaryDirectory()
+        self.stack = (numpy.random.rand(5, 3, 40, 24) * 1000).astype(numpy.uint16)
+
+    def tearDown(self):
+        """Remove files."""
+        self.dir.cleanup()
+
+    def checkChannels(self, data=None, **kwargs):
+        """Save data (stack if None) with kwargs and compare all frames of all channels."""
+        name = os.path.join(self.dir.name, 'stack.tif')
+        tifffile.imwrite(name, self.stack if data is None else data, **kwargs)
+        for channel in range(3):
+            with openStack((name, channel)) as im:
+                self.assertTupleEqual(im.shape, (5, 40, 24))
+                for frame in range(len(im)):
+                    numpy.testing.assert_array_equal(im[frame], self.stack[frame, channel])
+        with self.assertRaises(ValueError):
+            ChannelStack(name, 3)
+
+    def testSamples(self):
+        """Channels in separate planes of one page, as in LSM."""
+        self.checkChannels(planarconfig='separate', photometric='minisblack', rowsperstrip=16)
+
+    def testCompressedSamples(self):
+        """Compressed strips."""
+        self.checkChannels(planarconfig='separate', photometric='minisblack', rowsperstrip=7, compression='zlib')
+
+    def testContigSamples(self):
+        """Interleaved samples of one page, as in RGB file."""
+        self.checkChannels(numpy.moveaxis(self.stack, 1, -1), planarconfig='contig', photometric='rgb')
+
+    def testPages(self):
+        """Page for each channel."""
+        self.checkChannels(imagej=True, metadata={'axes': 'TCYX'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+"""
+Generate synthetic QuimP data.
+
+Writes QCONF files with BOAState/nest/sHs/finalSnakes structure read by ScanQconf and matching multi-frame TIFF
+stacks for each tail. Cells are ellipses that move randomly between frames, optionally they appear and disappear
+mid-movie. Used for tests and benchmarks.
+
+Usage:
+    python synthetic.py -o <outputfolder> [-q qconfs] [-c cells] [-f frames] [-x size] [-t tails] [--spans]
+"""
+
+import getopt
+import json
+import os
+import sys
+import tempfile
+import unittest
+import numpy
+import tifffile
+
+
+def makeSnake(cx, cy, rx, ry, angle, nodes):
+    """Return finalSnakes record of ellipse outline with bounds, centroid and nodes."""
+    t = numpy.linspace(0, 2 * numpy.pi, nodes, endpoint=False)
+    x = cx + rx * numpy.cos(t) * numpy.cos(angle) - ry * numpy.sin(t) * numpy.sin(angle)
+    y = cy + rx * numpy.cos(t) * numpy.sin(angle) + ry * numpy.sin(t) * numpy.cos(angle)
+    x0 = int(numpy.floor(x.min()))
+    y0 = int(numpy.floor(y.min()))
+    return {'bounds': {'x': x0, 'y': y0,
+                       'width': int(numpy.ceil(x.max())) - x0, 'height': int(numpy.ceil(y.max())) - y0},
+            'centroid': {'x': float(x.mean()), 'y': float(y.mean())},
+            'POINTS': nodes,
+            'Elements': [{'point': {'x': float(px), 'y': float(py)}, 'tracknumber': i}
+                         for i, (px, py) in enumerate(zip(x, y))]}
+
+
+def drawEllipse(image, cx, cy, rx, ry, angle, value):
+    """Fill ellipse in image."""
+    r = int(numpy.ceil(max(rx, ry))) + 1
+    ys = numpy.arange(max(int(cy) - r, 0), min(int(cy) + r + 1, image.shape[0]))
+    xs = numpy.arange(max(int(cx) - r, 0), min(int(cx) + r + 1, image.shape[1]))
+    dx = xs[None, :] - cx
+    dy = ys[:, None] - cy
+    u = dx * numpy.cos(angle) + dy * numpy.sin(angle)
+    v = -dx * numpy.sin(angle) + dy * numpy.cos(angle)
+    inside = (u / rx) ** 2 + (v / ry) ** 2 <= 1
+    image[ys[0]:ys[-1] + 1, xs[0]:xs[-1] + 1][inside] = value
+
+
+def makeDataset(folder, qconfs=2, cells=5, frames=10, imageSize=(256, 256), tails=('_CH_1', '_CH_2'),
+                cellSize=(10, 60), nodes=40, dtype='uint16', seed=0, spans=False):
+    """
+    Write synthetic QCONFs and stacks to folder.
+
+    Args:
+        folder - output folder, created if does not exist
+        qconfs - number of QCONF files, each with own stacks
+        cells - number of SnakeHandlers (tracked cells) in each QCONF
+        frames - number of frames of each stack
+        imageSize - (rows, cols) of frames
+        tails - tails of stacks, first is image referenced in QCONF, see nameresolver
+        cellSize - range of cell diameters
+        nodes - number of outline nodes of each snake
+        dtype - type of stacks
+        seed - seed of random generator
+        spans - cells are tracked from random startFrame to random endFrame, finalSnakes are null after endFrame,
+                otherwise all cells are tracked in all frames
+
+    Returns:
+        list of QCONF paths
+
+    """
+    rng = numpy.random.RandomState(seed)
+    os.makedirs(folder, exist_ok=True)
+    rows, cols = imageSize
+    top = numpy.iinfo(dtype).max if numpy.issubdtype(numpy.dtype(dtype), numpy.integer) else 1.0
+    ret = []
+    for q in range(qconfs):
+        base = 'synthetic' + str(q) + '.lsm'
+        stacks = [(rng.rand(frames, rows, cols) * top * 0.2).astype(dtype) for _ in tails]
+        sHs = []
+        for c in range(cells):
+            rx, ry = rng.uniform(cellSize[0], cellSize[1], 2) / 2
+            cx, cy = rng.uniform(0, cols), rng.uniform(0, rows)
+            angle = rng.uniform(0, numpy.pi)
+            start, end = numpy.sort(rng.randint(1, frames + 1, 2)) if spans else (1, frames)
+            finalSnakes = []
+            for f in range(frames):
+                cx = numpy.clip(cx + rng.normal(0, 2), 0, cols - 1)
+                cy = numpy.clip(cy + rng.normal(0, 2), 0, rows - 1)
+                if f + 1 < start:
+                    continue
+                if f + 1 > end:
+                    finalSnakes.append(None)
+                    continue
+                finalSnakes.append(makeSnake(cx, cy, rx, ry, angle, nodes))
+                for t, stack in enumerate(stacks):
+                    drawEllipse(stack[f], cx, cy, rx, ry, angle, top * (0.5 + 0.4 * t / len(tails)))
+            sHs.append({'ID': c, 'startFrame': int(start), 'endFrame': int(end), 'finalSnakes': finalSnakes})
+        for tail, stack in zip(tails, stacks):
+            tifffile.imwrite(os.path.join(folder, base + tail + '.tif'), stack)
+        js = {'className': 'QParamsQconf', 'version': ['synthetic'], 'createdOn': 'synthetic',
+              'obj': {'BOAState': {'boap': {'orgFile': {'path': os.path.join('/synthetic', base + tails[0] + '.tif')},
+                                            'FRAMES': frames},
+                                   'nest': {'sHs': sHs, 'NSNAKES': cells, 'ALIVE': cells, 'nextID': cells}}}}
+        qconf = os.path.join(folder, base + tails[0] + '.QCONF')
+        with open(qconf, 'w') as f:
+            json.dump(js, f)
+        ret.append(qconf)
+    return ret
+
+
+def main(argv):
+    """Generate dataset, see module description."""
+    kwargs = {}
+    folder = None
+    try:
+        opts, args = getopt.getopt(argv, "ho:q:c:f:x:t:", ["spans"])
+    except getopt.GetoptError as err:
+        print(__doc__)
+        print(err)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print(__doc__)
+            sys.exit()
+        elif opt == '-o':
+            folder = arg
+        elif opt == '-q':
+            kwargs['qconfs'] = int(arg)
+        elif opt == '-c':
+            kwargs['cells'] = int(arg)
+        elif opt == '-f':
+            kwargs['frames'] = int(arg)
+        elif opt == '-x':
+            kwargs['imageSize'] = (int(arg), int(arg))
+        elif opt == '-t':
+            kwargs['tails'] = tuple(arg.split(','))
+        elif opt == '--spans':
+            kwargs['spans'] = True
+    if not folder:
+        print("No output folder")
+        sys.exit(2)
+    print("Written", len(makeDataset(folder, **kwargs)), "QCONFs to", folder)
+
+
+class SyntheticTest(unittest.TestCase):
+    """Generated data can be read and processed."""
+
+    def setUp(self):
+        """Generate small dataset."""
+        self.dir = tempfile.TemporaryDirectory()
+        self.qconfs = makeDataset(self.dir.name, qconfs=2, cells=3, frames=5, imageSize=(64, 48))
+
+    def tearDown(self):
+        """Remove dataset."""
+        self.dir.cleanup()
+
+    def testRead(self):
+        """QCONF refers to stack with proper number of frames."""
+        from scanqconf import ScanQconf
+        from stackreader import LazyStack
+        sq = ScanQconf(self.qconfs[0])
+        b, c, n, f = sq.getAll()
+        self.assertEqual(len(b), 15)
+        with LazyStack(os.path.join(self.dir.name, os.path.basename(n[0]))) as stack:
+            self.assertTupleEqual(stack.shape, (5, 64, 48))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])